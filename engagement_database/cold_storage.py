@@ -0,0 +1,121 @@
+import datetime
+import gzip
+import json
+import uuid
+from collections import OrderedDict
+
+from core_data_modules.logging import Logger
+
+from storage.google_cloud import google_cloud_utils
+from util.lazy_imports import LazyModule
+
+firestore = LazyModule("google.cloud.firestore")
+
+log = Logger(__name__)
+
+_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+class ColdStorage(object):
+    def __init__(self, bucket_credentials_file_path, cold_storage_url, max_cached_blobs=16):
+        """
+        Google Cloud Storage location that EngagementDatabase records can be tiered to, once they no longer need to
+        be kept in Firestore.
+
+        Records are stored as gzipped JSON lines, partitioned by record kind and date, in blobs of the form
+        <cold_storage_url>/<kind>/<yyyy>/<mm>/<dd>/<uuid>.jsonl.gz
+
+        :param bucket_credentials_file_path: Path to a credentials file for accessing the cold storage bucket.
+        :type bucket_credentials_file_path: str
+        :param cold_storage_url: gs URL to the "directory" to store the tiered records in,
+                                 e.g. gs://<bucket-name>/engagement-database-cold-storage/test-project
+        :type cold_storage_url: str
+        :param max_cached_blobs: Maximum number of downloaded blobs to keep in memory, so that reading many records from
+                                 the same blob only downloads it once.
+        :type max_cached_blobs: int
+        """
+        self._bucket_credentials_file_path = bucket_credentials_file_path
+        self._cold_storage_url = cold_storage_url.rstrip("/")
+        self._max_cached_blobs = max_cached_blobs
+        self._blob_cache = OrderedDict()  # of blob url -> list of dict
+
+    def write_records(self, kind, partition_date, records):
+        """
+        Writes records to a new blob in cold storage.
+
+        :param kind: Kind of the records being written e.g. "messages". Used to partition the blobs.
+        :type kind: str
+        :param partition_date: Date to partition the blob by.
+        :type partition_date: datetime.date | datetime.datetime
+        :param records: Records to write. These may contain datetimes and Firestore document references, in addition
+                        to JSON-serializable types. Document references are stored as their paths.
+        :type records: list of dict
+        :return: gs URL of the blob the records were written to.
+        :rtype: str
+        """
+        blob_url = f"{self._cold_storage_url}/{kind}/{partition_date.strftime('%Y/%m/%d')}/{uuid.uuid4()}.jsonl.gz"
+        serialized = "".join(json.dumps(_encode(record)) + "\n" for record in records).encode("utf-8")
+        google_cloud_utils.upload_bytes_to_blob(
+            self._bucket_credentials_file_path, blob_url, gzip.compress(serialized), content_type="application/gzip"
+        )
+        log.info(f"Wrote {len(records)} {kind} records to cold storage blob '{blob_url}'")
+        return blob_url
+
+    def delete_records(self, blob_url):
+        """
+        Deletes a cold storage blob, e.g. after the records in it failed to be tiered.
+
+        :param blob_url: gs URL of the blob to delete, as returned by `write_records`.
+        :type blob_url: str
+        """
+        google_cloud_utils.delete_blob(self._bucket_credentials_file_path, blob_url)
+        self._blob_cache.pop(blob_url, None)
+
+    def read_records(self, blob_url):
+        """
+        Reads all the records in a cold storage blob.
+
+        Document references are returned as their paths.
+
+        :param blob_url: gs URL of the blob to read, as returned by `write_records`.
+        :type blob_url: str
+        :return: Records in the blob.
+        :rtype: list of dict
+        """
+        if blob_url in self._blob_cache:
+            self._blob_cache.move_to_end(blob_url)
+            return self._blob_cache[blob_url]
+
+        serialized = gzip.decompress(
+            google_cloud_utils.download_blob_to_bytes(self._bucket_credentials_file_path, blob_url)
+        ).decode("utf-8")
+        records = [json.loads(line, object_hook=_decode_object) for line in serialized.splitlines() if line != ""]
+
+        self._blob_cache[blob_url] = records
+        if len(self._blob_cache) > self._max_cached_blobs:
+            self._blob_cache.popitem(last=False)
+
+        return records
+
+
+def _encode(value):
+    if isinstance(value, dict):
+        return {k: _encode(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc)
+        return {"__datetime_utc__": value.strftime(_DATETIME_FORMAT)}
+    if isinstance(value, firestore.DocumentReference):
+        return {"__document_path__": value.path}
+    return value
+
+
+def _decode_object(d):
+    if "__datetime_utc__" in d:
+        return datetime.datetime.strptime(d["__datetime_utc__"], _DATETIME_FORMAT).replace(
+            tzinfo=datetime.timezone.utc)
+    if "__document_path__" in d:
+        return d["__document_path__"]
+    return d
@@ -0,0 +1,210 @@
+import datetime
+import json
+import os
+
+from core_data_modules.logging import Logger
+
+log = Logger(__name__)
+
+_MANIFEST_FILE_NAME = "manifest.json"
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.ipc
+    except ImportError as ex:
+        raise ImportError("Columnar exports require pyarrow. Install it with "
+                          "`pip install PipelineInfrastructure[columnar_export]`") from ex
+    return pyarrow
+
+
+def _to_epoch_micros(dt):
+    return (dt - _EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def _from_epoch_micros(micros):
+    return _EPOCH + datetime.timedelta(microseconds=micros)
+
+
+def _make_schema(pa, code_scheme_ids):
+    fields = [
+        pa.field("message_id", pa.string()),
+        pa.field("text", pa.string()),
+        pa.field("timestamp", pa.timestamp("us", tz="UTC")),
+        pa.field("participant_uuid", pa.string()),
+        pa.field("direction", pa.string()),
+        pa.field("channel_operator", pa.string()),
+        pa.field("status", pa.string()),
+        pa.field("dataset", pa.string()),
+        pa.field("coda_id", pa.string()),
+        pa.field("last_updated", pa.timestamp("us", tz="UTC")),
+        pa.field("previous_datasets", pa.list_(pa.string()))
+    ]
+    for scheme_id in code_scheme_ids:
+        fields.append(pa.field(f"{scheme_id}.code_id", pa.string()))
+        fields.append(pa.field(f"{scheme_id}.checked", pa.bool_()))
+    return pa.schema(fields)
+
+
+def _messages_to_record_batch(pa, schema, code_scheme_ids, messages):
+    columns = {field.name: [] for field in schema}
+    for msg in messages:
+        columns["message_id"].append(msg.message_id)
+        columns["text"].append(msg.text)
+        columns["timestamp"].append(msg.timestamp)
+        columns["participant_uuid"].append(msg.participant_uuid)
+        columns["direction"].append(msg.direction)
+        columns["channel_operator"].append(msg.channel_operator)
+        columns["status"].append(msg.status)
+        columns["dataset"].append(msg.dataset)
+        columns["coda_id"].append(msg.coda_id)
+        columns["last_updated"].append(msg.last_updated)
+        columns["previous_datasets"].append(msg.previous_datasets)
+
+        latest_labels = {label.scheme_id: label for label in msg.get_latest_labels()}
+        for scheme_id in code_scheme_ids:
+            label = latest_labels.get(scheme_id)
+            columns[f"{scheme_id}.code_id"].append(None if label is None else label.code_id)
+            columns[f"{scheme_id}.checked"].append(None if label is None else label.checked)
+
+    return pa.RecordBatch.from_arrays(
+        [pa.array(columns[field.name], type=field.type) for field in schema], schema=schema
+    )
+
+
+def _read_manifest(export_dir):
+    manifest_path = os.path.join(export_dir, _MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _write_manifest(export_dir, manifest):
+    manifest_path = os.path.join(export_dir, _MANIFEST_FILE_NAME)
+    with open(f"{manifest_path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def export_messages(database, export_dir, code_scheme_ids, page_size=1000):
+    """
+    Exports messages from an EngagementDatabase to a directory of columnar Arrow IPC files, which can be memory-mapped
+    by `read_export`.
+
+    Each call appends a new part file containing only the messages whose `last_updated` is later than the latest
+    `last_updated` in the previous parts. Messages are streamed from Firestore a page at a time, so memory use is
+    bounded by `page_size` rather than by the size of the database.
+    Messages which were updated since a previous export appear in more than one part. The latest version of each
+    message is in the part with the highest index. A message which is updated during an export can also appear more
+    than once in the same part, with its latest version last.
+
+    Labels are flattened to two columns per code scheme: "<scheme_id>.code_id" and "<scheme_id>.checked", for the
+    latest label assigned in that scheme.
+
+    Requires pyarrow.
+
+    :param database: Database to export messages from.
+    :type database: engagement_database.EngagementDatabase
+    :param export_dir: Directory to write the export to. This is created if it doesn't exist.
+    :type export_dir: str
+    :param code_scheme_ids: Ids of the code schemes to export labels for. Must be the same for every export to the
+                            same `export_dir`.
+    :type code_scheme_ids: list of str
+    :param page_size: Number of messages to download from Firestore and write to the export at a time.
+    :type page_size: int
+    :return: Number of messages exported.
+    :rtype: int
+    """
+    pa = _import_pyarrow()
+    os.makedirs(export_dir, exist_ok=True)
+
+    manifest = _read_manifest(export_dir)
+    if manifest is None:
+        manifest = {"code_scheme_ids": list(code_scheme_ids), "parts": [], "last_updated_watermark_micros": None}
+    assert manifest["code_scheme_ids"] == list(code_scheme_ids), \
+        f"Export in '{export_dir}' was made with code schemes {manifest['code_scheme_ids']}, " \
+        f"which don't match the requested code schemes {list(code_scheme_ids)}"
+
+    watermark_micros = manifest["last_updated_watermark_micros"]
+    if watermark_micros is None:
+        log.info(f"Exporting all messages to '{export_dir}'...")
+        query_filter = lambda q: q.order_by("last_updated")
+    else:
+        watermark = _from_epoch_micros(watermark_micros)
+        log.info(f"Exporting messages updated after {watermark.isoformat()} to '{export_dir}'...")
+        query_filter = lambda q: q.where("last_updated", ">", watermark).order_by("last_updated")
+
+    schema = _make_schema(pa, code_scheme_ids)
+    part_name = f"part-{len(manifest['parts']):05d}.arrow"
+    part_path = os.path.join(export_dir, part_name)
+    exported_count = 0
+    with pa.OSFile(f"{part_path}.tmp", "wb") as sink:
+        writer = pa.ipc.new_file(sink, schema)
+        for messages in database.iterate_message_pages(query_filter, page_size):
+            if len(messages) == 0:
+                continue
+            writer.write_batch(_messages_to_record_batch(pa, schema, code_scheme_ids, messages))
+            watermark_micros = max(_to_epoch_micros(msg.last_updated) for msg in messages)
+            exported_count += len(messages)
+            log.debug(f"Exported {exported_count} messages...")
+        writer.close()
+
+    if exported_count == 0:
+        os.remove(f"{part_path}.tmp")
+        log.info("No new messages to export")
+        return 0
+
+    # Only publish the new part once it's complete, so that a failed export doesn't leave a partial part behind.
+    os.replace(f"{part_path}.tmp", part_path)
+    manifest["parts"].append(part_name)
+    manifest["last_updated_watermark_micros"] = watermark_micros
+    _write_manifest(export_dir, manifest)
+    log.info(f"Exported {exported_count} messages to '{part_path}'")
+
+    return exported_count
+
+
+def read_export(export_dir, latest_only=True):
+    """
+    Reads a columnar export made by `export_messages`, memory-mapping its part files so that the data isn't copied
+    into memory until it is accessed.
+
+    Requires pyarrow.
+
+    :param export_dir: Directory containing the export.
+    :type export_dir: str
+    :param latest_only: Whether to only return the latest version of each message. If False, returns every version of
+                        each message that was exported, in export order. The latest versions are copied into a new
+                        table in memory.
+    :type latest_only: bool
+    :return: Table of exported messages.
+    :rtype: pyarrow.Table
+    """
+    pa = _import_pyarrow()
+
+    manifest = _read_manifest(export_dir)
+    assert manifest is not None, f"No columnar export found in '{export_dir}'"
+
+    tables = []
+    for part_name in manifest["parts"]:
+        source = pa.memory_map(os.path.join(export_dir, part_name), "r")
+        tables.append(pa.ipc.open_file(source).read_all())
+
+    if len(tables) == 0:
+        return _make_schema(pa, manifest["code_scheme_ids"]).empty_table()
+    table = pa.concat_tables(tables)
+
+    if latest_only:
+        # Keep the last row for each message id, because messages are exported in order of when they were last
+        # updated. A message updated during the export can appear more than once, even within a single part.
+        pc = pa.compute
+        row_indices = pc.subtract(pc.cumulative_sum(pa.repeat(pa.scalar(1, pa.int64()), table.num_rows)), 1)
+        latest_indices = pa.table({"message_id": table.column("message_id"), "row_index": row_indices}) \
+            .group_by("message_id").aggregate([("row_index", "max")]).column("row_index_max")
+        table = table.take(latest_indices.take(pc.sort_indices(latest_indices)))
+
+    return table
@@ -1,3 +1,5 @@
+import hashlib
+import json
 import uuid
 
 from core_data_modules.data_models import Label
@@ -50,7 +52,8 @@ class Message(object):
         :type coda_id: str | None
         :param last_updated: Timestamp this message was last updated in Firestore, or None if it does not yet exist.
         :type last_updated: datetime.datetime | None
-        :param previous_datasets: Datasets which this message originally belonged to/moved from. If None, initialises with an empty list
+        :param previous_datasets: Datasets which this message originally belonged to/moved from. If None, initialises
+                                  with an empty list
         :type previous_datasets: list of strings | None
         """
 
@@ -151,31 +154,56 @@ class HistoryEntry(object):
         self.origin = origin
         self.timestamp = timestamp
 
-    def to_dict(self):
+    def to_dict(self, reference_origin_template=False):
+        """
+        :param reference_origin_template: Whether to serialize the origin as a reference to its origin template,
+                                          rather than embedding a full copy of the origin. This only has an effect if
+                                          the origin was made from a `HistoryEntryOriginTemplate`.
+        :type reference_origin_template: bool
+        :return: Serialized history entry.
+        :rtype: dict
+        """
+        if reference_origin_template and self.origin.template_id is not None:
+            origin = self.origin.to_template_reference_dict()
+        else:
+            origin = self.origin.to_dict()
+
         return {
             "history_entry_id": self.history_entry_id,
             "update_path": self.update_path,
             "updated_doc": self.updated_doc.to_dict(),
-            "origin": self.origin.to_dict(),
+            "origin": origin,
             "timestamp": self.timestamp
         }
 
     @classmethod
-    def from_dict(cls, d, doc_type=None):
+    def from_dict(cls, d, doc_type=None, origin_templates=None):
         """
         :param d: Dictionary to initialise from.
         :type d: dict
         :param doc_type: Type to deserialize the updated_doc to e.g. `Message`. If None, returns the updated_doc in its
                          serialized form.
         :type doc_type: class with from_dict() method.
+        :param origin_templates: Dictionary of template id -> origin template, used to resolve origins that were
+                                 serialized as a reference to their template. Only required if `d` contains such an
+                                 origin reference.
+        :type origin_templates: dict of str -> HistoryEntryOriginTemplate | None
         :return: HistoryEntry instance
         :rtype: HistoryEntry
         """
+        if HistoryEntryOrigin.is_template_reference_dict(d["origin"]):
+            template_id = d["origin"]["template_id"]
+            assert origin_templates is not None and template_id in origin_templates, \
+                f"History entry {d['history_entry_id']} references origin template {template_id}, which was not given"
+            origin = origin_templates[template_id].make_origin(d["origin"]["details"])
+        else:
+            origin = HistoryEntryOrigin.from_dict(d["origin"])
+
         return HistoryEntry(
             history_entry_id=d["history_entry_id"],
             update_path=d["update_path"],
             updated_doc=d["updated_doc"] if doc_type is None else doc_type.from_dict(d["updated_doc"]),
-            origin=HistoryEntryOrigin.from_dict(d["origin"]),
+            origin=origin,
             timestamp=d["timestamp"]
         )
 
@@ -188,7 +216,8 @@ class HistoryEntryOrigin(object):
     _default_pipeline = None
     _default_commit = None
 
-    def __init__(self, origin_name, details, user=None, project=None, pipeline=None, commit=None, line=None):
+    def __init__(self, origin_name, details, user=None, project=None, pipeline=None, commit=None, line=None,
+                 template_id=None):
         """
         Represents the origin description for a history event.
 
@@ -198,13 +227,16 @@ class HistoryEntryOrigin(object):
                      If None, attempts to use the global default set by cls.set_defaults if it exists, otherwise fails.
         :type user: str | None
         :param project: Name of the project that created the update, ideally as the repository origin url.
-                        If None, attempts to use the global default set by cls.set_defaults if it exists, otherwise fails.
+                        If None, attempts to use the global default set by cls.set_defaults if it exists, otherwise
+                        fails.
         :type project: str
         :param commit: Id of the vcs commit for the version of code that created the update.
-                       If None, attempts to use the global default set by cls.set_defaults if it exists, otherwise fails.
+                       If None, attempts to use the global default set by cls.set_defaults if it exists, otherwise
+                       fails.
         :type commit: str
         :param pipeline: Name of the pipeline that created the update.
-                         If None, attempts to use the global default set by cls.set_defaults if it exists, otherwise fails.
+                         If None, attempts to use the global default set by cls.set_defaults if it exists, otherwise
+                         fails.
         :type pipeline: str
         :param details: Dictionary containing any update-specific details that help to explain/justify the update.
                         This is to aid with manual debugging, and would typically include a copy of source data and
@@ -217,10 +249,27 @@ class HistoryEntryOrigin(object):
         :param line: Line of code that created the update. If None, automatically sets to the line that called this
                      constructor.
         :type line: str | None
+        :param template_id: Id of the `HistoryEntryOriginTemplate` this origin was made from, or None.
+                            Origins with a template id can be stored as a reference to their template rather than as a
+                            full copy. Set automatically by `HistoryEntryOriginTemplate.make_origin`.
+        :type template_id: str | None
         """
         if line is None:
             line = Metadata.get_call_location(depth=2)
 
+        user, project, pipeline, commit = HistoryEntryOrigin._resolve_defaults(user, project, pipeline, commit)
+
+        self.origin_name = origin_name
+        self.user = user
+        self.project = project
+        self.commit = commit
+        self.pipeline = pipeline
+        self.line = line
+        self.details = details
+        self.template_id = template_id
+
+    @staticmethod
+    def _resolve_defaults(user, project, pipeline, commit):
         if user is None:
             assert HistoryEntryOrigin._default_user is not None, \
                 "No default user set. Set one with HistoryEventOrigin.set_defaults"
@@ -241,13 +290,7 @@ class HistoryEntryOrigin(object):
                 "No default commit set. Set one with HistoryEventOrigin.set_defaults"
             commit = HistoryEntryOrigin._default_commit
 
-        self.origin_name = origin_name
-        self.user = user
-        self.project = project
-        self.commit = commit
-        self.pipeline = pipeline
-        self.line = line
-        self.details = details
+        return user, project, pipeline, commit
 
     @classmethod
     def set_defaults(cls, user, project, pipeline, commit):
@@ -270,7 +313,7 @@ class HistoryEntryOrigin(object):
         cls._default_commit = commit
 
     def to_dict(self):
-        return {
+        origin_dict = {
             "origin_name": self.origin_name,
             "user": self.user,
             "project": self.project,
@@ -280,6 +323,29 @@ class HistoryEntryOrigin(object):
             "details": self.details
         }
 
+        if self.template_id is not None:
+            origin_dict["template_id"] = self.template_id
+
+        return origin_dict
+
+    def to_template_reference_dict(self):
+        """
+        Serializes this origin as a reference to its origin template plus the details that are specific to this origin.
+
+        :return: Serialized reference to this origin's template.
+        :rtype: dict
+        """
+        assert self.template_id is not None, "Only origins made from a HistoryEntryOriginTemplate can be serialized " \
+                                             "as a template reference"
+        return {
+            "template_id": self.template_id,
+            "details": self.details
+        }
+
+    @staticmethod
+    def is_template_reference_dict(d):
+        return "origin_name" not in d and "template_id" in d
+
     @classmethod
     def from_dict(cls, d):
         return HistoryEntryOrigin(
@@ -289,5 +355,111 @@ class HistoryEntryOrigin(object):
             pipeline=d["pipeline"],
             details=d["details"],
             commit=d["commit"],
+            line=d["line"],
+            template_id=d.get("template_id")
+        )
+
+
+class HistoryEntryOriginTemplate(object):
+    def __init__(self, origin_name, user=None, project=None, pipeline=None, commit=None, line=None):
+        """
+        Template for constructing many `HistoryEntryOrigin`s which only differ in their `details`, for example when
+        writing one origin per message in a bulk sync.
+
+        The defaults and the line of code are resolved once, when the template is constructed, so origins made with
+        `make_origin` don't need to inspect the call stack.
+
+        :param origin_name: Human-friendly name describing the origin of the updates e.g. "Rapid Pro -> Database Sync"
+        :type origin_name: str
+        :param user: Id of the user who ran the program that created the updates e.g. user@domain.com.
+                     If None, attempts to use the global default set by HistoryEntryOrigin.set_defaults if it exists,
+                     otherwise fails.
+        :type user: str | None
+        :param project: Name of the project that created the updates, ideally as the repository origin url.
+                        If None, attempts to use the global default set by HistoryEntryOrigin.set_defaults if it
+                        exists, otherwise fails.
+        :type project: str | None
+        :param pipeline: Name of the pipeline that created the updates.
+                         If None, attempts to use the global default set by HistoryEntryOrigin.set_defaults if it
+                         exists, otherwise fails.
+        :type pipeline: str | None
+        :param commit: Id of the vcs commit for the version of code that created the updates.
+                       If None, attempts to use the global default set by HistoryEntryOrigin.set_defaults if it exists,
+                       otherwise fails.
+        :type commit: str | None
+        :param line: Line of code that created the updates. If None, automatically sets to the line that called this
+                     constructor.
+        :type line: str | None
+        """
+        if line is None:
+            line = Metadata.get_call_location(depth=2)
+
+        user, project, pipeline, commit = HistoryEntryOrigin._resolve_defaults(user, project, pipeline, commit)
+
+        self.origin_name = origin_name
+        self.user = user
+        self.project = project
+        self.commit = commit
+        self.pipeline = pipeline
+        self.line = line
+
+        # Derive the id from the template's contents, so that identical templates constructed in different runs share
+        # the same id, and therefore the same stored template document.
+        self.template_id = hashlib.sha256(json.dumps(self.to_dict(), sort_keys=True).encode("utf-8")).hexdigest()
+
+    def make_origin(self, details):
+        """
+        :param details: Dictionary containing any update-specific details that help to explain/justify the update.
+                        See `HistoryEntryOrigin` for more details.
+        :type details: dict
+        :return: Origin with the fields from this template and the given `details`.
+        :rtype: HistoryEntryOrigin
+        """
+        return HistoryEntryOrigin(
+            origin_name=self.origin_name,
+            details=details,
+            user=self.user,
+            project=self.project,
+            pipeline=self.pipeline,
+            commit=self.commit,
+            line=self.line,
+            template_id=self.template_id
+        )
+
+    @classmethod
+    def from_origin(cls, origin):
+        """
+        :param origin: Origin to extract the template fields from.
+        :type origin: HistoryEntryOrigin
+        :return: Template with the same fields as `origin`, excluding its `details`.
+        :rtype: HistoryEntryOriginTemplate
+        """
+        return HistoryEntryOriginTemplate(
+            origin_name=origin.origin_name,
+            user=origin.user,
+            project=origin.project,
+            pipeline=origin.pipeline,
+            commit=origin.commit,
+            line=origin.line
+        )
+
+    def to_dict(self):
+        return {
+            "origin_name": self.origin_name,
+            "user": self.user,
+            "project": self.project,
+            "commit": self.commit,
+            "pipeline": self.pipeline,
+            "line": self.line
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return HistoryEntryOriginTemplate(
+            origin_name=d["origin_name"],
+            user=d["user"],
+            project=d["project"],
+            pipeline=d["pipeline"],
+            commit=d["commit"],
             line=d["line"]
         )
@@ -1,27 +1,64 @@
-import uuid
+import datetime
+import random
+import threading
+import time
+from collections import deque
 
-from google.cloud import firestore
+from core_data_modules.logging import Logger
 
-from engagement_database.data_models import Message, HistoryEntry
+from engagement_database.data_models import (Message, HistoryEntry, HistoryEntryOrigin, HistoryEntryOriginTemplate,
+                                             MessageStatuses)
+from util.firestore_metrics import estimate_document_size, get_firestore_metrics, measure_read_result
+from util.firestore_operations import get_operation_executor, is_retryable_error, READ, WRITE
 from util.firestore_utils import make_firestore_client
+from util.lazy_imports import LazyModule
+
+exceptions = LazyModule("google.api_core.exceptions")
+firestore = LazyModule("google.cloud.firestore")
+
+log = Logger(__name__)
+
+# Firestore allows at most 500 writes in a single transaction, and each message update costs 2 writes
+# (the message itself + its history entry).
+MAX_MESSAGES_PER_TRANSACTION = 250
+
+# Field that marks a message document as a tombstone for a message that has been tiered to cold storage.
+# The value is the gs URL of the cold storage blob containing the full message.
+_COLD_STORAGE_BLOB_URL_KEY = "cold_storage_blob_url"
 
 
 class EngagementDatabase(object):
-    def __init__(self, client, database_path):
+    def __init__(self, client, database_path, reference_origin_templates=False):
         """
         :param client: Firebase client.
         :type client: firebase_admin.auth.Client
         :param database_path: Path to the parent database document e.g. "databases/test-project"
         :type database_path: str
+        :param reference_origin_templates: Whether to write history entries whose origin was made from a
+                                           `HistoryEntryOriginTemplate` with a reference to a shared origin template
+                                           document, instead of embedding a full copy of the origin in every entry.
+                                           History entries written in either mode can always be read back.
+        :type reference_origin_templates: bool
         """
         self._client = client
+        self._executor = get_operation_executor(client)
         self._database_path = database_path
+        self._reference_origin_templates = reference_origin_templates
+        self._origin_templates_cache = dict()  # of template id -> HistoryEntryOriginTemplate
+        # Guards the cache, which is shared by every thread writing through this instance e.g. the flush threads of
+        # a WriteBehindMessageWriter.
+        self._origin_templates_lock = threading.Lock()
 
         # Make sure the database we're connecting to exists so it shows when listing available databases
-        self._database_ref().set({"database_path": database_path}, merge=True)
+        database = {"database_path": database_path}
+        write_bytes = estimate_document_size(database_path, database) if get_firestore_metrics().measure_bytes else 0
+        self._executor.execute(lambda timeout: self._database_ref().set(database, merge=True, timeout=timeout), WRITE,
+                               description="EngagementDatabase.__init__", collection=self._database_ref().parent.id,
+                               size_bytes=write_bytes)
 
     @classmethod
-    def init_from_credentials(cls, cert, database_path, app_name="EngagementDatabase"):
+    def init_from_credentials(cls, cert, database_path, app_name="EngagementDatabase",
+                              reference_origin_templates=False):
         """
         :param cert: Firestore service account certificate, as a path to a file or a dictionary.
         :type cert: str | dict
@@ -29,10 +66,12 @@ class EngagementDatabase(object):
         :type database_path: str
         :param app_name: Name to give the Firestore app instance we'll use to connect.
         :type app_name: str
+        :param reference_origin_templates: See `EngagementDatabase.__init__`.
+        :type reference_origin_templates: bool
         :return: EngagementDatabase instance
         :rtype: EngagementDatabase
         """
-        return cls(make_firestore_client(cert, app_name), database_path)
+        return cls(make_firestore_client(cert, app_name), database_path, reference_origin_templates)
 
     def _database_ref(self):
         return self._client.document(self._database_path)
@@ -43,13 +82,47 @@ class EngagementDatabase(object):
     def _history_entry_ref(self, history_entry_id):
         return self._history_ref().document(history_entry_id)
 
+    def _origin_templates_ref(self):
+        return self._database_ref().collection("origin_templates")
+
+    def _origin_template_ref(self, template_id):
+        return self._origin_templates_ref().document(template_id)
+
+    def _cold_storage_manifests_ref(self):
+        return self._database_ref().collection("cold_storage_manifests")
+
     def _messages_ref(self):
         return self._database_ref().collection("messages")
 
     def _message_ref(self, message_id):
         return self._messages_ref().document(message_id)
 
-    def get_history_for_message(self, message_id, filter=lambda q: q, transaction=None):
+    def _run_query(self, query, transaction, method, collection):
+        """
+        Runs a query through this database's operation executor, so that it is rate limited, recorded to the
+        Firestore metrics, and, if it isn't part of a transaction, retried on transient errors.
+
+        :param query: Query to run.
+        :type query: google.cloud.firestore.Query
+        :param transaction: Transaction to run this query in or None.
+        :type transaction: google.cloud.firestore.Transaction | None
+        :param method: Name of the method running the query, for logging and metrics.
+        :type method: str
+        :param collection: Id of the collection being queried, for metrics.
+        :type collection: str
+        :return: Documents returned by the query, as a list. `Query.get` returns a generator in some versions of
+                 google-cloud-firestore, so callers must use this rather than `Query.get` when they need `len()` or
+                 more than one pass over the results, as the tiering methods do.
+        :rtype: list of google.cloud.firestore.DocumentSnapshot
+        """
+        if transaction is None:
+            return self._executor.execute_query(query.get, description=method, collection=collection)
+
+        # Reads in a transaction are retried by re-running the whole transaction, so aren't retried here.
+        return self._executor.execute_query(lambda timeout: query.get(transaction=transaction, timeout=timeout),
+                                            max_retries=0, description=method, collection=collection)
+
+    def get_history_for_message(self, message_id, filter=lambda q: q, transaction=None, cold_storage=None):
         """
         Gets all the history entries for a message, sorted by history timestamp.
 
@@ -59,16 +132,103 @@ class EngagementDatabase(object):
         :type filter: Callable of google.cloud.firestore.Query -> google.cloud.firestore.Query
         :param transaction: Transaction to run this get in or None.
         :type transaction: google.cloud.firestore.Transaction | None
+        :param cold_storage: Cold storage to also fetch this message's tiered history entries from, or None to only
+                             return the history entries that are still in Firestore. Note that `filter` is not
+                             applied to the tiered entries.
+        :type cold_storage: engagement_database.cold_storage.ColdStorage | None
         :return: History entries for the requested message.
         :rtype: list of engagement_database.data_models.HistoryEntry
         """
         message_ref = self._message_ref(message_id)
         query = self._history_ref().where("update_path", "==", message_ref).order_by("timestamp")
         query = filter(query)
-        data = query.get(transaction=transaction)
-        return [HistoryEntry.from_dict(d.to_dict(), doc_type=Message) for d in data]
+        data = [d.to_dict() for d in self._run_query(query, transaction, "EngagementDatabase.get_history_for_message",
+                                                     "history")]
+
+        if cold_storage is not None:
+            data.extend(self._get_tiered_history(message_ref, cold_storage, transaction))
+            data.sort(key=lambda d: d["timestamp"])
+
+        origin_templates = self._get_origin_templates(
+            {d["origin"]["template_id"] for d in data if HistoryEntryOrigin.is_template_reference_dict(d["origin"])}
+        )
+        return [HistoryEntry.from_dict(d, doc_type=Message, origin_templates=origin_templates) for d in data]
+
+    def _get_tiered_history(self, message_ref, cold_storage, transaction=None):
+        manifests = self._run_query(
+            self._cold_storage_manifests_ref().where("update_paths", "array_contains", message_ref),
+            transaction, "EngagementDatabase.get_history_for_message", "cold_storage_manifests"
+        )
+
+        tiered_history = []
+        for manifest in manifests:
+            for d in cold_storage.read_records(manifest.get("blob_url")):
+                # Cold storage returns document references as paths, so convert back to match Firestore.
+                if d["update_path"] == message_ref.path:
+                    d = d.copy()
+                    d["update_path"] = message_ref
+                    tiered_history.append(d)
+        return tiered_history
+
+    def _get_origin_templates(self, template_ids):
+        """
+        Gets origin templates by id, from the local cache where possible, otherwise from the database.
+
+        :param template_ids: Ids of the origin templates to get.
+        :type template_ids: iterable of str
+        :return: Dictionary of template id -> origin template.
+        :rtype: dict of str -> engagement_database.data_models.HistoryEntryOriginTemplate
+        """
+        template_ids = set(template_ids)
+        with self._origin_templates_lock:
+            uncached_ids = [template_id for template_id in template_ids
+                            if template_id not in self._origin_templates_cache]
+        if len(uncached_ids) > 0:
+            template_refs = [self._origin_template_ref(template_id) for template_id in uncached_ids]
+            docs = self._executor.execute(lambda timeout: list(self._client.get_all(template_refs, timeout=timeout)),
+                                          READ, len(template_refs),
+                                          description="EngagementDatabase.get_history_for_message",
+                                          collection="origin_templates")
+            with self._origin_templates_lock:
+                for doc in docs:
+                    assert doc.exists, f"Origin template {doc.id} not found in the database"
+                    self._origin_templates_cache[doc.id] = HistoryEntryOriginTemplate.from_dict(doc.to_dict())
+
+        with self._origin_templates_lock:
+            return {template_id: self._origin_templates_cache[template_id] for template_id in template_ids}
+
+    def _ensure_origin_template_written(self, origin):
+        """
+        Makes sure the origin template that `origin` was made from exists in the database.
+
+        Templates are written at most once per EngagementDatabase instance, even when several threads write history
+        entries with the same template concurrently. The write is outside of any transaction, because the template's
+        id is derived from its contents so writing it is idempotent, and it must exist before any history entries that
+        reference it can be read.
+
+        :param origin: Origin made from a HistoryEntryOriginTemplate.
+        :type origin: engagement_database.data_models.HistoryEntryOrigin
+        """
+        # Checking and writing under the lock means concurrent writers of a new template wait for the first one to
+        # write it, rather than all uploading it.
+        with self._origin_templates_lock:
+            if origin.template_id in self._origin_templates_cache:
+                return
 
-    def get_message(self, message_id, transaction=None):
+            template = HistoryEntryOriginTemplate.from_origin(origin)
+            assert template.template_id == origin.template_id, \
+                f"Origin has template id {origin.template_id} but its fields match template id {template.template_id}"
+            template_ref = self._origin_template_ref(template.template_id)
+            template_dict = template.to_dict()
+            write_bytes = 0
+            if get_firestore_metrics().measure_bytes:
+                write_bytes = estimate_document_size(template_ref.path, template_dict)
+            self._executor.execute(lambda timeout: template_ref.set(template_dict, timeout=timeout), WRITE,
+                                   description="EngagementDatabase.set_message", collection="origin_templates",
+                                   size_bytes=write_bytes)
+            self._origin_templates_cache[template.template_id] = template
+
+    def get_message(self, message_id, transaction=None, cold_storage=None):
         """
         Gets a message by id from the database.
 
@@ -76,15 +236,25 @@ class EngagementDatabase(object):
         :type message_id: str
         :param transaction: Transaction to run this get in or None.
         :type transaction: google.cloud.firestore.Transaction | None
+        :param cold_storage: Cold storage to fetch the message from if it has been tiered, or None.
+        :type cold_storage: engagement_database.cold_storage.ColdStorage | None
         :return: Message with id `message_id`, if it exists in the database, otherwise None.
+                 If the message has been tiered to cold storage and no `cold_storage` was given, also returns None.
         :rtype: engagement_database.data_models.Message | None
         """
-        doc = self._message_ref(message_id).get(transaction=transaction)
+        message_ref = self._message_ref(message_id)
+        if transaction is None:
+            doc = self._executor.execute(message_ref.get, READ, description="EngagementDatabase.get_message",
+                                         collection="messages")
+        else:
+            doc = self._executor.execute(lambda timeout: message_ref.get(transaction=transaction, timeout=timeout),
+                                         READ, max_retries=0, description="EngagementDatabase.get_message",
+                                         collection="messages")
         if not doc.exists:
             return None
-        return Message.from_dict(doc.to_dict())
+        return self._message_from_dict(doc.to_dict(), cold_storage)
 
-    def get_messages(self, filter=lambda q: q, transaction=None):
+    def get_messages(self, filter=lambda q: q, transaction=None, cold_storage=None):
         """
         Gets messages from the database.
 
@@ -98,13 +268,71 @@ class EngagementDatabase(object):
         :type filter: Callable of google.cloud.firestore.Query -> google.cloud.firestore.Query
         :param transaction: Transaction to run this get in or None.
         :type transaction: google.cloud.firestore.Transaction | None
+        :param cold_storage: Cold storage to fetch matching messages that have been tiered from, or None to skip
+                             tiered messages. Tiered messages are only matched by the fields which are kept in their
+                             tombstones: message_id, status, dataset, participant_uuid and timestamp.
+        :type cold_storage: engagement_database.cold_storage.ColdStorage | None
         :return: Messages downloaded from the database.
         :rtype: list of engagement_database.data_models.Message
         """
         query = self._messages_ref()
         query = filter(query)
-        data = query.get(transaction=transaction)
-        return [Message.from_dict(d.to_dict()) for d in data]
+        data = self._run_query(query, transaction, "EngagementDatabase.get_messages", "messages")
+        messages = [self._message_from_dict(d.to_dict(), cold_storage) for d in data]
+        return [msg for msg in messages if msg is not None]
+
+    def iterate_message_pages(self, filter=lambda q: q, page_size=1000):
+        """
+        Iterates over all the messages matching a query, downloading them in pages.
+
+        Unlike `get_messages`, this is guaranteed to return all the matching messages, while only holding one page of
+        messages in memory at a time. Pages are fetched with document cursors, so pagination is stable even when many
+        messages share the same value for the field being ordered by.
+        Messages that have been tiered to cold storage are skipped.
+
+        :param filter: Filter to apply to the underlying Firestore query. This may include an order_by, but must not
+                       include a limit or cursor.
+        :type filter: Callable of google.cloud.firestore.Query -> google.cloud.firestore.Query
+        :param page_size: Number of messages to download in each page.
+        :type page_size: int
+        :return: Generator of pages of messages.
+        :rtype: generator of list of engagement_database.data_models.Message
+        """
+        query = filter(self._messages_ref()).limit(page_size)
+        last_doc = None
+        while True:
+            page_query = query if last_doc is None else query.start_after(last_doc)
+            docs = self._run_query(page_query, None, "EngagementDatabase.iterate_message_pages", "messages")
+            if len(docs) == 0:
+                return
+
+            messages = [self._message_from_dict(doc.to_dict(), cold_storage=None) for doc in docs]
+            yield [msg for msg in messages if msg is not None]
+
+            if len(docs) < page_size:
+                return
+            last_doc = docs[-1]
+
+    @staticmethod
+    def _message_from_dict(d, cold_storage):
+        """
+        :param d: Serialized message or message tombstone, as read from Firestore.
+        :type d: dict
+        :param cold_storage: Cold storage to fetch the message from if `d` is a tombstone, or None.
+        :type cold_storage: engagement_database.cold_storage.ColdStorage | None
+        :return: Deserialized message, or None if `d` is a tombstone and no `cold_storage` was given.
+        :rtype: engagement_database.data_models.Message | None
+        """
+        if _COLD_STORAGE_BLOB_URL_KEY not in d:
+            return Message.from_dict(d)
+
+        if cold_storage is None:
+            return None
+
+        for record in cold_storage.read_records(d[_COLD_STORAGE_BLOB_URL_KEY]):
+            if record["message_id"] == d["message_id"]:
+                return Message.from_dict(record)
+        raise LookupError(f"Message {d['message_id']} not found in cold storage blob {d[_COLD_STORAGE_BLOB_URL_KEY]}")
 
     def set_message(self, message, origin, transaction=None):
         """
@@ -119,22 +347,39 @@ class EngagementDatabase(object):
                             to be explicitly committed elsewhere.
         :type transaction: google.cloud.firestore.Transaction | None
         """
+        if transaction is not None:
+            self._add_message_writes(message, origin, transaction)
+            return
+
+        # If no transaction was given, run all the updates in a new batched-write transaction and commit it before
+        # returning from this function.
+        transaction = self._client.batch()
+        write_bytes = self._add_message_writes(message, origin, transaction)
+
+        # Retrying is safe because the batch only contains sets of documents with fixed ids.
+        self._executor.execute(transaction.commit, WRITE, 2, description="EngagementDatabase.set_message",
+                               collection="messages", size_bytes=write_bytes)
+
+    def _add_message_writes(self, message, origin, transaction):
+        """
+        Adds the writes that set a message and log its history entry to a transaction or batched write.
+
+        :param message: Message to write to the database.
+        :type message: engagement_database.data_models.Message
+        :param origin: Origin details for this update.
+        :type origin: engagement_database.data_models.HistoryEntryOrigin
+        :param transaction: Transaction or batched write to add the writes to.
+        :type transaction: google.cloud.firestore.Transaction | google.cloud.firestore.WriteBatch
+        :return: Estimated size of the written documents in bytes, or 0 if the Firestore metrics aren't measuring bytes.
+        :rtype: int
+        """
         message = message.copy()
         message.last_updated = firestore.SERVER_TIMESTAMP
 
-        if transaction is None:
-            # If no transaction was given, run all the updates in a new batched-write transaction and flag that
-            # this transaction needs to be committed before returning from this function.
-            transaction = self._client.batch()
-            commit_before_returning = True
-        else:
-            commit_before_returning = False
-
         # Set the message
-        transaction.set(
-            self._message_ref(message.message_id),
-            message.to_dict()
-        )
+        message_ref = self._message_ref(message.message_id)
+        message_dict = message.to_dict()
+        transaction.set(message_ref, message_dict)
 
         # Log a history event for this update
         history_entry = HistoryEntry(
@@ -143,13 +388,294 @@ class EngagementDatabase(object):
             updated_doc=message,
             timestamp=firestore.SERVER_TIMESTAMP
         )
-        transaction.set(
-            self._history_entry_ref(history_entry.history_entry_id),
-            history_entry.to_dict()
-        )
+        reference_origin_template = self._reference_origin_templates and origin.template_id is not None
+        if reference_origin_template:
+            self._ensure_origin_template_written(origin)
+        history_entry_ref = self._history_entry_ref(history_entry.history_entry_id)
+        history_entry_dict = history_entry.to_dict(reference_origin_template=reference_origin_template)
+        transaction.set(history_entry_ref, history_entry_dict)
 
-        if commit_before_returning:
-            transaction.commit()
+        if not get_firestore_metrics().measure_bytes:
+            return 0
+        return estimate_document_size(message_ref.path, message_dict) + \
+            estimate_document_size(history_entry_ref.path, history_entry_dict)
+
+    def set_messages(self, updates):
+        """
+        Sets messages in the database, in a single batched write.
+
+        :param updates: Messages to write, with the origin details for each update. At most
+                        `MAX_MESSAGES_PER_TRANSACTION` messages can be written in one batch.
+        :type updates: list of (engagement_database.data_models.Message,
+                                engagement_database.data_models.HistoryEntryOrigin)
+        """
+        assert len(updates) <= MAX_MESSAGES_PER_TRANSACTION, \
+            f"Can only set up to {MAX_MESSAGES_PER_TRANSACTION} messages in one batch"
+
+        batch = self._client.batch()
+        write_bytes = 0
+        for message, origin in updates:
+            write_bytes += self._add_message_writes(message, origin, batch)
+
+        # Retrying is safe because the batch only contains sets of documents with fixed ids.
+        self._executor.execute(batch.commit, WRITE, 2 * len(updates), description="EngagementDatabase.set_messages",
+                               collection="messages", size_bytes=write_bytes)
 
     def transaction(self):
         return self._client.transaction()
+
+    def batch(self):
+        return self._client.batch()
+
+    def tier_archived_messages(self, cold_storage, batch_size=500):
+        """
+        Moves all archived messages to cold storage, leaving a tombstone in Firestore for each message.
+
+        Tombstones keep the message's message_id, status, dataset, participant_uuid and timestamp, plus the url of the
+        cold storage blob containing the full message. The full message can be read back by passing the same
+        cold storage to `get_message` or `get_messages`.
+
+        A message's tombstone is only written if the message hasn't been modified since it was read for tiering.
+        If any message in a batch was modified, that batch's cold storage blob is deleted and the batch is read and
+        tiered again.
+
+        Archived messages are queried by status in order of last_updated, which requires a composite index on the
+        messages collection, of "status" ascending then "last_updated" ascending. Without it, this fails with
+        FailedPrecondition. Create the index with e.g.
+        `gcloud firestore indexes composite create --collection-group=messages
+        --field-config=field-path=status,order=ascending --field-config=field-path=last_updated,order=ascending`
+
+        :param cold_storage: Cold storage to move the messages to.
+        :type cold_storage: engagement_database.cold_storage.ColdStorage
+        :param batch_size: Maximum number of messages to write to each cold storage blob.
+        :type batch_size: int
+        :return: Number of messages that were tiered.
+        :rtype: int
+        """
+        assert 0 < batch_size <= 500, "batch_size must be between 1 and 500"
+
+        tiered_count = 0
+        while True:
+            # Tombstones don't have a last_updated field, so ordering by last_updated excludes them from the query.
+            docs = self._run_query(self._messages_ref().where("status", "==", MessageStatuses.ARCHIVED)
+                                   .order_by("last_updated").limit(batch_size),
+                                   None, "EngagementDatabase.tier_archived_messages", "messages")
+            if len(docs) == 0:
+                break
+
+            records = [doc.to_dict() for doc in docs]
+            blob_url = cold_storage.write_records("messages", datetime.datetime.now(datetime.timezone.utc), records)
+
+            batch = self._client.batch()
+            for doc, record in zip(docs, records):
+                tombstone = {k: firestore.DELETE_FIELD for k in record.keys()}
+                tombstone.update({
+                    "message_id": record["message_id"],
+                    "status": record["status"],
+                    "dataset": record["dataset"],
+                    "participant_uuid": record["participant_uuid"],
+                    "timestamp": record["timestamp"],
+                    _COLD_STORAGE_BLOB_URL_KEY: blob_url
+                })
+                batch.update(doc.reference, tombstone,
+                             option=self._client.write_option(last_update_time=doc.update_time))
+            # Don't retry, because the update preconditions would fail if a timed-out commit had been applied.
+            try:
+                self._executor.execute(batch.commit, WRITE, len(docs), max_retries=0,
+                                       description="EngagementDatabase.tier_archived_messages",
+                                       collection="messages")
+            except exceptions.FailedPrecondition:
+                # Batches are atomic, so none of the tombstones were written and the blob isn't referenced by any
+                # message. Other errors may have been raised after the commit was applied, so leave their blobs.
+                log.warning(f"A message was modified while its batch was being tiered. Deleting cold storage blob "
+                            f"'{blob_url}' and tiering the batch again...")
+                cold_storage.delete_records(blob_url)
+                continue
+
+            tiered_count += len(records)
+            log.info(f"Tiered {len(records)} archived messages to cold storage, total tiered: {tiered_count}")
+
+        return tiered_count
+
+    def tier_history_entries(self, cold_storage, cutoff, batch_size=499):
+        """
+        Moves history entries older than a cutoff to cold storage.
+
+        Each cold storage blob of history entries is recorded in a manifest document in Firestore, which lists the
+        paths of the documents whose history is in the blob. The tiered entries can be read back by passing the same
+        cold storage to `get_history_for_message`.
+
+        :param cold_storage: Cold storage to move the history entries to.
+        :type cold_storage: engagement_database.cold_storage.ColdStorage
+        :param cutoff: History entries with timestamps before this cutoff will be moved.
+        :type cutoff: datetime.datetime
+        :param batch_size: Maximum number of history entries to write to each cold storage blob.
+        :type batch_size: int
+        :return: Number of history entries that were tiered.
+        :rtype: int
+        """
+        # Each batch deletes up to `batch_size` history entries and writes one manifest, and Firestore batches
+        # are limited to 500 writes.
+        assert 0 < batch_size <= 499, "batch_size must be between 1 and 499"
+
+        tiered_count = 0
+        while True:
+            docs = self._run_query(self._history_ref().where("timestamp", "<", cutoff).order_by("timestamp")
+                                   .limit(batch_size), None, "EngagementDatabase.tier_history_entries", "history")
+            if len(docs) == 0:
+                break
+
+            records = [doc.to_dict() for doc in docs]
+            blob_url = cold_storage.write_records("history", records[0]["timestamp"], records)
+
+            update_paths = {record["update_path"].path: record["update_path"] for record in records}
+
+            batch = self._client.batch()
+            batch.set(self._cold_storage_manifests_ref().document(), {
+                "blob_url": blob_url,
+                "update_paths": list(update_paths.values()),
+                "entry_count": len(records),
+                "min_timestamp": records[0]["timestamp"],
+                "max_timestamp": records[-1]["timestamp"]
+            })
+            for doc in docs:
+                batch.delete(doc.reference)
+            # Retrying is safe because the manifest's id is fixed when the batch is built, and deletes are idempotent.
+            self._executor.execute(batch.commit, WRITE, len(docs) + 1,
+                                   description="EngagementDatabase.tier_history_entries", collection="history")
+
+            tiered_count += len(records)
+            log.info(f"Tiered {len(records)} history entries to cold storage, total tiered: {tiered_count}")
+
+        return tiered_count
+
+    def run_transactional_updates(self, message_ids, update_fn, origin, chunk_size=MAX_MESSAGES_PER_TRANSACTION,
+                                  max_retries=8, initial_backoff_seconds=0.5, max_backoff_seconds=30):
+        """
+        Updates many messages, using one transaction per chunk of messages rather than one transaction per message.
+
+        Each chunk is read in a single `get_all` inside a transaction, passed through `update_fn`, then written back
+        along with a history entry for each updated message. If a transaction is aborted due to contention, the chunk
+        is retried after a jittered exponential backoff, and the chunk size is halved so that later transactions lock
+        fewer documents. Transactions which fail with other transient errors (see
+        `util.firestore_operations.is_retryable_error`) are retried after a backoff without changing the chunk size.
+        Each transaction waits for the rate limits of this database's operation executor before it starts.
+
+        Note that `update_fn` may be called more than once for the same message if its transaction needs to be retried,
+        so it should not have side effects.
+
+        :param message_ids: Ids of the messages to update. Ids of messages that don't exist in the database are skipped.
+        :type message_ids: iterable of str
+        :param update_fn: Function which is given a message and returns the updated message to write, or None if this
+                          message doesn't need to be updated.
+        :type update_fn: Callable of engagement_database.data_models.Message ->
+                         engagement_database.data_models.Message | None
+        :param origin: Origin details for these updates.
+        :type origin: engagement_database.data_models.HistoryEntryOrigin
+        :param chunk_size: Initial number of messages to update in each transaction.
+        :type chunk_size: int
+        :param max_retries: Maximum number of consecutive times to retry a chunk that failed due to contention or a
+                            transient error.
+        :type max_retries: int
+        :param initial_backoff_seconds: Maximum backoff to wait before the first retry.
+        :type initial_backoff_seconds: float
+        :param max_backoff_seconds: Upper limit on the backoff to wait before any retry.
+        :type max_backoff_seconds: float
+        :return: The updated messages that were written to the database.
+        :rtype: list of engagement_database.data_models.Message
+        """
+        assert 0 < chunk_size <= MAX_MESSAGES_PER_TRANSACTION, \
+            f"chunk_size must be between 1 and {MAX_MESSAGES_PER_TRANSACTION}"
+
+        pending_ids = deque(dict.fromkeys(message_ids))  # Preserve order while removing duplicates
+        total_count = len(pending_ids)
+        updated_messages = []
+        retries = 0
+        while len(pending_ids) > 0:
+            chunk = [pending_ids.popleft() for _ in range(min(chunk_size, len(pending_ids)))]
+            self._executor.acquire(READ, len(chunk))
+            self._executor.acquire(WRITE, 2 * len(chunk))
+            start = time.perf_counter()
+            try:
+                chunk_updated_messages = self._update_messages_in_transaction(chunk, update_fn, origin)
+            except Exception as ex:
+                get_firestore_metrics().record("EngagementDatabase.run_transactional_updates", "messages", WRITE,
+                                               latency_seconds=time.perf_counter() - start, error=True)
+                contention = isinstance(ex, (exceptions.Aborted, exceptions.Conflict, _TransactionContentionError))
+                if not contention and not is_retryable_error(ex):
+                    raise ex
+                if retries >= max_retries:
+                    log.error(f"Transaction for a chunk of {len(chunk)} messages failed with {type(ex).__name__} "
+                              f"after {retries} retries")
+                    raise ex
+
+                pending_ids.extendleft(reversed(chunk))
+                if contention:
+                    chunk_size = max(1, chunk_size // 2)
+                backoff = random.uniform(0, min(max_backoff_seconds, initial_backoff_seconds * 2 ** retries))
+                retries += 1
+                log.warning(f"Transaction for a chunk of {len(chunk)} messages failed with {type(ex).__name__}. "
+                            f"Retrying in {backoff:.2f} seconds with a chunk size of {chunk_size}...")
+                time.sleep(backoff)
+                continue
+
+            # The latency of the whole transaction is recorded against the write, because the transaction's writes
+            # are only sent when it commits.
+            get_firestore_metrics().record("EngagementDatabase.run_transactional_updates", "messages", WRITE,
+                                           2 * len(chunk_updated_messages),
+                                           latency_seconds=time.perf_counter() - start)
+            updated_messages.extend(chunk_updated_messages)
+            retries = 0
+            log.debug(f"Committed transaction for {len(chunk)} messages, "
+                      f"progress: {total_count - len(pending_ids)} / {total_count}")
+
+        return updated_messages
+
+    def _update_messages_in_transaction(self, message_ids, update_fn, origin):
+        # Run the transaction with max_attempts=1, so that contention is reported back to
+        # run_transactional_updates, which can then back off and shrink the chunk before retrying.
+        transaction = self._client.transaction(max_attempts=1)
+        body_completed = False
+
+        @firestore.transactional
+        def update_messages(transaction):
+            nonlocal body_completed
+            body_completed = False
+
+            updated = []
+            metrics = get_firestore_metrics()
+            start = time.perf_counter()
+            snapshots = list(transaction.get_all([self._message_ref(message_id) for message_id in message_ids]))
+            documents, read_bytes = measure_read_result(snapshots, metrics.measure_bytes)
+            metrics.record("EngagementDatabase.run_transactional_updates", "messages", READ, documents, read_bytes,
+                           time.perf_counter() - start)
+            for snapshot in snapshots:
+                if not snapshot.exists:
+                    continue
+                d = snapshot.to_dict()
+                if _COLD_STORAGE_BLOB_URL_KEY in d:
+                    # Skip messages that have been tiered to cold storage
+                    continue
+                message = update_fn(Message.from_dict(d))
+                if message is not None:
+                    updated.append(message)
+
+            for message in updated:
+                self.set_message(message, origin, transaction=transaction)
+
+            body_completed = True
+            return updated
+
+        try:
+            return update_messages(transaction)
+        except ValueError as ex:
+            # Depending on the Firestore library version, an aborted commit is reported by `transactional` as a
+            # ValueError saying the maximum number of attempts was exceeded. Errors raised while running the
+            # transaction body (e.g. by `update_fn`) are propagated as-is.
+            if body_completed:
+                raise _TransactionContentionError(str(ex)) from ex
+            raise ex
+
+
+class _TransactionContentionError(Exception):
+    pass
@@ -0,0 +1,352 @@
+import glob
+import os
+import pickle
+import queue
+import threading
+import time
+import uuid
+
+from core_data_modules.logging import Logger
+
+from engagement_database.data_models import Message, HistoryEntryOrigin
+from engagement_database.engagement_database import MAX_MESSAGES_PER_TRANSACTION
+
+log = Logger(__name__)
+
+
+class WriteBehindMessageWriter(object):
+    def __init__(self, database, batch_size=MAX_MESSAGES_PER_TRANSACTION, flush_interval_seconds=5,
+                 max_queue_size=10000, flush_threads=2, journal_path=None, journal_fsync=False,
+                 on_success=None, on_failure=None):
+        """
+        Writes messages to an EngagementDatabase in the background, in batched writes.
+
+        Messages passed to `write` are added to a bounded queue and `write` returns immediately, unless the queue is
+        full, in which case it blocks until there is space (backpressure). Background threads commit the queued
+        messages in batches, once `batch_size` messages are waiting or `flush_interval_seconds` has passed since the
+        oldest waiting message was queued.
+
+        Batches are committed with `EngagementDatabase.set_messages`, so are rate limited and retried by the database's
+        Firestore operation executor. If a batch still fails to commit, its messages are retried individually so that
+        failures are reported per-message, via `on_failure`.
+
+        If a `journal_path` is given, every queued write is appended to a local journal before `write` returns, and is
+        acknowledged in the journal once it has been committed or reported as failed. Writes that were still in the
+        journal when a previous writer crashed are replayed when a writer is next constructed with the same
+        `journal_path`.
+
+        :param database: Database to write messages to.
+        :type database: engagement_database.EngagementDatabase
+        :param batch_size: Maximum number of messages to write in each batch.
+        :type batch_size: int
+        :param flush_interval_seconds: Maximum time a message can wait in the queue before it is flushed, in seconds.
+        :type flush_interval_seconds: float
+        :param max_queue_size: Maximum number of messages that can be waiting to be flushed before `write` blocks.
+        :type max_queue_size: int
+        :param flush_threads: Number of background threads to commit batches from.
+        :type flush_threads: int
+        :param journal_path: Path to a local file to journal unflushed writes to, or None to disable journaling.
+        :type journal_path: str | None
+        :param journal_fsync: Whether to fsync the journal after every write. If False, journaled writes survive this
+                              process crashing but not the machine crashing.
+        :type journal_fsync: bool
+        :param on_success: Function to call with (message, origin) after each message has been committed.
+                           Called from a background thread.
+        :type on_success: Callable of (engagement_database.data_models.Message,
+                                       engagement_database.data_models.HistoryEntryOrigin) -> None | None
+        :param on_failure: Function to call with (message, origin, exception) for each message that failed to be
+                           written. Called from a background thread. If None, failures are logged.
+        :type on_failure: Callable of (engagement_database.data_models.Message,
+                                       engagement_database.data_models.HistoryEntryOrigin, Exception) -> None | None
+        """
+        assert 0 < batch_size <= MAX_MESSAGES_PER_TRANSACTION, \
+            f"batch_size must be between 1 and {MAX_MESSAGES_PER_TRANSACTION}"
+
+        self._database = database
+        self._batch_size = batch_size
+        self._flush_interval_seconds = flush_interval_seconds
+        self._on_success = on_success
+        self._on_failure = on_failure
+
+        self._queue = queue.Queue(maxsize=max_queue_size)  # of (journal sequence number | None, message, origin)
+        self._flush_requested = threading.Event()
+        self._closed = threading.Event()
+
+        self._journal = None
+        if journal_path is not None:
+            self._journal = _WriteJournal(journal_path, journal_fsync)
+
+        self._threads = [
+            threading.Thread(target=self._run_flush_thread, name=f"WriteBehindMessageWriter-{i}", daemon=True)
+            for i in range(flush_threads)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+        if self._journal is not None:
+            self._replay_journal()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, message, origin, timeout=None):
+        """
+        Queues a message to be written to the database.
+
+        :param message: Message to write to the database.
+        :type message: engagement_database.data_models.Message
+        :param origin: Origin details for this update.
+        :type origin: engagement_database.data_models.HistoryEntryOrigin
+        :param timeout: Maximum time to wait for space in the queue, in seconds, or None to wait indefinitely.
+        :type timeout: float | None
+        :raises queue.Full: If there was no space in the queue after waiting for `timeout` seconds.
+        """
+        assert not self._closed.is_set(), "Cannot write to a WriteBehindMessageWriter after it has been closed"
+
+        message = message.copy()
+        seq = None
+        if self._journal is not None:
+            seq = self._journal.append_write(message, origin)
+        try:
+            self._queue.put((seq, message, origin), timeout=timeout)
+        except queue.Full:
+            if seq is not None:
+                self._journal.append_acks([seq])
+            raise
+
+    def flush(self):
+        """
+        Blocks until all the messages queued so far have been committed or reported as failed.
+        """
+        self._flush_requested.set()
+        self._queue.join()
+        self._flush_requested.clear()
+
+    def close(self):
+        """
+        Flushes all queued messages, then stops the background threads.
+        """
+        if self._closed.is_set():
+            return
+        self.flush()
+        self._closed.set()
+        for thread in self._threads:
+            thread.join()
+        if self._journal is not None:
+            self._journal.close()
+
+    def _replay_journal(self):
+        pending = self._journal.take_pending()
+        if len(pending) == 0:
+            return
+
+        log.info(f"Replaying {len(pending)} unflushed writes from the journal...")
+        for message, origin in pending:
+            self.write(message, origin)
+        self._journal.discard_taken()
+
+    def _next_batch(self):
+        """
+        Waits for the next batch of messages to write.
+
+        :return: Batch of queued items, or None if this writer has been closed and there are no more items to write.
+        :rtype: list of (int | None, engagement_database.data_models.Message,
+                         engagement_database.data_models.HistoryEntryOrigin) | None
+        """
+        while True:
+            try:
+                batch = [self._queue.get(timeout=0.1)]
+                break
+            except queue.Empty:
+                if self._closed.is_set():
+                    return None
+
+        deadline = time.monotonic() + self._flush_interval_seconds
+        while len(batch) < self._batch_size:
+            if self._flush_requested.is_set() or self._closed.is_set():
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+                continue
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                # Wait in short intervals so that flush requests are noticed promptly
+                batch.append(self._queue.get(timeout=min(remaining, 0.1)))
+            except queue.Empty:
+                pass
+
+        return batch
+
+    def _run_flush_thread(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            try:
+                self._write_batch(batch)
+            finally:
+                if self._journal is not None:
+                    self._journal.append_acks([seq for seq, _, _ in batch if seq is not None])
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write_batch(self, batch):
+        try:
+            self._database.set_messages([(message, origin) for _, message, origin in batch])
+        except Exception as ex:
+            log.warning(f"Failed to commit a batch of {len(batch)} messages ({type(ex).__name__}: {ex}). "
+                        f"Retrying each message individually...")
+            self._write_individually(batch)
+            return
+
+        log.debug(f"Committed a batch of {len(batch)} messages")
+        for _, message, origin in batch:
+            self._report_success(message, origin)
+
+    def _write_individually(self, batch):
+        for _, message, origin in batch:
+            try:
+                self._database.set_message(message, origin)
+            except Exception as ex:
+                self._report_failure(message, origin, ex)
+                continue
+            self._report_success(message, origin)
+
+    def _report_success(self, message, origin):
+        if self._on_success is None:
+            return
+        try:
+            self._on_success(message, origin)
+        except Exception as ex:
+            log.error(f"on_success callback failed for message {message.message_id}: {type(ex).__name__}: {ex}")
+
+    def _report_failure(self, message, origin, exception):
+        if self._on_failure is None:
+            log.error(f"Failed to write message {message.message_id}: {type(exception).__name__}: {exception}")
+            return
+        try:
+            self._on_failure(message, origin, exception)
+        except Exception as ex:
+            log.error(f"on_failure callback failed for message {message.message_id}: {type(ex).__name__}: {ex}")
+
+
+class _WriteJournal(object):
+    _WRITE = "write"
+    _ACK = "ack"
+
+    def __init__(self, path, fsync):
+        """
+        Append-only local journal of writes that have been queued but not yet flushed.
+
+        The journal is a sequence of pickled records, either ("write", seq, message_dict, origin_dict) when a write is
+        queued or ("ack", [seq]) when writes have been flushed. The journal is truncated whenever every journaled write
+        has been acknowledged, so it stays small while the writer is keeping up.
+
+        :param path: Path to the journal file.
+        :type path: str
+        :param fsync: Whether to fsync the journal after every append.
+        :type fsync: bool
+        """
+        self._path = path
+        self._fsync = fsync
+        self._lock = threading.Lock()
+        self._next_seq = 0
+        self._outstanding = set()
+
+        # If there's an existing journal, move it aside so it can be replayed into a fresh journal. Journals that were
+        # moved aside by a previous replay which was interrupted are kept too.
+        if os.path.exists(path):
+            os.replace(path, f"{path}.replaying-{uuid.uuid4()}")
+
+        self._replaying = len(self._replaying_paths()) > 0
+
+        self._f = open(path, "ab")
+
+    def _replaying_paths(self):
+        return glob.glob(f"{glob.escape(self._path)}.replaying-*")
+
+    def take_pending(self):
+        """
+        :return: The writes in previous journals that were never acknowledged.
+        :rtype: list of (engagement_database.data_models.Message, engagement_database.data_models.HistoryEntryOrigin)
+        """
+        pending = []
+        for replaying_path in sorted(self._replaying_paths(), key=os.path.getmtime):
+            pending.extend(self._read_pending(replaying_path))
+        return pending
+
+    @classmethod
+    def _read_pending(cls, path):
+        pending = dict()  # of seq -> (message, origin)
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, TypeError, AttributeError, IndexError):
+                    # A crash while appending can leave a partially written final record, which is safe to ignore
+                    # because the write that was being journaled never returned.
+                    log.warning(f"Ignoring a corrupt record at the end of journal '{path}'")
+                    break
+
+                if record[0] == cls._WRITE:
+                    _, seq, message_dict, origin_dict = record
+                    pending[seq] = (Message.from_dict(message_dict), HistoryEntryOrigin.from_dict(origin_dict))
+                else:
+                    for seq in record[1]:
+                        pending.pop(seq, None)
+
+        return list(pending.values())
+
+    def discard_taken(self):
+        """
+        Deletes the previous journals, once their pending writes have been re-journaled.
+        """
+        with self._lock:
+            self._sync()
+            for replaying_path in self._replaying_paths():
+                os.remove(replaying_path)
+            self._replaying = False
+
+    def append_write(self, message, origin):
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._outstanding.add(seq)
+            self._append((self._WRITE, seq, message.to_dict(), origin.to_dict()))
+            return seq
+
+    def append_acks(self, seqs):
+        if len(seqs) == 0:
+            return
+
+        with self._lock:
+            self._outstanding.difference_update(seqs)
+            if len(self._outstanding) == 0 and not self._replaying:
+                self._f.seek(0)
+                self._f.truncate()
+                self._sync()
+            else:
+                self._append((self._ACK, list(seqs)))
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+    def _append(self, record):
+        pickle.dump(record, self._f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._sync()
+
+    def _sync(self):
+        self._f.flush()
+        if self._fsync:
+            os.fsync(self._f.fileno())
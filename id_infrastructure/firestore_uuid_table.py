@@ -2,6 +2,8 @@ import uuid
 
 from core_data_modules.logging import Logger
 
+from util.firestore_metrics import estimate_document_size, get_firestore_metrics
+from util.firestore_operations import get_operation_executor, READ, WRITE
 from util.firestore_utils import make_firestore_client
 
 BATCH_SIZE = 500
@@ -19,6 +21,7 @@ class FirestoreUuidInfrastructure(object):
         :type client: firebase_admin.auth.Client
         """
         self._client = client
+        self._executor = get_operation_executor(client)
 
     @classmethod
     def init_from_credentials(cls, cert, app_name="FirestoreUuidInfrastructure"):
@@ -37,7 +40,9 @@ class FirestoreUuidInfrastructure(object):
         :return: The names of all the firestore uuid tables currently in Firestore.
         :rtype: list of str
         """
-        tables = self._client.collection("tables").get()
+        tables = self._executor.execute_query(self._client.collection("tables").get,
+                                              description="FirestoreUuidInfrastructure.list_table_names",
+                                              collection="tables")
         return [table.id for table in tables]
 
     def get_table(self, table_name, uuid_prefix):
@@ -65,6 +70,7 @@ class FirestoreUuidTable(object):
         :type uuid_prefix: str
         """
         self._client = client
+        self._executor = get_operation_executor(client)
         self._table_name = table_name
         self._uuid_prefix = uuid_prefix
         self._mappings_cache = dict()  # of data -> uuid
@@ -99,7 +105,7 @@ class FirestoreUuidTable(object):
         if len(self._mappings_cache) == 0:
             log.info(f"Sourcing uuids for {len(list_of_data_requested)} data items from Firestore...")
             existing_mappings = dict()
-            for mapping in self._client.collection(f"tables/{self._table_name}/mappings").get():
+            for mapping in self._get_all_mapping_docs("FirestoreUuidTable.data_to_uuid_batch"):
                 existing_mappings[mapping.id] = mapping.get(_UUID_KEY_NAME)
         else:
             log.info(f"Sourcing uuids for {len(list_of_data_requested)} data items from cache...")
@@ -116,16 +122,18 @@ class FirestoreUuidTable(object):
             new_mappings[data] = FirestoreUuidTable.generate_new_uuid(self._uuid_prefix)
 
         # Make sure the table doc exists
-        self._client.document(f"tables/{self._table_name}").set({"table_name": self._table_name}, merge=True)
+        self._ensure_table_doc_exists("FirestoreUuidTable.data_to_uuid_batch")
 
         # Batch write the new mappings
         total_count_to_write = len(new_mappings)
         i = 0
         batch_counter = 0
+        batch_bytes = 0
         batch = self._client.batch()
+        measure_bytes = get_firestore_metrics().measure_bytes
         for data in new_mappings.keys():
             # ensure in single read that the data doesn't exist
-            uuid_doc = self._client.document(f"tables/{self._table_name}/mappings/{data}").get()
+            uuid_doc = self._get_mapping_doc(data, "FirestoreUuidTable.data_to_uuid_batch")
             exists = uuid_doc.exists
             if exists:
                 log.warning("Attempted to set mapping for data which was already in the datastore. "
@@ -134,20 +142,23 @@ class FirestoreUuidTable(object):
                 continue
             
             i += 1
-            batch.set(
-                self._client.document(f"tables/{self._table_name}/mappings/{data}"),
-                {
-                    _UUID_KEY_NAME: new_mappings[data]
-                })
+            mapping_ref = self._client.document(f"tables/{self._table_name}/mappings/{data}")
+            mapping = {
+                _UUID_KEY_NAME: new_mappings[data]
+            }
+            batch.set(mapping_ref, mapping)
             batch_counter += 1
+            if measure_bytes:
+                batch_bytes += estimate_document_size(mapping_ref.path, mapping)
             if batch_counter >= BATCH_SIZE:
-                batch.commit()
+                self._commit_batch(batch, batch_counter, batch_bytes)
                 log.info(f"Batch of {batch_counter} mappings committed, progress: {i} / {total_count_to_write}")
                 batch_counter = 0
+                batch_bytes = 0
                 batch = self._client.batch()
         
         if batch_counter > 0:
-            batch.commit()
+            self._commit_batch(batch, batch_counter, batch_bytes)
             log.info(f"Final batch of {batch_counter} mappings committed")
         
         existing_mappings.update(new_mappings)
@@ -159,8 +170,28 @@ class FirestoreUuidTable(object):
         
         return ret
 
+    def _get_mapping_doc(self, data, method):
+        mapping_ref = self._client.document(f"tables/{self._table_name}/mappings/{data}")
+        return self._executor.execute(mapping_ref.get, READ, description=method, collection="mappings")
+
+    def _get_all_mapping_docs(self, method):
+        return self._executor.execute_query(self._client.collection(f"tables/{self._table_name}/mappings").get,
+                                            description=method, collection="mappings")
+
+    def _ensure_table_doc_exists(self, method):
+        table_ref = self._client.document(f"tables/{self._table_name}")
+        table = {"table_name": self._table_name}
+        write_bytes = estimate_document_size(table_ref.path, table) if get_firestore_metrics().measure_bytes else 0
+        self._executor.execute(lambda timeout: table_ref.set(table, merge=True, timeout=timeout), WRITE,
+                               description=method, collection="tables", size_bytes=write_bytes)
+
+    def _commit_batch(self, batch, write_count, write_bytes):
+        # Retrying is safe because the batches only contain sets, which are idempotent
+        self._executor.execute(batch.commit, WRITE, write_count, description="FirestoreUuidTable.data_to_uuid_batch",
+                               collection="mappings", size_bytes=write_bytes)
+
     def has_data(self, data):
-        return self._client.document(f"tables/{self._table_name}/mappings/{data}").get().exists
+        return self._get_mapping_doc(data, "FirestoreUuidTable.has_data").exists
 
     def data_to_uuid(self, data):
         # Check if data mapping exists
@@ -170,7 +201,7 @@ class FirestoreUuidTable(object):
         if data in self._mappings_cache:
             return self._mappings_cache[data]
 
-        uuid_doc_ref = self._client.document(f"tables/{self._table_name}/mappings/{data}").get()
+        uuid_doc_ref = self._get_mapping_doc(data, "FirestoreUuidTable.data_to_uuid")
 
         exists = uuid_doc_ref.exists
 
@@ -179,14 +210,19 @@ class FirestoreUuidTable(object):
             log.info(f"Creating new UUID {new_uuid}")
 
             # Make sure the table doc exists
-            self._client.document(f"tables/{self._table_name}").set({"table_name": self._table_name}, merge=True)
+            self._ensure_table_doc_exists("FirestoreUuidTable.data_to_uuid")
 
             # Write the new data <-> uuid mapping
-            self._client.document(f"tables/{self._table_name}/mappings/{data}").set(
-                {
-                    _UUID_KEY_NAME: new_uuid
-                }
-            )
+            mapping_ref = self._client.document(f"tables/{self._table_name}/mappings/{data}")
+            mapping = {
+                _UUID_KEY_NAME: new_uuid
+            }
+            write_bytes = 0
+            if get_firestore_metrics().measure_bytes:
+                write_bytes = estimate_document_size(mapping_ref.path, mapping)
+            self._executor.execute(lambda timeout: mapping_ref.set(mapping, timeout=timeout), WRITE,
+                                   description="FirestoreUuidTable.data_to_uuid", collection="mappings",
+                                   size_bytes=write_bytes)
         else:
             new_uuid = uuid_doc_ref.get(_UUID_KEY_NAME)
 
@@ -205,7 +241,8 @@ class FirestoreUuidTable(object):
         # Execute the query, and return the first uuid found
         # The API doesn't have a get first method, so this
         # unusual iterator extractor is needed 
-        for result in query_ref.get():
+        for result in self._executor.execute_query(query_ref.get, description="FirestoreUuidTable.uuid_to_data",
+                                                   collection="mappings"):
             return result.id
         raise LookupError() 
 
@@ -220,7 +257,7 @@ class FirestoreUuidTable(object):
         # Return a mapping data for the uuids that were in the collection
         log.info(f"Looking up the data for {len(uuids_to_lookup)} uuids from Firestore...")
         reverse_mappings = dict()
-        for mapping in self._client.collection(f"tables/{self._table_name}/mappings").get():
+        for mapping in self._get_all_mapping_docs("FirestoreUuidTable.uuid_to_data_batch"):
             self._mappings_cache[mapping.id] = mapping.get(_UUID_KEY_NAME)
             reverse_mappings[mapping.get(_UUID_KEY_NAME)] = mapping.id
         
@@ -242,7 +279,7 @@ class FirestoreUuidTable(object):
         :rtype: dict
         """
         self._mappings_cache = {}
-        for mapping in self._client.collection(f"tables/{self._table_name}/mappings").get():
+        for mapping in self._get_all_mapping_docs("FirestoreUuidTable.get_all_mappings"):
             self._mappings_cache[mapping.id] = mapping.get(_UUID_KEY_NAME)
         return self._mappings_cache.copy()
 
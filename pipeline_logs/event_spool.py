@@ -0,0 +1,94 @@
+import json
+import os
+import threading
+
+from core_data_modules.logging import Logger
+
+log = Logger(__name__)
+
+
+class EventSpool(object):
+    def __init__(self, path):
+        """
+        Local append-only file of pipeline log records which haven't been written to Firestore yet.
+
+        Each line of the file is either {"spooled": record}, when a record is added to the spool, or
+        {"replayed": [record ids]}, when spooled records have been written to Firestore. The file is truncated once
+        every spooled record has been replayed.
+
+        Only one process should use a spool file at a time.
+
+        :param path: Path to the spool file. This is created if it doesn't exist.
+        :type path: str
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending_ids = {record["id"] for record in self._read_pending()}
+
+    def _read_pending(self):
+        if not os.path.exists(self.path):
+            return []
+
+        pending = dict()  # of record id -> record, in the order the records were spooled
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A crash while appending can leave a partially written final line. That record was never
+                    # spooled, because append didn't return.
+                    log.warning(f"Ignoring a corrupt line in event spool '{self.path}'")
+                    continue
+
+                if "spooled" in entry:
+                    pending[entry["spooled"]["id"]] = entry["spooled"]
+                else:
+                    for record_id in entry["replayed"]:
+                        pending.pop(record_id, None)
+
+        return list(pending.values())
+
+    def _append(self, entry):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def has_pending(self):
+        """
+        :return: Whether there are any spooled records which haven't been replayed yet.
+        :rtype: bool
+        """
+        return len(self._pending_ids) > 0
+
+    def append(self, record):
+        """
+        Adds a record to the spool.
+
+        :param record: JSON-serializable record to spool. Must contain a unique "id".
+        :type record: dict
+        """
+        with self._lock:
+            self._append({"spooled": record})
+            self._pending_ids.add(record["id"])
+
+    def get_pending(self):
+        """
+        :return: Spooled records which haven't been replayed yet, in the order they were spooled.
+        :rtype: list of dict
+        """
+        with self._lock:
+            return self._read_pending()
+
+    def mark_replayed(self, record_ids):
+        """
+        Marks spooled records as replayed, so they won't be returned by `get_pending` again.
+
+        :param record_ids: Ids of the records which have been replayed.
+        :type record_ids: list of str
+        """
+        with self._lock:
+            self._append({"replayed": list(record_ids)})
+            self._pending_ids.difference_update(record_ids)
+            if len(self._pending_ids) == 0:
+                open(self.path, "w").close()
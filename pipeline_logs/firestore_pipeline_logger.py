@@ -1,14 +1,267 @@
-import firebase_admin
+import atexit
+import datetime
+import queue
+import re
+import threading
+import uuid
+
 from core_data_modules.logging import Logger
-from firebase_admin import credentials, firestore
+
+from pipeline_logs.event_spool import EventSpool
+from util.firestore_metrics import estimate_document_size, get_firestore_metrics
+from util.firestore_operations import get_operation_executor, WRITE
+from util.firestore_utils import get_firestore_client
+from util.lazy_imports import LazyModule
+
+firestore = LazyModule("google.cloud.firestore")
 
 
 log = Logger(__name__)
 
+# Maximum number of writes Firestore allows in a single batch
+_MAX_BATCH_SIZE = 500
+
+_EVENT_TIMESTAMP_FORMATS = [
+    "%Y-%m-%dT%H:%M:%S.%f%z", "%Y-%m-%dT%H:%M:%S%z", "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M:%S.%f%z", "%Y-%m-%d %H:%M:%S%z", "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"
+]
+
+
+def parse_event_timestamp(event_timestamp):
+    """
+    Parses an event timestamp, as passed to `FirestorePipelineLogger.log_event`.
+
+    :param event_timestamp: ISO 8601 timestamp string, or a datetime. Timestamps without a timezone are assumed to be
+                            in UTC.
+    :type event_timestamp: str | datetime.datetime
+    :return: Parsed timestamp, in UTC, or None if the timestamp couldn't be parsed.
+    :rtype: datetime.datetime | None
+    """
+    if isinstance(event_timestamp, datetime.datetime):
+        dt = event_timestamp
+    else:
+        # Normalise the UTC offset to a form that strptime's %z accepts in all Python versions e.g. +03:00 -> +0300
+        normalised = re.sub(r"([+-]\d{2}):(\d{2})$", r"\1\2", event_timestamp.strip().replace("Z", "+0000"))
+        dt = None
+        for timestamp_format in _EVENT_TIMESTAMP_FORMATS:
+            try:
+                dt = datetime.datetime.strptime(normalised, timestamp_format)
+                break
+            except ValueError:
+                continue
+        if dt is None:
+            return None
+
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.astimezone(datetime.timezone.utc)
+
+
+def get_pipeline_runs_collection_ref(client, pipeline_name):
+    """
+    :param client: Firestore client.
+    :type client: google.cloud.firestore.Client
+    :param pipeline_name: Name of pipeline to get the runs collection of.
+    :type pipeline_name: str
+    :return: Reference to the collection containing one document per run of the given pipeline, keyed by run id.
+    :rtype: google.cloud.firestore.CollectionReference
+    """
+    return client.collection(f"metrics/pipelines/pipeline_runs/{pipeline_name}/runs")
+
+
+def _get_event_writes(client, event_record, write_legacy_event_logs, set_last_event_time=True):
+    """
+    :param client: Firestore client.
+    :type client: google.cloud.firestore.Client
+    :param event_record: Event record, as constructed by `FirestorePipelineLogger.log_event`.
+    :type event_record: dict
+    :param write_legacy_event_logs: Whether to include the write to the event's legacy per-event document.
+    :type write_legacy_event_logs: bool
+    :param set_last_event_time: Whether to set the run's last_event_time to the event's time. This must be False if
+                                a later event of the run may already have been written, as when replaying a spool.
+    :type set_last_event_time: bool
+    :return: The writes needed to log the event, as (document reference, data, merge) tuples. These writes are
+             idempotent, so replaying an event that was already written has no further effect. The run's start_time
+             isn't set by these writes, because it must only be moved backwards. See `_get_run_times`.
+    :rtype: list of (google.cloud.firestore.DocumentReference, dict, bool)
+    """
+    pipeline_name = event_record["pipeline_name"]
+    run_id = event_record["run_id"]
+    event_timestamp = event_record["event_timestamp"]
+    event_name = event_record["event_name"]
+
+    writes = []
+    if write_legacy_event_logs:
+        pipeline_log = {"pipeline_name": pipeline_name,
+                        "run_id": run_id,
+                        "timestamp": event_timestamp,
+                        "event": event_name}
+        writes.append((client.document(f"metrics/pipelines/pipeline_logs/{event_timestamp}"), pipeline_log, False))
+
+    # Record the event in this run's document, so that all of a run's events can be read from a single document.
+    event_time = parse_event_timestamp(event_timestamp)
+    if event_time is None:
+        log.warning(f"Could not parse event timestamp '{event_timestamp}', so this event will be excluded from "
+                    f"pipeline run analytics")
+    run_update = {
+        "pipeline_name": pipeline_name,
+        "run_id": run_id,
+        "events": firestore.ArrayUnion([{"event": event_name, "timestamp": event_timestamp, "time": event_time}])
+    }
+    if event_time is not None and set_last_event_time:
+        run_update["last_event_time"] = event_time
+    run_doc_ref = get_pipeline_runs_collection_ref(client, pipeline_name).document(run_id)
+    writes.append((run_doc_ref, run_update, True))
+
+    return writes
+
+
+def replay_spool(client, spool, write_legacy_event_logs=True):
+    """
+    Writes the events in a spool to Firestore in batches, marking each batch as replayed once it has been committed.
+
+    Because the writes for an event are idempotent, an event that is replayed again after a crash between a batch
+    being committed and it being marked as replayed is still only logged once. Spooled events may be older than
+    events that were written while Firestore was reachable again, so a run's last_event_time is only moved forwards,
+    and its start_time only backwards.
+
+    :param client: Firestore client.
+    :type client: google.cloud.firestore.Client
+    :param spool: Spool to replay.
+    :type spool: pipeline_logs.event_spool.EventSpool
+    :param write_legacy_event_logs: Whether to also write each event to its legacy per-event document.
+    :type write_legacy_event_logs: bool
+    :return: Number of events replayed.
+    :rtype: int
+    """
+    pending = spool.get_pending()
+    if len(pending) == 0:
+        return 0
+
+    log.info(f"Replaying {len(pending)} spooled Pipeline Logs events from '{spool.path}'...")
+    replayed_count = 0
+    batch_writes = []
+    batch_records = []
+    for i, record in enumerate(pending):
+        writes = _get_event_writes(client, record, write_legacy_event_logs, set_last_event_time=False)
+        if len(batch_writes) + len(writes) > _MAX_BATCH_SIZE:
+            _commit_writes(client, batch_writes, "replay_spool")
+            _advance_run_times(client, _get_run_times(client, batch_records, include_last_event_times=True),
+                               "replay_spool")
+            spool.mark_replayed([record["id"] for record in batch_records])
+            replayed_count += len(batch_records)
+            batch_writes = []
+            batch_records = []
+        batch_writes.extend(writes)
+        batch_records.append(record)
+
+    _commit_writes(client, batch_writes, "replay_spool")
+    _advance_run_times(client, _get_run_times(client, batch_records, include_last_event_times=True), "replay_spool")
+    spool.mark_replayed([record["id"] for record in batch_records])
+    replayed_count += len(batch_records)
+    log.info(f"Replayed {replayed_count} spooled Pipeline Logs events")
+
+    return replayed_count
+
+
+def _commit_writes(client, writes, method):
+    batch = client.batch()
+    write_bytes = 0
+    measure_bytes = get_firestore_metrics().measure_bytes
+    for doc_ref, data, merge in writes:
+        batch.set(doc_ref, data, merge=merge)
+        if measure_bytes:
+            write_bytes += estimate_document_size(doc_ref.path, data)
+    collections = ",".join(sorted({doc_ref.parent.id for doc_ref, _, _ in writes}))
+
+    # Retrying is safe because events are added to run documents with ArrayUnion, so re-applying a write has no
+    # effect. Only retry a couple of times, so that events are spooled promptly if Firestore is unreachable.
+    get_operation_executor(client).execute(batch.commit, WRITE, len(writes), max_retries=2, description=method,
+                                           collection=collections, size_bytes=write_bytes)
+
+
+def _get_run_times(client, event_records, include_last_event_times):
+    """
+    Gets the times to move the start_time and last_event_time of the events' run documents to.
+
+    A run's start_time is the earliest time of the first event logged by each logger of the run. If the first event's
+    timestamp can't be parsed, the time it was logged at is used instead, so that the run can still be found by
+    `PipelineRunAnalytics.get_runs`.
+
+    :param client: Firestore client.
+    :type client: google.cloud.firestore.Client
+    :param event_records: Event records, as constructed by `FirestorePipelineLogger.log_event`.
+    :type event_records: iterable of dict
+    :param include_last_event_times: Whether to include the latest event time of each run, for events whose
+                                     writes didn't set the run's last_event_time.
+    :type include_last_event_times: bool
+    :return: Dict of run document path -> (run document reference, start time or None, last event time or None).
+    :rtype: dict of str -> (google.cloud.firestore.DocumentReference, datetime.datetime | None,
+                            datetime.datetime | None)
+    """
+    run_times = dict()
+    for record in event_records:
+        event_time = parse_event_timestamp(record["event_timestamp"])
+        start_time = None
+        if record["is_first_event"]:
+            start_time = event_time
+            # Spools written before events recorded when they were logged don't have a "logged_time".
+            if start_time is None and record.get("logged_time") is not None:
+                start_time = parse_event_timestamp(record["logged_time"])
+        last_event_time = event_time if include_last_event_times else None
+        if start_time is None and last_event_time is None:
+            continue
+
+        run_doc_ref = get_pipeline_runs_collection_ref(client, record["pipeline_name"]).document(record["run_id"])
+        _, current_start_time, current_last_event_time = run_times.get(run_doc_ref.path, (run_doc_ref, None, None))
+        if current_start_time is not None and (start_time is None or current_start_time < start_time):
+            start_time = current_start_time
+        if current_last_event_time is not None and (last_event_time is None or
+                                                    current_last_event_time > last_event_time):
+            last_event_time = current_last_event_time
+        run_times[run_doc_ref.path] = (run_doc_ref, start_time, last_event_time)
+    return run_times
+
+
+def _advance_run_times(client, run_times, method):
+    """
+    Moves the start_time of run documents backwards, and their last_event_time forwards, in a transaction, so that
+    a run's start_time is never replaced by a later time nor its last_event_time by an earlier one.
+
+    :param client: Firestore client.
+    :type client: google.cloud.firestore.Client
+    :param run_times: Times to move each run document to, as returned by `_get_run_times`.
+    :type run_times: dict of str -> (google.cloud.firestore.DocumentReference, datetime.datetime | None,
+                     datetime.datetime | None)
+    :param method: Name of the method to record the writes under in the Firestore metrics.
+    :type method: str
+    """
+    if len(run_times) == 0:
+        return
+
+    @firestore.transactional
+    def advance(transaction, timeout):
+        for snapshot in transaction.get_all([doc_ref for doc_ref, _, _ in run_times.values()], timeout=timeout):
+            _, start_time, last_event_time = run_times[snapshot.reference.path]
+            run = snapshot.to_dict() or dict()
+            update = dict()
+            if start_time is not None and (run.get("start_time") is None or run["start_time"] > start_time):
+                update["start_time"] = start_time
+            if last_event_time is not None and (run.get("last_event_time") is None or
+                                                run["last_event_time"] < last_event_time):
+                update["last_event_time"] = last_event_time
+            if len(update) > 0:
+                transaction.set(snapshot.reference, update, merge=True)
+
+    # Retrying is safe because the transaction re-reads the run documents each time.
+    get_operation_executor(client).execute(lambda timeout: advance(client.transaction(), timeout), WRITE,
+                                           len(run_times), max_retries=2, description=method, collection="runs")
+
 
 class FirestorePipelineLogger(object):
 
-    def __init__(self,  pipeline_name, run_id, cert):
+    def __init__(self,  pipeline_name, run_id, cert, asynchronous=False, write_legacy_event_logs=True,
+                 spool_path=None, offline=False, replay_interval_seconds=60):
         """
         :param pipeline_name: Name of pipeline to update the pipeline logs of.
         :type pipeline_name: str
@@ -16,33 +269,219 @@ class FirestorePipelineLogger(object):
         :type run_id: str
         :param cert: Path to a certificate file or a dict representing the contents of a certificate.
         :type cert: str or dict
-
+        :param asynchronous: Whether to write events in the background. If True, `log_event` only adds the event to an
+                             in-process queue, and a background thread writes queued events to Firestore in batches.
+                             Call `flush` to wait for the queued events to be written, and `close` when finished
+                             logging. Any events still queued when the process exits are flushed by an at-exit hook.
+        :type asynchronous: bool
+        :param write_legacy_event_logs: Whether to also write each event to its own document keyed by event timestamp,
+                                        in the layout used before per-run documents were introduced.
+        :type write_legacy_event_logs: bool
+        :param spool_path: Path to a local file to spool events to when they can't be written to Firestore, or None.
+                           If None, failing to write an event raises an exception (or, if asynchronous, is logged).
+                           Spooled events are replayed by `replay_spool`, and if asynchronous, are also replayed in
+                           the background once Firestore is reachable again.
+        :type spool_path: str | None
+        :param offline: Whether to spool all events without attempting to write them to Firestore.
+                        Requires a `spool_path`.
+        :type offline: bool
+        :param replay_interval_seconds: If asynchronous, how often to try to replay spooled events while idle.
+        :type replay_interval_seconds: float
         """
+        assert not offline or spool_path is not None, "A spool_path is required when offline"
+
         self.pipeline_name = pipeline_name
         self.run_id = run_id
-        cred = credentials.Certificate(cert)
-        firebase_admin.initialize_app(cred)
-        self.client = firestore.client()
+        self.client = get_firestore_client(cert)
+        self._write_legacy_event_logs = write_legacy_event_logs
+        # Whether this logger has logged an event. The first event logged by each logger of a run is used to set the
+        # run's start_time, so that a restarted run keeps its original start_time.
+        self._first_event_logged = False
+
+        self._spool = None if spool_path is None else EventSpool(spool_path)
+        self._offline = offline
+        self._replay_interval_seconds = replay_interval_seconds
+        self._replay_lock = threading.Lock()
+
+        self._queue = None
+        self._flush_thread = None
+        self._closed = False
+        if asynchronous:
+            # Queue of (writes, event record | None), or None to stop the flush thread
+            self._queue = queue.Queue()
+            self._flush_thread = threading.Thread(target=self._run_flush_thread, name="FirestorePipelineLogger",
+                                                  daemon=True)
+            self._flush_thread.start()
+            atexit.register(self.close)
 
-    def _get_pipeline_log_doc_ref(self, event_timestamp):
-        return self.client.document(f"metrics/pipelines/pipeline_logs/{event_timestamp}")
+    def _get_pipeline_profile_doc_ref(self):
+        return self.client.document(f"metrics/pipelines/pipeline_profiles/{self.pipeline_name}-{self.run_id}")
 
 
     def log_event(self, event_timestamp, event_name):
         """
         Updates the pipeline logs for the given pipeline run.
 
-        :param timestamp_string: timestamp string to update the pipeline logs of.
-        :type timestamp_string: str
-         :param event_name: name of current run stage to update to firestore.
-        :type event: datetime str
-
+        :param event_timestamp: ISO 8601 timestamp string of the event, or a datetime. Datetimes are logged as ISO 8601
+                                strings.
+        :type event_timestamp: str | datetime.datetime
+        :param event_name: name of current run stage to update to firestore.
+        :type event_name: str
         """
+        if isinstance(event_timestamp, datetime.datetime):
+            # Convert to a string so the event can be spooled as JSON, and is logged the same way if it's replayed.
+            event_timestamp = event_timestamp.isoformat()
 
-        pipeline_log = {"pipeline_name": self.pipeline_name,
-                        "run_id": self.run_id,
-                        "timestamp": event_timestamp,
-                        "event": event_name}
+        event_record = {
+            "id": str(uuid.uuid4()),
+            "pipeline_name": self.pipeline_name,
+            "run_id": self.run_id,
+            "event_timestamp": event_timestamp,
+            "event_name": event_name,
+            "is_first_event": not self._first_event_logged,
+            "logged_time": datetime.datetime.now(datetime.timezone.utc).isoformat()
+        }
+        self._first_event_logged = True
+
+        if self._offline:
+            log.info(f"Spooling Pipeline Logs event {event_name} at time {event_timestamp} (offline)")
+            self._spool.append(event_record)
+            return
 
         log.info(f"Updating Pipeline Logs for project {event_name} at time {event_timestamp}...")
-        self._get_pipeline_log_doc_ref(event_timestamp).set(pipeline_log)
+        self._submit(_get_event_writes(self.client, event_record, self._write_legacy_event_logs), event_record)
+
+    def log_profile(self, profile):
+        """
+        Writes a profile of this pipeline run, replacing any profile previously written for this run.
+
+        :param profile: Serialized profile, as returned by `pipeline_logs.stage_profiler.StageProfiler.to_dict`.
+        :type profile: dict
+        """
+        log.info(f"Updating Pipeline Profile for run {self.run_id}...")
+        self._submit([(self._get_pipeline_profile_doc_ref(), profile, False)])
+
+    def replay_spool(self):
+        """
+        Writes any spooled events to Firestore. Has no effect if this logger doesn't have a spool.
+
+        :return: Number of events replayed.
+        :rtype: int
+        """
+        if self._spool is None:
+            return 0
+        with self._replay_lock:
+            return replay_spool(self.client, self._spool, self._write_legacy_event_logs)
+
+    def _submit(self, writes, event_record=None):
+        """
+        :param writes: Writes to make, as (document reference, data, merge) tuples.
+        :type writes: list of (google.cloud.firestore.DocumentReference, dict, bool)
+        :param event_record: Event record to spool if the writes fail, or None if the writes shouldn't be spooled.
+        :type event_record: dict | None
+        """
+        if self._queue is not None:
+            assert not self._closed, "Cannot log to a FirestorePipelineLogger after it has been closed"
+            self._queue.put((writes, event_record))
+            return
+
+        try:
+            _commit_writes(self.client, writes, "FirestorePipelineLogger._submit")
+            if event_record is not None:
+                _advance_run_times(self.client, _get_run_times(self.client, [event_record], False),
+                                   "FirestorePipelineLogger._submit")
+        except Exception as ex:
+            if self._spool is None or event_record is None:
+                raise ex
+            log.warning(f"Failed to write Pipeline Logs event ({type(ex).__name__}: {ex}). "
+                        f"Spooling to '{self._spool.path}'")
+            self._spool.append(event_record)
+            return
+
+        self._try_replay_spool()
+
+    def _try_replay_spool(self):
+        if self._spool is None or self._offline or not self._spool.has_pending():
+            return
+        try:
+            self.replay_spool()
+        except Exception as ex:
+            log.warning(f"Failed to replay spooled Pipeline Logs events ({type(ex).__name__}: {ex}). "
+                        f"Will retry later")
+
+    def flush(self):
+        """
+        Blocks until all the events logged so far have been written. Has no effect if this logger isn't asynchronous.
+        """
+        if self._queue is not None:
+            self._queue.join()
+
+    def close(self):
+        """
+        Flushes all logged events, then stops the background flush thread. Has no effect if this logger isn't
+        asynchronous or has already been closed.
+        """
+        if self._queue is None or self._closed:
+            return
+
+        self._closed = True
+        self.flush()
+        self._queue.put(None)
+        self._flush_thread.join()
+        atexit.unregister(self.close)
+
+    def _run_flush_thread(self):
+        while True:
+            # Wait for an event, then write it along with any other events that were queued in the meantime.
+            # While idle, periodically try to replay any spooled events.
+            try:
+                first_item = self._queue.get(timeout=None if self._spool is None else self._replay_interval_seconds)
+            except queue.Empty:
+                self._try_replay_spool()
+                continue
+
+            batch = [first_item]
+            write_count = 0 if first_item is None else len(first_item[0])
+            while batch[-1] is not None:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+                if item is not None:
+                    write_count += len(item[0])
+                    if write_count >= _MAX_BATCH_SIZE - 2:
+                        break
+
+            stopping = batch[-1] is None
+            items = [item for item in batch if item is not None]
+            try:
+                if len(items) > 0:
+                    self._write_items(items)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+            if stopping:
+                return
+
+    def _write_items(self, items):
+        writes = [write for item_writes, _ in items for write in item_writes]
+        event_records = [event_record for _, event_record in items if event_record is not None]
+        log.debug(f"Writing {len(writes)} queued Pipeline Logs updates...")
+        try:
+            _commit_writes(self.client, writes, "FirestorePipelineLogger._write_items")
+            _advance_run_times(self.client, _get_run_times(self.client, event_records, False),
+                               "FirestorePipelineLogger._write_items")
+        except Exception as ex:
+            # Don't let a failed write kill the flush thread, because that would stop all future events being written.
+            if self._spool is None:
+                log.error(f"Failed to write {len(writes)} Pipeline Logs updates: {type(ex).__name__}: {ex}")
+                return
+            log.warning(f"Failed to write {len(writes)} Pipeline Logs updates ({type(ex).__name__}: {ex}). "
+                        f"Spooling {len(event_records)} events to '{self._spool.path}'")
+            for event_record in event_records:
+                self._spool.append(event_record)
+            return
+
+        self._try_replay_spool()
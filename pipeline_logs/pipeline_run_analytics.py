@@ -0,0 +1,130 @@
+import math
+
+from core_data_modules.logging import Logger
+
+from pipeline_logs.firestore_pipeline_logger import get_pipeline_runs_collection_ref
+from util.firestore_operations import get_operation_executor
+from util.firestore_utils import make_firestore_client
+
+log = Logger(__name__)
+
+
+def _percentile(sorted_values, percentile):
+    """
+    Computes a percentile of some sorted values, interpolating linearly between the closest ranks.
+    """
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    rank = percentile / 100 * (len(sorted_values) - 1)
+    lower = math.floor(rank)
+    upper = math.ceil(rank)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+class PipelineRunAnalytics(object):
+    def __init__(self, client):
+        """
+        Queries the per-run pipeline logs written by `FirestorePipelineLogger`.
+
+        :param client: Firebase client.
+        :type client: firebase_admin.auth.Client
+        """
+        self._client = client
+
+    @classmethod
+    def init_from_credentials(cls, cert, app_name="PipelineRunAnalytics"):
+        """
+        :param cert: Firestore service account certificate, as a path to a file or a dictionary.
+        :type cert: str | dict
+        :param app_name: Name to give the Firestore app instance we'll use to connect.
+        :type app_name: str
+        :return: PipelineRunAnalytics instance
+        :rtype: PipelineRunAnalytics
+        """
+        return cls(make_firestore_client(cert, app_name))
+
+    def get_runs(self, pipeline_name, start_time, end_time):
+        """
+        Gets the runs of a pipeline which started in a time window.
+
+        :param pipeline_name: Name of the pipeline to get the runs of.
+        :type pipeline_name: str
+        :param start_time: Start of the time window, inclusive.
+        :type start_time: datetime.datetime
+        :param end_time: End of the time window, exclusive.
+        :type end_time: datetime.datetime
+        :return: Run documents, each containing the "pipeline_name", "run_id", "start_time", "last_event_time", and
+                 a list of "events", sorted by event time. Each event is a dict containing the "event" name, its
+                 original "timestamp" string, and its parsed "time".
+        :rtype: list of dict
+        """
+        log.info(f"Downloading runs of pipeline '{pipeline_name}' which started between {start_time.isoformat()} and "
+                 f"{end_time.isoformat()}...")
+        query = get_pipeline_runs_collection_ref(self._client, pipeline_name) \
+            .where("start_time", ">=", start_time).where("start_time", "<", end_time)
+
+        docs = get_operation_executor(self._client).execute_query(
+            query.get, description="PipelineRunAnalytics.get_runs", collection="runs")
+
+        runs = []
+        for doc in docs:
+            run = doc.to_dict()
+            run["events"] = sorted([e for e in run["events"] if e["time"] is not None], key=lambda e: e["time"])
+            runs.append(run)
+        log.info(f"Downloaded {len(runs)} runs")
+
+        return runs
+
+    def get_run_durations(self, pipeline_name, start_time, end_time):
+        """
+        Gets the duration of each run of a pipeline which started in a time window, measured from the run's first
+        event to its last event.
+
+        :param pipeline_name: Name of the pipeline to get the run durations of.
+        :type pipeline_name: str
+        :param start_time: Start of the time window, inclusive.
+        :type start_time: datetime.datetime
+        :param end_time: End of the time window, exclusive.
+        :type end_time: datetime.datetime
+        :return: Dictionary of run id -> run duration in seconds.
+        :rtype: dict of str -> float
+        """
+        durations = dict()
+        for run in self.get_runs(pipeline_name, start_time, end_time):
+            if len(run["events"]) == 0:
+                continue
+            durations[run["run_id"]] = (run["events"][-1]["time"] - run["events"][0]["time"]).total_seconds()
+        return durations
+
+    def get_stage_latency_percentiles(self, pipeline_name, start_time, end_time, percentiles=(50, 90, 95, 99)):
+        """
+        Gets percentiles of the latency of each stage of a pipeline, over the runs which started in a time window.
+
+        Each event logged by a run is treated as the start of a stage with the same name as the event, which lasts
+        until the run's next event. The last event of each run therefore has no latency.
+
+        :param pipeline_name: Name of the pipeline to get the stage latencies of.
+        :type pipeline_name: str
+        :param start_time: Start of the time window, inclusive.
+        :type start_time: datetime.datetime
+        :param end_time: End of the time window, exclusive.
+        :type end_time: datetime.datetime
+        :param percentiles: Percentiles to compute, each between 0 and 100.
+        :type percentiles: iterable of float
+        :return: Dictionary of stage name -> {"count": number of runs of this stage, "p<percentile>": latency at that
+                 percentile in seconds, for each requested percentile}
+        :rtype: dict of str -> (dict of str -> float)
+        """
+        latencies = dict()  # of stage name -> list of latency seconds
+        for run in self.get_runs(pipeline_name, start_time, end_time):
+            for event, next_event in zip(run["events"], run["events"][1:]):
+                latencies.setdefault(event["event"], []).append((next_event["time"] - event["time"]).total_seconds())
+
+        stage_percentiles = dict()
+        for stage, stage_latencies in latencies.items():
+            stage_latencies.sort()
+            stage_percentiles[stage] = {"count": len(stage_latencies)}
+            for percentile in percentiles:
+                stage_percentiles[stage][f"p{percentile:g}"] = _percentile(stage_latencies, percentile)
+
+        return stage_percentiles
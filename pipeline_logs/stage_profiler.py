@@ -0,0 +1,260 @@
+import datetime
+import functools
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from core_data_modules.logging import Logger
+
+try:
+    import resource
+except ImportError:
+    # The resource module is only available on Unix, so peak RSS isn't recorded on other platforms.
+    resource = None
+
+log = Logger(__name__)
+
+
+def _get_peak_rss_bytes():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS, but in KiB on Linux
+    return peak_rss if sys.platform == "darwin" else peak_rss * 1024
+
+
+class StageProfile(object):
+    def __init__(self, name):
+        """
+        Profile of a pipeline stage, aggregated over every time the stage ran under the same parent stage.
+        Construct with `StageProfiler.stage` rather than directly.
+
+        :param name: Name of the stage.
+        :type name: str
+        """
+        self.name = name
+        self.start_time = datetime.datetime.now(datetime.timezone.utc)
+        self.calls = 0
+        self.wall_seconds = 0
+        self.cpu_seconds = 0
+        self.peak_rss_bytes = None
+        self.counters = dict()  # of counter name -> count
+        self.sub_stages = OrderedDict()  # of stage name -> StageProfile
+
+        self._lock = threading.Lock()
+
+    def increment_counter(self, name, amount=1):
+        """
+        Increments a custom counter for this stage e.g. the number of rows processed.
+
+        :param name: Name of the counter to increment.
+        :type name: str
+        :param amount: Amount to increment the counter by.
+        :type amount: int | float
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def _get_sub_stage(self, name):
+        with self._lock:
+            if name not in self.sub_stages:
+                self.sub_stages[name] = StageProfile(name)
+            return self.sub_stages[name]
+
+    def _record_call(self, wall_seconds, cpu_seconds, peak_rss_bytes):
+        with self._lock:
+            self.calls += 1
+            self.wall_seconds += wall_seconds
+            self.cpu_seconds += cpu_seconds
+            if peak_rss_bytes is not None:
+                self.peak_rss_bytes = max(peak_rss_bytes, self.peak_rss_bytes or 0)
+
+    def to_dict(self):
+        with self._lock:
+            sub_stages = list(self.sub_stages.values())
+            return {
+                "name": self.name,
+                "start_time": self.start_time,
+                "calls": self.calls,
+                "wall_seconds": self.wall_seconds,
+                "cpu_seconds": self.cpu_seconds,
+                "peak_rss_bytes": self.peak_rss_bytes,
+                "counters": dict(self.counters),
+                "sub_stages": [sub_stage.to_dict() for sub_stage in sub_stages]
+            }
+
+
+class StageProfiler(object):
+    def __init__(self, pipeline_name, run_id):
+        """
+        Records the wall time, CPU time, peak RSS, and custom counters of each stage of a pipeline run.
+
+        Stages are recorded with the `stage` context manager or the `profile_stage` decorator. Stages that are started
+        while another stage is running on the same thread are recorded as sub-stages of that stage. Stages with the
+        same name and parent stage are aggregated into a single stage profile, so that profiling a function which is
+        called many times doesn't make the profile grow with each call.
+
+        Note that CPU time is measured for the whole process, and peak RSS is the peak for the whole process up to the
+        end of the stage, so these include work done by other threads.
+
+        :param pipeline_name: Name of the pipeline being profiled.
+        :type pipeline_name: str
+        :param run_id: Identifier of the pipeline run being profiled.
+        :type run_id: str
+        """
+        self.pipeline_name = pipeline_name
+        self.run_id = run_id
+        self._stages = OrderedDict()  # of stage name -> StageProfile
+        self._lock = threading.Lock()
+        self._thread_local = threading.local()
+
+    def _active_stages(self):
+        if not hasattr(self._thread_local, "active_stages"):
+            self._thread_local.active_stages = []
+        return self._thread_local.active_stages
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager which profiles the code it wraps as a stage.
+
+        Yields the StageProfile being recorded, which can be used to increment custom counters, e.g.
+
+        >>> with profiler.stage("fetch_messages") as stage:
+        >>>     stage.increment_counter("firestore_reads", len(messages))
+
+        :param name: Name of the stage.
+        :type name: str
+        """
+        active_stages = self._active_stages()
+        if len(active_stages) > 0:
+            stage_profile = active_stages[-1]._get_sub_stage(name)
+        else:
+            with self._lock:
+                if name not in self._stages:
+                    self._stages[name] = StageProfile(name)
+                stage_profile = self._stages[name]
+
+        active_stages.append(stage_profile)
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield stage_profile
+        finally:
+            wall_seconds = time.perf_counter() - start_wall
+            cpu_seconds = time.process_time() - start_cpu
+            stage_profile._record_call(wall_seconds, cpu_seconds, _get_peak_rss_bytes())
+            active_stages.pop()
+            log.debug(f"Stage '{name}' took {wall_seconds:.3f}s wall time, {cpu_seconds:.3f}s CPU time")
+
+    def profile_stage(self, name=None):
+        """
+        Decorator which profiles every call to the decorated function as a stage.
+
+        :param name: Name of the stage. If None, uses the name of the decorated function.
+        :type name: str | None
+        """
+        def decorator(f):
+            stage_name = f.__name__ if name is None else name
+
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.stage(stage_name):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def increment_counter(self, name, amount=1):
+        """
+        Increments a custom counter on the innermost stage running on this thread.
+
+        :param name: Name of the counter to increment.
+        :type name: str
+        :param amount: Amount to increment the counter by.
+        :type amount: int | float
+        """
+        active_stages = self._active_stages()
+        assert len(active_stages) > 0, "Cannot increment a counter when no stage is running on this thread"
+        active_stages[-1].increment_counter(name, amount)
+
+    def to_dict(self):
+        with self._lock:
+            stages = list(self._stages.values())
+
+        return {
+            "pipeline_name": self.pipeline_name,
+            "run_id": self.run_id,
+            "stages": [stage.to_dict() for stage in stages]
+        }
+
+    def write_profile(self, pipeline_logger):
+        """
+        Writes the profile of the stages recorded so far to Firestore.
+
+        :param pipeline_logger: Pipeline logger to write the profile with.
+        :type pipeline_logger: pipeline_logs.FirestorePipelineLogger
+        """
+        pipeline_logger.log_profile(self.to_dict())
+
+
+def get_hot_stages(profile, top_n=10):
+    """
+    Gets the stages in a profile which took the most wall time, including sub-stages.
+
+    :param profile: Serialized profile, as returned by `StageProfiler.to_dict`.
+    :type profile: dict
+    :param top_n: Maximum number of stages to return.
+    :type top_n: int
+    :return: The hottest stages, sorted by descending wall time. Each stage is a dict with its "path" (the names of
+             the stage and its parent stages, joined with "/"), "calls", "wall_seconds", "self_wall_seconds" (wall
+             time not spent in sub-stages), "cpu_seconds", "peak_rss_bytes", and "counters".
+    :rtype: list of dict
+    """
+    flattened = []
+
+    def flatten(stages, parent_path):
+        for stage in stages:
+            path = stage["name"] if parent_path is None else f"{parent_path}/{stage['name']}"
+            flattened.append({
+                "path": path,
+                "calls": stage["calls"],
+                "wall_seconds": stage["wall_seconds"],
+                "self_wall_seconds": stage["wall_seconds"] - sum(s["wall_seconds"] for s in stage["sub_stages"]),
+                "cpu_seconds": stage["cpu_seconds"],
+                "peak_rss_bytes": stage["peak_rss_bytes"],
+                "counters": stage["counters"]
+            })
+            flatten(stage["sub_stages"], path)
+
+    flatten(profile["stages"], None)
+    flattened.sort(key=lambda s: s["wall_seconds"], reverse=True)
+    return flattened[:top_n]
+
+
+def print_hot_stages(profile, top_n=10, file=None):
+    """
+    Prints a table of the stages in a profile which took the most wall time.
+
+    :param profile: Serialized profile, as returned by `StageProfiler.to_dict`, or as read back from Firestore.
+    :type profile: dict
+    :param top_n: Maximum number of stages to print.
+    :type top_n: int
+    :param file: File to print to. If None, prints to stdout.
+    :type file: file-like | None
+    """
+    hot_stages = get_hot_stages(profile, top_n)
+    total_wall_seconds = sum(stage["wall_seconds"] for stage in profile["stages"])
+
+    print(f"Hot stages for pipeline '{profile['pipeline_name']}', run '{profile['run_id']}' "
+          f"(total {total_wall_seconds:.2f}s):", file=file)
+    print(f"{'Wall (s)':>10} {'% total':>8} {'Self (s)':>10} {'CPU (s)':>10} {'Calls':>7} "
+          f"{'Peak RSS (MiB)':>15}  Stage", file=file)
+    for stage in hot_stages:
+        percent = 100 * stage["wall_seconds"] / total_wall_seconds if total_wall_seconds > 0 else 0
+        rss = "-" if stage["peak_rss_bytes"] is None else f"{stage['peak_rss_bytes'] / 1024 / 1024:.1f}"
+        counters = ", ".join(f"{k}={v}" for k, v in sorted(stage["counters"].items()))
+        print(f"{stage['wall_seconds']:>10.2f} {percent:>7.1f}% {stage['self_wall_seconds']:>10.2f} "
+              f"{stage['cpu_seconds']:>10.2f} {stage['calls']:>7} {rss:>15}  {stage['path']}"
+              + (f"  [{counters}]" if counters != "" else ""), file=file)
@@ -6,6 +6,11 @@ setup(
     python_requires='>=3.6.0',
     url="https://github.com/AfricasVoices/Pipeline-Infrastructure",
     packages=find_packages(exclude=("test",)),
-    install_requires=["firebase_admin", "google-cloud-firestore", "google-cloud-storage", "google-api-python-client",
-                      "oauth2client", "coredatamodules @ git+https://github.com/AfricasVoices/CoreDataModules"]
+    install_requires=["firebase_admin", "google-cloud-firestore", "google-cloud-storage>=1.44",
+                      "google-api-python-client", "oauth2client",
+                      "coredatamodules @ git+https://github.com/AfricasVoices/CoreDataModules"],
+    extras_require={
+        "columnar_export": ["pyarrow>=8"],
+        "zstd": ["zstandard>=0.15"]
+    }
 )
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from core_data_modules.logging import Logger
+
+from storage.google_cloud import google_cloud_utils
+
+log = Logger(__name__)
+
+_BLOB_FILE_EXTENSION = ".blob"
+_METADATA_FILE_EXTENSION = ".json"
+
+
+class BlobCache(object):
+    def __init__(self, cache_dir, max_size_bytes=1024 * 1024 * 1024):
+        """
+        Local disk cache of Google Cloud Storage blobs, keyed by blob URL.
+
+        Each cached blob is stored with the generation it was downloaded at. When a cached blob is requested, its
+        current generation is fetched with a metadata request, and the blob is only downloaded again if it has
+        changed. When the cache grows over its maximum size, the least recently used blobs are evicted.
+
+        Every cached blob is stored in its own pair of files, which are replaced atomically, so a cache directory
+        can be shared by several processes. The directory and files are only readable by the current user, because
+        cached blobs may contain credentials.
+
+        :param cache_dir: Directory to store the cached blobs in. This is created if it doesn't exist.
+        :type cache_dir: str
+        :param max_size_bytes: Maximum total size of the cached blobs. A single blob larger than this is still cached
+                               until the next blob is downloaded.
+        :type max_size_bytes: int
+        """
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+
+    def _get_paths(self, blob_url):
+        key = hashlib.sha256(blob_url.encode("utf-8")).hexdigest()
+        return (os.path.join(self.cache_dir, key + _BLOB_FILE_EXTENSION),
+                os.path.join(self.cache_dir, key + _METADATA_FILE_EXTENSION))
+
+    def _read_metadata(self, metadata_path, blob_path):
+        if not os.path.exists(metadata_path) or not os.path.exists(blob_path):
+            return None
+        try:
+            with open(metadata_path) as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def _write_atomically(self, path, write_fn):
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write_fn(f)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def get_blob_path(self, bucket_credentials_file_path, blob_url, force_refresh=False):
+        """
+        Gets the path to a local copy of a blob, downloading the blob only if it isn't cached or has changed.
+
+        The returned file must not be modified, and may be evicted by later calls to this cache.
+
+        :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
+        :type bucket_credentials_file_path: str
+        :param blob_url: gs URL to the blob to get (i.e. of the form gs://<bucket-name>/<blob-name>).
+        :type blob_url: str
+        :param force_refresh: Whether to download the blob even if the cached copy is up to date.
+        :type force_refresh: bool
+        :return: Path to the cached copy of the blob.
+        :rtype: str
+        """
+        blob_path, metadata_path = self._get_paths(blob_url)
+        metadata = self._read_metadata(metadata_path, blob_path)
+
+        storage_client = google_cloud_utils.get_storage_client(bucket_credentials_file_path)
+        blob = google_cloud_utils._blob_at_url(storage_client, blob_url)
+        blob.reload()
+
+        if not force_refresh and metadata is not None and metadata["generation"] == blob.generation:
+            log.info(f"Using cached copy of blob '{blob_url}' (generation {blob.generation})")
+            # Mark the blob as recently used, for LRU eviction
+            os.utime(blob_path)
+            return blob_path
+
+        log.info(f"Downloading blob '{blob_url}' (generation {blob.generation}) to the blob cache...")
+        # Download the exact generation we just checked, so the data always matches the recorded generation.
+        # Decompress blobs which were uploaded with compression, so that the cached copy holds the blob's content.
+        self._write_atomically(
+            blob_path, lambda f: google_cloud_utils._download_blob_decompressed(blob, f, metadata_loaded=True))
+        self._write_atomically(metadata_path, lambda f: f.write(json.dumps({
+            "blob_url": blob_url,
+            "generation": blob.generation,
+            "etag": blob.etag,
+            "size": blob.size
+        }).encode("utf-8")))
+        log.info(f"Downloaded blob to the blob cache ({os.path.getsize(blob_path)} bytes)")
+
+        self._evict(keep_path=blob_path)
+        return blob_path
+
+    def download_blob_to_string(self, bucket_credentials_file_path, blob_url, force_refresh=False):
+        """
+        Cached equivalent of `google_cloud_utils.download_blob_to_string`.
+
+        :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
+        :type bucket_credentials_file_path: str
+        :param blob_url: gs URL to the blob to download (i.e. of the form gs://<bucket-name>/<blob-name>).
+        :type blob_url: str
+        :param force_refresh: Whether to download the blob even if the cached copy is up to date.
+        :type force_refresh: bool
+        :return: Contents of the requested blob.
+        :rtype: str
+        """
+        with open(self.get_blob_path(bucket_credentials_file_path, blob_url, force_refresh), "rb") as f:
+            return f.read().decode("utf-8")
+
+    def download_blob_to_file(self, bucket_credentials_file_path, blob_url, f, force_refresh=False):
+        """
+        Cached equivalent of `google_cloud_utils.download_blob_to_file`.
+
+        :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
+        :type bucket_credentials_file_path: str
+        :param blob_url: gs URL to the blob to download (i.e. of the form gs://<bucket-name>/<blob-name>).
+        :type blob_url: str
+        :param f: File to download the blob to, opened in binary mode.
+        :type f: file-like
+        :param force_refresh: Whether to download the blob even if the cached copy is up to date.
+        :type force_refresh: bool
+        """
+        with open(self.get_blob_path(bucket_credentials_file_path, blob_url, force_refresh), "rb") as cached_f:
+            while True:
+                chunk = cached_f.read(1024 * 1024)
+                if len(chunk) == 0:
+                    break
+                f.write(chunk)
+
+    def _evict(self, keep_path):
+        """
+        Deletes the least recently used blobs until the cache is no larger than its maximum size.
+
+        :param keep_path: Path of a blob which must not be evicted.
+        :type keep_path: str
+        """
+        with self._lock:
+            blobs = []
+            for file_name in os.listdir(self.cache_dir):
+                if not file_name.endswith(_BLOB_FILE_EXTENSION):
+                    continue
+                path = os.path.join(self.cache_dir, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Evicted by another process
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, path))
+
+            total_size = sum(size for _, size, _ in blobs)
+            for _, size, path in sorted(blobs):
+                if total_size <= self.max_size_bytes:
+                    break
+                if path == keep_path:
+                    continue
+
+                log.debug(f"Evicting '{path}' from the blob cache")
+                metadata_path = path[:-len(_BLOB_FILE_EXTENSION)] + _METADATA_FILE_EXTENSION
+                for evicted_path in [metadata_path, path]:
+                    try:
+                        os.remove(evicted_path)
+                    except FileNotFoundError:
+                        pass
+                total_size -= size
+
+    def clear(self):
+        """
+        Deletes every blob in the cache.
+        """
+        with self._lock:
+            for file_name in os.listdir(self.cache_dir):
+                if file_name.endswith(_BLOB_FILE_EXTENSION) or file_name.endswith(_METADATA_FILE_EXTENSION):
+                    os.remove(os.path.join(self.cache_dir, file_name))
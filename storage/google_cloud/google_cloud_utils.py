@@ -1,12 +1,119 @@
+import base64
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 
-from google.cloud import storage
 from core_data_modules.logging import Logger
-from requests import ConnectionError, Timeout
 import socket
 
+from util.lazy_imports import LazyModule
+
+requests = LazyModule("requests")
+requests_adapters = LazyModule("requests.adapters")
+service_account = LazyModule("google.oauth2.service_account")
+auth_requests = LazyModule("google.auth.transport.requests")
+storage = LazyModule("google.cloud.storage")
+api_exceptions = LazyModule("google.api_core.exceptions")
+google_crc32c = LazyModule("google_crc32c")
+
 log = Logger(__name__)
 
+# Default size of the chunks streamed to or from a blob. Uploaded chunks must be a multiple of 256 KiB.
+DEFAULT_STREAM_CHUNK_SIZE_BYTES = 8 * 1024 * 1024
+
+# Statuses of failed requests which may succeed if they are retried.
+_RETRYABLE_HTTP_STATUSES = {408, 429, 500, 502, 503, 504}
+
+# Google Cloud Storage's JSON API endpoint for starting resumable uploads.
+_RESUMABLE_UPLOAD_URL = "https://storage.googleapis.com/upload/storage/v1/b/{bucket_name}/o?uploadType=resumable"
+
+# Resumable uploads must be sent in chunks which are multiples of this size, except for the final chunk.
+_RESUMABLE_UPLOAD_CHUNK_MULTIPLE = 256 * 1024
+
+# JSON API fields of each blob which `iterate_blobs` requests by default.
+DEFAULT_BLOB_LIST_FIELDS = ("name", "size", "generation", "updated", "crc32c", "md5Hash")
+
+# Compressions which blobs can be uploaded with. Blobs are stored compressed, with their Content-Encoding set to the
+# compression, and are decompressed when downloaded with the functions in this module.
+COMPRESSIONS = ("gzip", "zstd")
+_GZIP_COMPRESSION_LEVEL = 6
+_ZSTD_COMPRESSION_LEVEL = 3
+
+_clients_lock = threading.Lock()
+_clients = dict()  # of absolute credentials file path -> google.cloud.storage.Client
+_sessions = dict()  # of absolute credentials file path -> google.auth.transport.requests.AuthorizedSession
+_http_pool_size = 10
+
+
+def configure_storage_clients(http_pool_size=10):
+    """
+    Sets the options to use when `get_storage_client` creates clients.
+
+    This only affects credentials that haven't had a client requested yet, so it should be called at start-up before
+    any clients are created.
+
+    :param http_pool_size: Maximum number of HTTP connections each client keeps open for reuse. This should be at
+                           least the number of threads which use the same client concurrently.
+    :type http_pool_size: int
+    """
+    global _http_pool_size
+
+    assert http_pool_size >= 1, "http_pool_size must be at least 1"
+    with _clients_lock:
+        _http_pool_size = http_pool_size
+
+
+def get_storage_client(bucket_credentials_file_path):
+    """
+    Gets a shared Google Cloud Storage client for the given credentials file.
+
+    Clients are created the first time they are requested for a credentials file, then shared by every later request
+    for the same file, including requests from different threads. Each client makes its requests through a pooled,
+    authorized HTTP session, so repeated blob operations reuse both connections and OAuth tokens rather than
+    re-reading the credentials and re-authenticating each time.
+
+    Note that changes to a credentials file after its client was created are not picked up.
+
+    :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
+    :type bucket_credentials_file_path: str
+    :return: Storage client.
+    :rtype: google.cloud.storage.Client
+    """
+    key = os.path.abspath(bucket_credentials_file_path)
+    with _clients_lock:
+        if key not in _clients:
+            log.debug(f"Creating Google Cloud Storage client for credentials file '{bucket_credentials_file_path}'")
+            credentials = service_account.Credentials.from_service_account_file(
+                bucket_credentials_file_path, scopes=storage.Client.SCOPE
+            )
+
+            session = auth_requests.AuthorizedSession(credentials)
+            adapter = requests_adapters.HTTPAdapter(pool_connections=_http_pool_size, pool_maxsize=_http_pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+
+            _clients[key] = storage.Client(project=credentials.project_id, credentials=credentials, _http=session)
+            _sessions[key] = session
+        return _clients[key]
+
+
+def _get_authorized_session(bucket_credentials_file_path):
+    # Returns the pooled, authorized HTTP session used by the shared storage client for these credentials, for
+    # making requests to the Cloud Storage JSON API which the client library doesn't expose.
+    get_storage_client(bucket_credentials_file_path)
+    with _clients_lock:
+        return _sessions[os.path.abspath(bucket_credentials_file_path)]
+
 
 def _blob_at_url(storage_client, blob_url):
     parsed_blob_url = urlparse(blob_url)
@@ -20,10 +127,118 @@ def _blob_at_url(storage_client, blob_url):
     return blob
 
 
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError as ex:
+        raise ImportError("zstd compression requires zstandard. Install it with "
+                          "`pip install PipelineInfrastructure[zstd]`") from ex
+    return zstandard
+
+
+def _check_compression(compression):
+    assert compression is None or compression in COMPRESSIONS, \
+        f"compression must be None or one of {COMPRESSIONS}, but was {compression}"
+    if compression == "zstd":
+        _import_zstandard()
+
+
+class _ClosingGzipFile(gzip.GzipFile):
+    # GzipFile doesn't close a file object it was given, but closing a blob writer is what finishes its upload.
+    # The file object is left open if the gzip stream couldn't be finished, so that a truncated upload isn't finished.
+    def close(self):
+        fileobj = self.fileobj
+        super().close()
+        if fileobj is not None:
+            fileobj.close()
+
+
+def _open_compressing_writer(f, compression, close_fileobj=True):
+    """
+    :return: Binary file-like object which compresses the data written to it, and writes the compressed data to `f`.
+             `f` is also closed when this is closed, if `close_fileobj` is True, unless the compressed stream can't be
+             finished. In that case `f` is left open, so that the caller can abort it instead e.g. a blob upload.
+    :rtype: file-like
+    """
+    if compression == "gzip":
+        # mtime=0 so the output only depends on the input, which lets interrupted uploads be resumed.
+        gzip_file_class = _ClosingGzipFile if close_fileobj else gzip.GzipFile
+        return gzip_file_class(fileobj=f, mode="wb", compresslevel=_GZIP_COMPRESSION_LEVEL, mtime=0)
+    assert compression == "zstd", compression
+    return _import_zstandard().ZstdCompressor(level=_ZSTD_COMPRESSION_LEVEL).stream_writer(f, closefd=close_fileobj)
+
+
+def _open_decompressing_reader(f, compression):
+    """
+    :return: Binary file-like object which reads and decompresses `f`. `f` is closed when this is closed.
+    :rtype: file-like
+    """
+    if compression == "gzip":
+        return _ClosingGzipFile(fileobj=f, mode="rb")
+    assert compression == "zstd", compression
+    return _import_zstandard().ZstdDecompressor().stream_reader(f, closefd=True)
+
+
+def _compress_bytes(data, compression):
+    compressed_f = io.BytesIO()
+    with _open_compressing_writer(compressed_f, compression, close_fileobj=False) as f:
+        f.write(data)
+    return compressed_f.getvalue()
+
+
+def _download_blob_decompressed(blob, f, metadata_loaded=False):
+    """
+    Downloads a blob to a binary file, decompressing it if it was uploaded with one of the `COMPRESSIONS`.
+
+    If `metadata_loaded` is True, the blob's content encoding is read from the metadata the caller already fetched
+    e.g. with `reload`, and the data is downloaded from the generation that metadata describes. Otherwise the stored
+    bytes are downloaded as they are, and the content encoding is read from the download's response headers, so no
+    separate metadata request is needed.
+    """
+    if metadata_loaded:
+        content_encoding = blob.content_encoding
+        blob = blob.bucket.blob(blob.name, generation=blob.generation)
+        if content_encoding not in COMPRESSIONS:
+            blob.download_to_file(f)
+            return
+        # Download the stored bytes as they are, rather than letting the client library decode gzip itself, so that
+        # every compression is decompressed the same way here.
+        compressed_f = tempfile.SpooledTemporaryFile(max_size=DEFAULT_STREAM_CHUNK_SIZE_BYTES)
+        blob.download_to_file(compressed_f, raw_download=True)
+    else:
+        # Downloading sets the blob's metadata, including its content encoding, from the response headers. The bytes
+        # are written straight to `f` if they can be moved out again should they turn out to be compressed.
+        start = f.tell() if f.seekable() else None
+        raw_f = f if start is not None else tempfile.SpooledTemporaryFile(max_size=DEFAULT_STREAM_CHUNK_SIZE_BYTES)
+        blob.download_to_file(raw_f, raw_download=True)
+        content_encoding = blob.content_encoding
+        if content_encoding not in COMPRESSIONS:
+            if raw_f is not f:
+                raw_f.seek(0)
+                shutil.copyfileobj(raw_f, f, DEFAULT_STREAM_CHUNK_SIZE_BYTES)
+            return
+        if raw_f is f:
+            compressed_f = tempfile.SpooledTemporaryFile(max_size=DEFAULT_STREAM_CHUNK_SIZE_BYTES)
+            f.seek(start)
+            shutil.copyfileobj(f, compressed_f, DEFAULT_STREAM_CHUNK_SIZE_BYTES)
+            f.seek(start)
+            f.truncate()
+        else:
+            compressed_f = raw_f
+
+    compressed_size = compressed_f.tell()
+    compressed_f.seek(0)
+    with _open_decompressing_reader(compressed_f, content_encoding) as decompressed_f:
+        shutil.copyfileobj(decompressed_f, f, DEFAULT_STREAM_CHUNK_SIZE_BYTES)
+    log.debug(f"Decompressed {content_encoding} blob from {compressed_size} bytes")
+
+
 def download_blob_to_string(bucket_credentials_file_path, blob_url):
     """
     Downloads the contents of a Google Cloud Storage blob to a string.
 
+    Blobs which were uploaded with one of the `COMPRESSIONS` are decompressed.
+
     :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
     :type bucket_credentials_file_path: str
     :param blob_url: gs URL to the blob to download (i.e. of the form gs://<bucket-name>/<blob-name>).
@@ -32,15 +247,17 @@ def download_blob_to_string(bucket_credentials_file_path, blob_url):
     :rtype: str
     """
     log.info(f"Downloading blob '{blob_url}' to string...")
-    storage_client = storage.Client.from_service_account_json(bucket_credentials_file_path)
+    storage_client = get_storage_client(bucket_credentials_file_path)
     blob = _blob_at_url(storage_client, blob_url)
-    blob_contents = blob.download_as_string().decode("utf-8")
+    f = io.BytesIO()
+    _download_blob_decompressed(blob, f)
+    blob_contents = f.getvalue().decode("utf-8")
     log.info(f"Downloaded blob to string ({len(blob_contents)} characters).")
 
     return blob_contents
 
 
-def upload_string_to_blob(bucket_credentials_file_path, target_blob_url, string):
+def upload_string_to_blob(bucket_credentials_file_path, target_blob_url, string, compression=None):
     """
     Uploads a string to a Google Cloud Storage blob.
 
@@ -50,18 +267,96 @@ def upload_string_to_blob(bucket_credentials_file_path, target_blob_url, string)
     :type target_blob_url: str
     :param string: String to upload
     :type string: str
+    :param compression: One of `COMPRESSIONS` to compress the blob with, or None to upload it uncompressed.
+    :type compression: str | None
     """
+    _check_compression(compression)
     log.info(f"Uploading string to blob '{target_blob_url}' ({len(string)} characters)...")
-    storage_client = storage.Client.from_service_account_json(bucket_credentials_file_path)
+    storage_client = get_storage_client(bucket_credentials_file_path)
     blob = _blob_at_url(storage_client, target_blob_url)
-    blob.upload_from_string(string)
+    if compression is None:
+        blob.upload_from_string(string)
+    else:
+        data = _compress_bytes(string.encode("utf-8"), compression)
+        log.info(f"Compressed string with {compression} to {len(data)} bytes")
+        blob.content_encoding = compression
+        blob.upload_from_string(data, content_type="text/plain")
     log.info("Uploaded string to blob.")
 
 
+def download_blob_to_bytes(bucket_credentials_file_path, blob_url):
+    """
+    Downloads the contents of a Google Cloud Storage blob to bytes.
+
+    Blobs which were uploaded with one of the `COMPRESSIONS` are decompressed.
+
+    :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
+    :type bucket_credentials_file_path: str
+    :param blob_url: gs URL to the blob to download (i.e. of the form gs://<bucket-name>/<blob-name>).
+    :type blob_url: str
+    :return: Contents of the requested blob.
+    :rtype: bytes
+    """
+    log.info(f"Downloading blob '{blob_url}' to bytes...")
+    storage_client = get_storage_client(bucket_credentials_file_path)
+    blob = _blob_at_url(storage_client, blob_url)
+    f = io.BytesIO()
+    _download_blob_decompressed(blob, f)
+    blob_contents = f.getvalue()
+    log.info(f"Downloaded blob to bytes ({len(blob_contents)} bytes).")
+
+    return blob_contents
+
+
+def upload_bytes_to_blob(bucket_credentials_file_path, target_blob_url, data, content_type="application/octet-stream",
+                         compression=None):
+    """
+    Uploads bytes to a Google Cloud Storage blob.
+
+    :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
+    :type bucket_credentials_file_path: str
+    :param target_blob_url: gs URL to the blob to upload to (i.e. of the form gs://<bucket-name>/<blob-name>).
+    :type target_blob_url: str
+    :param data: Bytes to upload.
+    :type data: bytes
+    :param content_type: Content type to set on the uploaded blob.
+    :type content_type: str
+    :param compression: One of `COMPRESSIONS` to compress the blob with, or None to upload it uncompressed.
+    :type compression: str | None
+    """
+    _check_compression(compression)
+    log.info(f"Uploading bytes to blob '{target_blob_url}' ({len(data)} bytes)...")
+    storage_client = get_storage_client(bucket_credentials_file_path)
+    blob = _blob_at_url(storage_client, target_blob_url)
+    if compression is not None:
+        data = _compress_bytes(data, compression)
+        log.info(f"Compressed bytes with {compression} to {len(data)} bytes")
+        blob.content_encoding = compression
+    blob.upload_from_string(data, content_type=content_type)
+    log.info("Uploaded bytes to blob.")
+
+
+def delete_blob(bucket_credentials_file_path, blob_url):
+    """
+    Deletes a Google Cloud Storage blob.
+
+    :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
+    :type bucket_credentials_file_path: str
+    :param blob_url: gs URL to the blob to delete (i.e. of the form gs://<bucket-name>/<blob-name>).
+    :type blob_url: str
+    """
+    log.info(f"Deleting blob '{blob_url}'...")
+    storage_client = get_storage_client(bucket_credentials_file_path)
+    _blob_at_url(storage_client, blob_url).delete()
+    log.info("Deleted blob.")
+
+
 def download_blob_to_file(bucket_credentials_file_path, blob_url, f):
     """
     Downloads a Google Cloud Storage blob to a file.
 
+    Blobs which were uploaded with one of the `COMPRESSIONS` are decompressed.
+
     :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
     :type bucket_credentials_file_path: str
     :param blob_url: gs URL to the blob to download (i.e. of the form gs://<bucket-name>/<blob-name>).
@@ -70,58 +365,433 @@ def download_blob_to_file(bucket_credentials_file_path, blob_url, f):
     :type f: file-like
     """
     log.info(f"Downloading blob '{blob_url}' to file...")
-    storage_client = storage.Client.from_service_account_json(bucket_credentials_file_path)
+    storage_client = get_storage_client(bucket_credentials_file_path)
     blob = _blob_at_url(storage_client, blob_url)
-    blob.download_to_file(f)
+    _download_blob_decompressed(blob, f)
     log.info(f"Downloaded blob to file")
 
 
-def upload_file_to_blob(bucket_credentials_file_path, target_blob_url, f, max_retries=4, blob_chunk_size=100 * 1024):
+class _RetryableUploadError(Exception):
+    pass
+
+
+class _UploadSessionExpiredError(Exception):
+    pass
+
+
+def _get_backoff_seconds(retries, initial_backoff_seconds, max_backoff_seconds):
+    """
+    :return: Jittered exponential backoff before retry number `retries + 1`, chosen uniformly at random up to
+             `initial_backoff_seconds * 2 ** retries`, or up to `max_backoff_seconds` if that is smaller. The jitter
+             stops concurrent transfers which failed together from all retrying at the same time.
+    :rtype: float
+    """
+    return random.uniform(0, min(max_backoff_seconds, initial_backoff_seconds * 2 ** retries))
+
+
+def _check_resumable_upload_response(response, total_bytes):
+    """
+    Interprets the response to a request made to a resumable upload session.
+
+    :return: Number of bytes the server has committed. This is `total_bytes` once the upload is complete.
+    :rtype: int
     """
-    Uploads a file to a Google Cloud Storage blob.
+    if response.status_code in {200, 201}:
+        return total_bytes
+    if response.status_code == 308:
+        # The Range header is of the form "bytes=0-<last committed byte>", and is missing if no bytes are committed.
+        committed_range = response.headers.get("Range")
+        return 0 if committed_range is None else int(committed_range.split("-")[1]) + 1
+    if response.status_code in {404, 410}:
+        raise _UploadSessionExpiredError(f"Resumable upload session expired (HTTP {response.status_code})")
+    if response.status_code in _RETRYABLE_HTTP_STATUSES:
+        raise _RetryableUploadError(f"Resumable upload request failed with HTTP {response.status_code}")
+    response.raise_for_status()
+    raise ValueError(f"Unexpected HTTP {response.status_code} response from resumable upload session")
+
+
+def _start_resumable_upload_session(session, target_blob_url, content_type, content_encoding, total_bytes):
+    parsed_blob_url = urlparse(target_blob_url)
+    metadata = {"name": parsed_blob_url.path.lstrip("/"), "contentType": content_type}
+    if content_encoding is not None:
+        metadata["contentEncoding"] = content_encoding
+    headers = {"X-Upload-Content-Type": content_type}
+    if total_bytes is not None:
+        headers["X-Upload-Content-Length"] = str(total_bytes)
+    response = session.post(
+        _RESUMABLE_UPLOAD_URL.format(bucket_name=parsed_blob_url.netloc),
+        json=metadata,
+        headers=headers
+    )
+    if response.status_code in _RETRYABLE_HTTP_STATUSES:
+        raise _RetryableUploadError(f"Starting resumable upload failed with HTTP {response.status_code}")
+    response.raise_for_status()
+    return response.headers["Location"]
+
+
+def _query_committed_bytes(session, session_uri, total_bytes):
+    response = session.put(session_uri, headers={"Content-Range": f"bytes */{total_bytes}"})
+    return _check_resumable_upload_response(response, total_bytes)
+
+
+def _read_upload_session_file(session_uri_file_path, target_blob_url, total_bytes):
+    if session_uri_file_path is None or not os.path.exists(session_uri_file_path):
+        return None
+    with open(session_uri_file_path) as f:
+        saved_session = json.load(f)
+    if saved_session["target_blob_url"] != target_blob_url or saved_session["total_bytes"] != total_bytes:
+        log.warning(f"Ignoring the saved upload session in '{session_uri_file_path}', because it was for a different "
+                    f"upload")
+        return None
+    return saved_session["session_uri"]
+
+
+def _write_upload_session_file(session_uri_file_path, target_blob_url, total_bytes, session_uri):
+    if session_uri_file_path is None:
+        return
+    with open(session_uri_file_path, "w") as f:
+        json.dump({"target_blob_url": target_blob_url, "total_bytes": total_bytes, "session_uri": session_uri}, f)
+
+
+def upload_file_to_blob(bucket_credentials_file_path, target_blob_url, f, max_retries=4, blob_chunk_size=100 * 1024,
+                        content_type="application/octet-stream", initial_backoff_seconds=1, max_backoff_seconds=60,
+                        session_uri_file_path=None, compression=None):
+    """
+    Uploads a file to a Google Cloud Storage blob, using a resumable upload.
+
+    The file is uploaded in chunks. If a chunk fails with a connection, timeout, or transient server error, the
+    server is asked how many bytes it has committed, and the upload continues from there after a jittered
+    exponential backoff, rather than starting again from the beginning.
+
+    If a `session_uri_file_path` is given, the upload session is saved there while the upload is in progress, so that
+    if this process is restarted, a later call with the same arguments continues the upload where it left off.
+    The file must not be modified between the two calls. The session file is deleted when the upload completes.
+
+    If a `compression` is given, the file is first compressed a chunk at a time into a temporary file, which is then
+    uploaded, so that failed chunks can be resent. The compressed output only depends on the file's contents, so
+    uploads of compressed files can also be continued by a later call.
 
     :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
     :type bucket_credentials_file_path: str
     :param target_blob_url: gs URL to the blob to upload to (i.e. of the form gs://<bucket-name>/<blob-name>).
     :type target_blob_url: str
-    :param f: File to upload, opened in binary mode.
+    :param f: File to upload, opened in binary mode. The file is uploaded from its current position to its end.
     :type f: file-like
-    :param max_retries: Maximum number of times to retry uploading the file.
+    :param max_retries: Maximum number of consecutive times to retry a request that failed without any more of the
+                        file being committed.
     :type max_retries: int
-    :param blob_chunk_size: The chunk size to use for resumable uploads, in KiB.
+    :param blob_chunk_size: The chunk size to use for resumable uploads, in KiB. This is rounded down to a multiple
+                            of 256 KiB.
     :type blob_chunk_size: float
+    :param content_type: Content type to set on the uploaded blob.
+    :type content_type: str
+    :param initial_backoff_seconds: Maximum backoff before the first retry. The maximum doubles on each consecutive
+                                    retry, and the actual backoff is chosen uniformly at random up to the maximum.
+    :type initial_backoff_seconds: float
+    :param max_backoff_seconds: Upper limit on the backoff before any retry.
+    :type max_backoff_seconds: float
+    :param session_uri_file_path: Path to a file to save the upload session in, or None to not save the session.
+    :type session_uri_file_path: str | None
+    :param compression: One of `COMPRESSIONS` to compress the blob with, or None to upload it uncompressed.
+    :type compression: str | None
     """
-    try:
-        log.info(f"Uploading file to blob '{target_blob_url}'...")
-        storage_client = storage.Client.from_service_account_json(bucket_credentials_file_path)
-        blob = _blob_at_url(storage_client, target_blob_url)
-        blob.chunk_size = int(blob_chunk_size * 1024) # resumable expects an integer
-        blob.upload_from_file(f)
-        log.info(f"Uploaded file to blob")
+    _check_compression(compression)
+    if compression is None:
+        _upload_file_resumably(bucket_credentials_file_path, target_blob_url, f, max_retries, blob_chunk_size,
+                               content_type, None, initial_backoff_seconds, max_backoff_seconds, session_uri_file_path)
+        return
+
+    with tempfile.TemporaryFile() as compressed_f:
+        uncompressed_start = f.tell()
+        with _open_compressing_writer(compressed_f, compression, close_fileobj=False) as compressing_f:
+            shutil.copyfileobj(f, compressing_f, DEFAULT_STREAM_CHUNK_SIZE_BYTES)
+        log.info(f"Compressed file with {compression} from {f.tell() - uncompressed_start} bytes to "
+                 f"{compressed_f.tell()} bytes")
+        compressed_f.seek(0)
+        _upload_file_resumably(bucket_credentials_file_path, target_blob_url, compressed_f, max_retries,
+                               blob_chunk_size, content_type, compression, initial_backoff_seconds,
+                               max_backoff_seconds, session_uri_file_path)
 
-    except (ConnectionError, socket.timeout, Timeout) as ex:
-        log.warning("Failed to upload due to connection/timeout error")
 
-        if max_retries <= 0:
-            log.error(f"Failed to upload file to blob")
-            raise ex
+def _upload_file_resumably(bucket_credentials_file_path, target_blob_url, f, max_retries, blob_chunk_size,
+                           content_type, content_encoding, initial_backoff_seconds, max_backoff_seconds,
+                           session_uri_file_path):
+    """
+    Uploads a file with a resumable upload session. See `upload_file_to_blob`.
+    """
+    chunk_size = max(1, int(blob_chunk_size * 1024) // _RESUMABLE_UPLOAD_CHUNK_MULTIPLE) * \
+        _RESUMABLE_UPLOAD_CHUNK_MULTIPLE
 
-        if blob_chunk_size / 2 < 256:
-            log.error(f"Not retrying because the next blob_chunk_size {blob_chunk_size / 2} is below the minimum "
-                      f"allowed (256KB)")
-            raise ex
+    start_position = f.tell()
+    total_bytes = f.seek(0, io.SEEK_END) - start_position
 
-        log.info(f"Retrying up to {max_retries} more times with a reduced chunk_size of {blob_chunk_size / 2}KB")
-        # lower the chunk size and start uploading from beginning because resumable_media requires so
-        f.seek(0)
-        upload_file_to_blob(bucket_credentials_file_path, target_blob_url, f,
-                            max_retries - 1, blob_chunk_size / 2)
+    log.info(f"Uploading file to blob '{target_blob_url}' ({total_bytes} bytes)...")
+    session = _get_authorized_session(bucket_credentials_file_path)
+
+    session_uri = _read_upload_session_file(session_uri_file_path, target_blob_url, total_bytes)
+    committed_bytes = None
+    retries = 0
+    while committed_bytes != total_bytes:
+        try:
+            if session_uri is None:
+                session_uri = _start_resumable_upload_session(session, target_blob_url, content_type,
+                                                              content_encoding, total_bytes)
+                _write_upload_session_file(session_uri_file_path, target_blob_url, total_bytes, session_uri)
+                committed_bytes = 0
+
+            if committed_bytes is None:
+                # Resuming a session after a failure or restart, so ask the server where to continue from.
+                committed_bytes = _query_committed_bytes(session, session_uri, total_bytes)
+                log.info(f"Resuming upload from byte {committed_bytes}/{total_bytes}")
+                if committed_bytes == total_bytes:
+                    break
+
+            f.seek(start_position + committed_bytes)
+            chunk = f.read(chunk_size)
+            if len(chunk) == 0:
+                # Only reached for empty files, which are finalized with an empty request.
+                content_range = f"bytes */{total_bytes}"
+            else:
+                content_range = f"bytes {committed_bytes}-{committed_bytes + len(chunk) - 1}/{total_bytes}"
+            response = session.put(session_uri, data=chunk, headers={"Content-Range": content_range})
+            new_committed_bytes = _check_resumable_upload_response(response, total_bytes)
+        except _UploadSessionExpiredError as ex:
+            if retries >= max_retries:
+                raise ex
+            log.warning("Upload session expired, restarting the upload from the beginning")
+            session_uri = None
+            retries += 1
+            continue
+        except (_RetryableUploadError, requests.ConnectionError, requests.Timeout, socket.timeout) as ex:
+            if retries >= max_retries:
+                log.error(f"Failed to upload file to blob after {retries} retries")
+                raise ex
+            backoff_seconds = _get_backoff_seconds(retries, initial_backoff_seconds, max_backoff_seconds)
+            retries += 1
+            log.warning(f"Upload request failed with {type(ex).__name__}: {ex}. Retrying from the last committed byte "
+                        f"in {backoff_seconds:.1f} seconds (retry {retries}/{max_retries})...")
+            time.sleep(backoff_seconds)
+            committed_bytes = None
+            continue
+
+        if new_committed_bytes > committed_bytes:
+            retries = 0
+        committed_bytes = new_committed_bytes
+        log.debug(f"Uploaded {committed_bytes}/{total_bytes} bytes")
+
+    if session_uri_file_path is not None and os.path.exists(session_uri_file_path):
+        os.remove(session_uri_file_path)
+    log.info(f"Uploaded file to blob")
+
+
+class _ResumableBlobWriter(io.BufferedIOBase):
+    """
+    Binary file-like object which uploads the data written to it to a blob in chunks, using a resumable upload session.
+
+    The upload is only finished when this is closed after `finish_on_close` has been set. Closing it without setting
+    `finish_on_close`, including when it is closed because it was garbage collected, cancels the upload session
+    instead, so that the blob isn't created or replaced. The session is also cancelled if a chunk fails to upload
+    after retrying, or `abort` is called.
+    """
+
+    def __init__(self, session, target_blob_url, content_type, content_encoding, chunk_size, max_retries=4,
+                 initial_backoff_seconds=1, max_backoff_seconds=60):
+        super().__init__()
+        self._session = session
+        self._target_blob_url = target_blob_url
+        self._content_type = content_type
+        self._content_encoding = content_encoding
+        self._chunk_size = chunk_size
+        self._max_retries = max_retries
+        self._initial_backoff_seconds = initial_backoff_seconds
+        self._max_backoff_seconds = max_backoff_seconds
+
+        self._session_uri = None
+        self._committed_bytes = 0
+        self._buffer = bytearray()  # of the bytes written after the last byte the server has committed
+        self._aborted = False
+        self.finish_on_close = False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        size = memoryview(b).nbytes
+        if self._aborted:
+            # Discard data written by the file objects wrapping this one as they are closed, e.g. a gzip trailer.
+            return size
+        if self.closed:
+            raise ValueError("write to closed blob writer")
+
+        self._buffer += b
+        while len(self._buffer) >= self._chunk_size:
+            self._upload(self._chunk_size, None)
+        return size
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if not self.finish_on_close:
+                self.abort()
+            elif not self._aborted:
+                self._upload(len(self._buffer), self._committed_bytes + len(self._buffer))
+        finally:
+            super().close()
+
+    def abort(self):
+        """
+        Cancels the upload, so that the blob isn't created or replaced. Data written after this is discarded.
+        Has no effect if the upload has already been finished.
+        """
+        if self._aborted or self.closed:
+            return
+        self._aborted = True
+        self._buffer = bytearray()
+        if self._session_uri is None:
+            return
+
+        log.warning(f"Cancelling the upload to blob '{self._target_blob_url}'")
+        try:
+            self._session.delete(self._session_uri)
+        except (requests.ConnectionError, requests.Timeout, socket.timeout) as ex:
+            # The blob still won't be created, because the session expires without being finished.
+            log.warning(f"Failed to cancel the upload session ({type(ex).__name__}: {ex})")
+
+    def _discard_committed(self, committed_bytes):
+        del self._buffer[:committed_bytes - self._committed_bytes]
+        self._committed_bytes = committed_bytes
+
+    def _upload(self, length, total_bytes):
+        """
+        Uploads the first `length` bytes of the buffer, resending any bytes the server didn't commit. If `total_bytes`
+        is given, these are the final bytes of the blob, and the upload is finished. If the upload fails, it is aborted.
+        """
+        end_bytes = self._committed_bytes + length
+        total = "*" if total_bytes is None else total_bytes
+        retries = 0
+        resuming = False
+        try:
+            while True:
+                try:
+                    if self._session_uri is None:
+                        self._session_uri = _start_resumable_upload_session(
+                            self._session, self._target_blob_url, self._content_type, self._content_encoding,
+                            total_bytes
+                        )
+                    elif resuming:
+                        # Ask the server where to continue from, so that only the uncommitted bytes are resent.
+                        self._discard_committed(_query_committed_bytes(self._session, self._session_uri, total))
+                        resuming = False
+                    if total_bytes is None and self._committed_bytes == end_bytes:
+                        return
+
+                    if self._committed_bytes == end_bytes:
+                        # Only reached for the final request of an upload whose bytes have all been committed.
+                        content_range = f"bytes */{total}"
+                    else:
+                        content_range = f"bytes {self._committed_bytes}-{end_bytes - 1}/{total}"
+                    response = self._session.put(self._session_uri,
+                                                 data=bytes(self._buffer[:end_bytes - self._committed_bytes]),
+                                                 headers={"Content-Range": content_range})
+                    committed_bytes = _check_resumable_upload_response(response, total_bytes)
+                except (_RetryableUploadError, requests.ConnectionError, requests.Timeout, socket.timeout) as ex:
+                    if retries >= self._max_retries:
+                        log.error(f"Failed to upload to blob after {retries} retries")
+                        raise ex
+                    backoff_seconds = _get_backoff_seconds(retries, self._initial_backoff_seconds,
+                                                           self._max_backoff_seconds)
+                    retries += 1
+                    log.warning(f"Upload request failed with {type(ex).__name__}: {ex}. Retrying from the last "
+                                f"committed byte in {backoff_seconds:.1f} seconds "
+                                f"(retry {retries}/{self._max_retries})...")
+                    time.sleep(backoff_seconds)
+                    resuming = self._session_uri is not None
+                    continue
+
+                if committed_bytes > self._committed_bytes:
+                    retries = 0
+                self._discard_committed(committed_bytes)
+                if self._committed_bytes == end_bytes:
+                    return
+        except BaseException:
+            self.abort()
+            raise
+
+
+def iterate_blobs(bucket_credentials_file_path, bucket_url, prefix=None, delimiter=None, page_size=1000,
+                  fields=DEFAULT_BLOB_LIST_FIELDS):
+    """
+    Iterates over the blobs in a bucket, with their metadata, fetching one page of results at a time.
+
+    All the metadata comes from the listing, so no further requests are needed per blob. Only the requested `fields`
+    are returned by the server, which keeps the listing responses small. Metadata which wasn't requested is None.
+
+    If a `delimiter` is given, blobs whose names contain the delimiter after the `prefix` are not listed. Instead,
+    each distinct prefix up to and including the delimiter is listed once as a "directory", with "is_prefix" set to
+    True and all its other metadata None. Each page's directories are yielded after its blobs.
+
+    :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
+    :type bucket_credentials_file_path: str
+    :param bucket_url: gs URL to the bucket to list (i.e. of the form gs://<bucket-name>).
+    :type bucket_url: str
+    :param prefix: Only list blobs whose names begin with this prefix, or None to list every blob in the bucket.
+    :type prefix: str | None
+    :param delimiter: Delimiter to list directories with e.g. "/", or None to list every blob under `prefix`.
+    :type delimiter: str | None
+    :param page_size: Maximum number of blobs to fetch per request.
+    :type page_size: int
+    :param fields: JSON API fields of each blob to request. Must include "name".
+    :type fields: iterable of str
+    :return: Generator of dicts with the blob's "name", "is_prefix", "size" (int), "generation" (int),
+             "updated" (datetime.datetime), and base64-encoded "crc32c" and "md5_hash".
+    :rtype: generator of dict
+    """
+    fields = tuple(fields)
+    assert "name" in fields, "fields must include 'name'"
+
+    storage_client = get_storage_client(bucket_credentials_file_path)
+    bucket_name = urlparse(bucket_url).netloc
+    iterator = storage_client.list_blobs(
+        bucket_name, prefix=prefix, delimiter=delimiter, page_size=page_size,
+        fields=f"items({','.join(fields)}),prefixes,nextPageToken"
+    )
+
+    seen_prefixes = set()
+    for page in iterator.pages:
+        for blob in page:
+            yield {
+                "name": blob.name,
+                "is_prefix": False,
+                "size": blob.size,
+                "generation": blob.generation,
+                "updated": blob.updated,
+                "crc32c": blob.crc32c,
+                "md5_hash": blob.md5_hash
+            }
+
+        for directory in page.prefixes:
+            # The same directory may be returned again on a later page, if it contains blobs listed on both pages.
+            if directory in seen_prefixes:
+                continue
+            seen_prefixes.add(directory)
+            yield {
+                "name": directory,
+                "is_prefix": True,
+                "size": None,
+                "generation": None,
+                "updated": None,
+                "crc32c": None,
+                "md5_hash": None
+            }
 
 
 def list_blobs( bucket_credentials_file_path, bucket_url, prefix):
     """
     Lists names of blobs in a bucket.
 
+    To list large buckets, or to get the blobs' metadata, use `iterate_blobs`.
+
     :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
     :type bucket_credentials_file_path: str
     :param bucket_url: gs URL to the bucket in which to look for objects names. (i.e. of the form gs://<bucket-name>).
@@ -131,10 +801,618 @@ def list_blobs( bucket_credentials_file_path, bucket_url, prefix):
     :return: a list of blob objects names.
     :rtype: list
     """
-    storage_client = storage.Client.from_service_account_json(bucket_credentials_file_path)
-    parsed_bucket_url = urlparse(bucket_url)
-    bucket_name = parsed_bucket_url.netloc
-    blobs = storage_client.list_blobs(bucket_name, prefix=prefix)
-    blob_names = [blob.name for blob in blobs]
+    return [blob["name"] for blob in iterate_blobs(bucket_credentials_file_path, bucket_url, prefix, fields=["name"])]
+
+
+def _is_retryable_transfer_error(ex):
+    return isinstance(ex, (
+        requests.ConnectionError, requests.Timeout, socket.timeout, ConnectionError,
+        api_exceptions.InternalServerError, api_exceptions.ServiceUnavailable, api_exceptions.TooManyRequests,
+        api_exceptions.GatewayTimeout
+    ))
+
+
+def _run_with_retries(f, description, max_retries, backoff_seconds, max_backoff_seconds=60):
+    """
+    Runs `f`, retrying with a jittered exponential backoff if it fails with a connection, timeout, or transient server
+    error. See `_get_backoff_seconds`.
+    """
+    retries = 0
+    while True:
+        try:
+            return f()
+        except Exception as ex:
+            if not _is_retryable_transfer_error(ex) or retries >= max_retries:
+                raise ex
+            retry_backoff_seconds = _get_backoff_seconds(retries, backoff_seconds, max_backoff_seconds)
+            retries += 1
+            log.warning(f"{description} failed with {type(ex).__name__}: {ex}. Retrying in "
+                        f"{retry_backoff_seconds:.1f} seconds (retry {retries}/{max_retries})...")
+            time.sleep(retry_backoff_seconds)
+
+
+def _get_throughput(description, total_bytes, start):
+    """
+    Logs and returns the throughput of a transfer which started at `start`, as measured by `time.perf_counter`.
+
+    :return: Dict of the number of "bytes" transferred, the elapsed "seconds", and the "bytes_per_second".
+    :rtype: dict of str -> float
+    """
+    elapsed_seconds = time.perf_counter() - start
+    bytes_per_second = total_bytes / elapsed_seconds if elapsed_seconds > 0 else 0
+    log.info(f"{description} ({total_bytes / 1024 / 1024:.1f} MiB) in {elapsed_seconds:.1f}s "
+             f"({bytes_per_second / 1024 / 1024:.1f} MiB/s)")
+    return {"bytes": total_bytes, "seconds": elapsed_seconds, "bytes_per_second": bytes_per_second}
+
+
+def download_blob_to_file_sliced(bucket_credentials_file_path, blob_url, file_path, slice_size_bytes=64 * 1024 * 1024,
+                                 max_workers=8, max_retries=3, backoff_seconds=1):
+    """
+    Downloads a Google Cloud Storage blob to a file, by downloading slices of the blob in parallel with range
+    requests. This is much faster than `download_blob_to_file` for very large blobs.
+
+    All slices are downloaded from the same generation of the blob, so the file can't be a mix of two versions of the
+    blob if it is overwritten during the download. Each slice is retried independently.
+
+    Blobs which were uploaded with one of the `COMPRESSIONS` can't be decompressed in slices, so are downloaded and
+    decompressed whole.
+
+    :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
+    :type bucket_credentials_file_path: str
+    :param blob_url: gs URL to the blob to download (i.e. of the form gs://<bucket-name>/<blob-name>).
+    :type blob_url: str
+    :param file_path: Path to download the blob to. Any existing file at this path will be overwritten.
+    :type file_path: str
+    :param slice_size_bytes: Size of each slice to download.
+    :type slice_size_bytes: int
+    :param max_workers: Maximum number of slices to download at the same time.
+    :type max_workers: int
+    :param max_retries: Maximum number of times to retry downloading each slice.
+    :type max_retries: int
+    :param backoff_seconds: Maximum backoff before the first retry of a slice. The maximum doubles on each retry, and
+                            the actual backoff is chosen uniformly at random up to the maximum.
+    :type backoff_seconds: float
+    :return: Dict of the number of "bytes" downloaded, the elapsed "seconds", and the "bytes_per_second".
+    :rtype: dict of str -> float
+    """
+    start = time.perf_counter()
+    storage_client = get_storage_client(bucket_credentials_file_path)
+    blob = _blob_at_url(storage_client, blob_url)
+    _run_with_retries(blob.reload, f"Getting the metadata of blob '{blob_url}'", max_retries, backoff_seconds)
+    size = _download_reloaded_blob_to_file_sliced(blob, blob_url, file_path, slice_size_bytes, max_workers,
+                                                  max_retries, backoff_seconds)
+    return _get_throughput(f"Downloaded blob '{blob_url}'", size, start)
+
+
+def _download_reloaded_blob_to_file_sliced(blob, blob_url, file_path, slice_size_bytes, max_workers, max_retries,
+                                           backoff_seconds):
+    """
+    Downloads a blob whose metadata has already been fetched to a file in slices.
+    See `download_blob_to_file_sliced`.
+
+    :return: Size of the downloaded file, in bytes.
+    :rtype: int
+    """
+    if blob.content_encoding in COMPRESSIONS:
+        def download_whole_blob():
+            with open(file_path, "wb") as f:
+                _download_blob_decompressed(blob, f, metadata_loaded=True)
+
+        _run_with_retries(download_whole_blob, f"Downloading blob '{blob_url}'", max_retries, backoff_seconds)
+        return os.path.getsize(file_path)
+
+    size = blob.size
+    blob = blob.bucket.blob(blob.name, generation=blob.generation)
+
+    slices = [(start, min(start + slice_size_bytes, size) - 1) for start in range(0, size, slice_size_bytes)]
+    log.info(f"Downloading blob '{blob_url}' ({size} bytes) to file '{file_path}' in {len(slices)} slices...")
+
+    with open(file_path, "wb") as f:
+        f.truncate(size)
+
+    def download_slice(start, end):
+        # Each slice opens its own handle on the file, so slices can be written at their offsets concurrently.
+        with open(file_path, "r+b") as slice_f:
+            slice_f.seek(start)
+            blob.download_to_file(slice_f, start=start, end=end)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(_run_with_retries, lambda start=start, end=end: download_slice(start, end),
+                            f"Downloading bytes {start}-{end} of blob '{blob_url}'", max_retries, backoff_seconds)
+            for start, end in slices
+        ]
+        for future in as_completed(futures):
+            future.result()
+
+    return size
+
+
+def download_blobs(bucket_credentials_file_path, blob_urls, dest_dir, max_workers=8, max_retries=3,
+                   backoff_seconds=1, sliced_download_threshold_bytes=None, slice_size_bytes=64 * 1024 * 1024):
+    """
+    Downloads many Google Cloud Storage blobs to a directory concurrently.
+
+    Each blob is downloaded to a file in `dest_dir` with the same name as the last component of the blob's name.
+    Each blob is retried independently if it fails with a connection, timeout, or transient server error.
+    Blobs larger than `sliced_download_threshold_bytes` are downloaded in slices, using up to `max_workers` extra
+    threads per blob.
+
+    Note that each worker thread uses a connection from the storage client's HTTP connection pool, so `max_workers`
+    should be at most the pool size set with `configure_storage_clients`.
+
+    :param bucket_credentials_file_path: Path to a credentials file for accessing the buckets.
+    :type bucket_credentials_file_path: str
+    :param blob_urls: gs URLs of the blobs to download (i.e. of the form gs://<bucket-name>/<blob-name>).
+    :type blob_urls: list of str
+    :param dest_dir: Directory to download the blobs to. This is created if it doesn't exist.
+    :type dest_dir: str
+    :param max_workers: Maximum number of blobs to download at the same time.
+    :type max_workers: int
+    :param max_retries: Maximum number of times to retry downloading each blob.
+    :type max_retries: int
+    :param backoff_seconds: Maximum backoff before the first retry of a blob. The maximum doubles on each retry, and
+                            the actual backoff is chosen uniformly at random up to the maximum.
+    :type backoff_seconds: float
+    :param sliced_download_threshold_bytes: Size above which to download a blob in parallel slices with
+                                            `download_blob_to_file_sliced`, or None to never download in slices.
+    :type sliced_download_threshold_bytes: int | None
+    :param slice_size_bytes: Size of each slice, when downloading a blob in slices.
+    :type slice_size_bytes: int
+    :return: Dict of the "paths" each blob was downloaded to, as a dict of blob url -> file path, and the aggregate
+             throughput: the number of "bytes" downloaded, the elapsed "seconds", and the "bytes_per_second".
+    :rtype: dict
+    """
+    dest_paths = {url: os.path.join(dest_dir, os.path.basename(urlparse(url).path)) for url in blob_urls}
+    assert len(set(dest_paths.values())) == len(dest_paths), \
+        "Cannot download blobs with the same name to the same directory"
+    os.makedirs(dest_dir, exist_ok=True)
+
+    storage_client = get_storage_client(bucket_credentials_file_path)
+
+    def download(url):
+        blob = _blob_at_url(storage_client, url)
+        metadata_loaded = sliced_download_threshold_bytes is not None
+        if metadata_loaded:
+            _run_with_retries(blob.reload, f"Getting the metadata of blob '{url}'", max_retries, backoff_seconds)
+            if blob.size > sliced_download_threshold_bytes:
+                return _download_reloaded_blob_to_file_sliced(blob, url, dest_paths[url], slice_size_bytes,
+                                                              max_workers, max_retries, backoff_seconds)
+
+        def download_whole_blob():
+            with open(dest_paths[url], "wb") as f:
+                _download_blob_decompressed(blob, f, metadata_loaded)
+
+        _run_with_retries(download_whole_blob, f"Downloading blob '{url}'", max_retries, backoff_seconds)
+        return os.path.getsize(dest_paths[url])
+
+    log.info(f"Downloading {len(dest_paths)} blobs to '{dest_dir}' with {max_workers} workers...")
+    start = time.perf_counter()
+    total_bytes = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download, url): url for url in dest_paths}
+        for i, future in enumerate(as_completed(futures)):
+            total_bytes += future.result()
+            log.debug(f"Downloaded blob {i + 1}/{len(futures)}: '{futures[future]}'")
+
+    throughput = _get_throughput(f"Downloaded {len(dest_paths)} blobs", total_bytes, start)
+    return {"paths": dest_paths, **throughput}
+
+
+def upload_files(bucket_credentials_file_path, file_paths, target_prefix_url, max_workers=8, max_retries=3,
+                 backoff_seconds=1):
+    """
+    Uploads many files to Google Cloud Storage concurrently.
+
+    Each file is uploaded to a blob under `target_prefix_url`, with the same name as the file, using a resumable
+    upload. If a chunk of a file fails with a connection, timeout, or transient server error, that file's upload
+    continues from the last byte the server committed. See `upload_file_to_blob`.
+
+    Note that each worker thread uses a connection from the storage client's HTTP connection pool, so `max_workers`
+    should be at most the pool size set with `configure_storage_clients`.
+
+    :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
+    :type bucket_credentials_file_path: str
+    :param file_paths: Paths of the files to upload.
+    :type file_paths: list of str
+    :param target_prefix_url: gs URL of the prefix to upload the files under
+                              (i.e. of the form gs://<bucket-name>/<prefix>).
+    :type target_prefix_url: str
+    :param max_workers: Maximum number of files to upload at the same time.
+    :type max_workers: int
+    :param max_retries: Maximum number of consecutive times to retry a request for a file that failed without any
+                        more of the file being committed.
+    :type max_retries: int
+    :param backoff_seconds: Maximum backoff before the first retry of a request. The maximum doubles on each
+                            consecutive retry, and the actual backoff is chosen uniformly at random up to the maximum.
+    :type backoff_seconds: float
+    :return: Dict of the "urls" each file was uploaded to, as a dict of file path -> blob url, and the aggregate
+             throughput: the number of "bytes" uploaded, the elapsed "seconds", and the "bytes_per_second".
+    :rtype: dict
+    """
+    target_urls = {path: f"{target_prefix_url.rstrip('/')}/{os.path.basename(path)}" for path in file_paths}
+    assert len(set(target_urls.values())) == len(target_urls), \
+        "Cannot upload files with the same name to the same prefix"
+
+    log.info(f"Uploading {len(target_urls)} files to '{target_prefix_url}' with {max_workers} workers...")
+    throughput = _upload_files_to_urls(bucket_credentials_file_path, target_urls, max_workers, max_retries,
+                                       backoff_seconds)
+    return {"urls": target_urls, **throughput}
+
+
+def _upload_files_to_urls(bucket_credentials_file_path, target_urls, max_workers, max_retries, backoff_seconds):
+    """
+    Uploads files to blobs concurrently, with a resumable upload per file. See `upload_files`.
+
+    :return: Dict of the number of "bytes" uploaded, the elapsed "seconds", and the "bytes_per_second".
+    :rtype: dict of str -> float
+    """
+    def upload(path):
+        # Set the content type from the file name, as Blob.upload_from_filename does.
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        with open(path, "rb") as f:
+            upload_file_to_blob(bucket_credentials_file_path, target_urls[path], f, max_retries=max_retries,
+                                blob_chunk_size=DEFAULT_STREAM_CHUNK_SIZE_BYTES / 1024, content_type=content_type,
+                                initial_backoff_seconds=backoff_seconds)
+        return os.path.getsize(path)
+
+    start = time.perf_counter()
+    total_bytes = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(upload, path): path for path in target_urls}
+        for i, future in enumerate(as_completed(futures)):
+            total_bytes += future.result()
+            log.debug(f"Uploaded file {i + 1}/{len(futures)}: '{futures[future]}'")
+
+    return _get_throughput(f"Uploaded {len(target_urls)} files", total_bytes, start)
+
+
+def _hash_file_base64(file_path, hasher):
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(DEFAULT_STREAM_CHUNK_SIZE_BYTES)
+            if len(chunk) == 0:
+                break
+            hasher.update(chunk)
+    return base64.b64encode(hasher.digest()).decode("ascii")
+
+
+def _local_file_matches_blob(file_path, blob):
+    """
+    :param file_path: Path to a local file.
+    :type file_path: str
+    :param blob: Blob metadata, as yielded by `iterate_blobs`.
+    :type blob: dict
+    :return: Whether the file has the same contents as the blob, according to the blob's size and checksum.
+    :rtype: bool
+    """
+    if os.path.getsize(file_path) != blob["size"]:
+        return False
+    # Composite blobs don't have an MD5 hash, but every blob has a CRC32C checksum.
+    if blob["md5_hash"] is not None:
+        return _hash_file_base64(file_path, hashlib.md5()) == blob["md5_hash"]
+    return _hash_file_base64(file_path, google_crc32c.Checksum()) == blob["crc32c"]
+
+
+def sync_directory_to_prefix(bucket_credentials_file_path, dir_path, target_prefix_url, delete_remote=False,
+                             max_workers=8, max_retries=3, backoff_seconds=1, allow_delete_all=False):
+    """
+    Uploads the files in a local directory to a prefix in Google Cloud Storage, skipping files which are unchanged
+    since they were last uploaded.
+
+    The remote blobs' sizes and checksums are fetched with a single listing of the prefix, and each local file is
+    only checksummed if it is the same size as its blob. Files are uploaded to blobs named with their path relative
+    to `dir_path`, under `target_prefix_url`. New and changed files are uploaded concurrently, with each file retried
+    independently if it fails with a connection, timeout, or transient server error.
+
+    :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
+    :type bucket_credentials_file_path: str
+    :param dir_path: Path to the directory to upload. All files in its subdirectories are uploaded too.
+    :type dir_path: str
+    :param target_prefix_url: gs URL of the prefix to sync the directory to
+                              (i.e. of the form gs://<bucket-name>/<prefix>).
+    :type target_prefix_url: str
+    :param delete_remote: Whether to delete blobs under the prefix which don't have a corresponding local file.
+    :type delete_remote: bool
+    :param max_workers: Maximum number of files to upload or blobs to delete at the same time.
+    :type max_workers: int
+    :param max_retries: Maximum number of times to retry deleting each blob, or to consecutively retry a request to
+                        upload a file without any more of the file being committed.
+    :type max_retries: int
+    :param backoff_seconds: Maximum backoff before the first retry. The maximum doubles on each consecutive retry, and
+                            the actual backoff is chosen uniformly at random up to the maximum.
+    :type backoff_seconds: float
+    :param allow_delete_all: Whether to allow `delete_remote` to delete every blob under the prefix, when the directory
+                             is empty. If False, syncing an empty directory with `delete_remote` raises a ValueError
+                             instead, in case the directory was emptied by mistake.
+    :type allow_delete_all: bool
+    :return: Dict of the "uploaded" file paths, "skipped" file paths, and "deleted" blob URLs, and the number of
+             "uploaded_bytes" and "skipped_bytes".
+    :rtype: dict
+    :raises NotADirectoryError: If `dir_path` isn't an existing directory.
+    :raises ValueError: If `delete_remote` would delete every blob under the prefix, and `allow_delete_all` is False.
+    """
+    # os.walk yields nothing for a path which doesn't exist, which would otherwise sync it as an empty directory.
+    if not os.path.isdir(dir_path):
+        raise NotADirectoryError(f"Can't sync '{dir_path}' to '{target_prefix_url}', because it isn't a directory")
+
+    parsed_prefix_url = urlparse(target_prefix_url)
+    bucket_url = f"gs://{parsed_prefix_url.netloc}"
+    prefix = parsed_prefix_url.path.strip("/")
+    if prefix != "":
+        prefix += "/"
+
+    log.info(f"Syncing directory '{dir_path}' to '{target_prefix_url}'...")
+    local_paths = dict()  # of blob name -> local file path
+    for root, _, file_names in os.walk(dir_path):
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            relative_path = os.path.relpath(path, dir_path).replace(os.sep, "/")
+            local_paths[prefix + relative_path] = path
+
+    remote_blobs = {
+        blob["name"]: blob for blob in iterate_blobs(bucket_credentials_file_path, bucket_url, prefix,
+                                                     fields=["name", "size", "crc32c", "md5Hash"])
+    }
+    log.info(f"Found {len(local_paths)} local files and {len(remote_blobs)} remote blobs")
+    if delete_remote and len(local_paths) == 0 and len(remote_blobs) > 0 and not allow_delete_all:
+        raise ValueError(f"Refusing to delete all {len(remote_blobs)} blobs under '{target_prefix_url}', because "
+                         f"directory '{dir_path}' is empty. Pass allow_delete_all=True to delete them")
+
+    target_urls = dict()  # of local file path -> blob url
+    skipped = []
+    skipped_bytes = 0
+    for blob_name, path in sorted(local_paths.items()):
+        if blob_name in remote_blobs and _local_file_matches_blob(path, remote_blobs[blob_name]):
+            skipped.append(path)
+            skipped_bytes += remote_blobs[blob_name]["size"]
+        else:
+            target_urls[path] = f"{bucket_url}/{blob_name}"
+
+    uploaded_bytes = 0
+    if len(target_urls) > 0:
+        log.info(f"Uploading {len(target_urls)} new or changed files with {max_workers} workers...")
+        uploaded_bytes = _upload_files_to_urls(bucket_credentials_file_path, target_urls, max_workers, max_retries,
+                                               backoff_seconds)["bytes"]
+
+    deleted = []
+    if delete_remote:
+        deleted = [f"{bucket_url}/{blob_name}" for blob_name in sorted(remote_blobs.keys() - local_paths.keys())]
+        if len(deleted) > 0:
+            log.info(f"Deleting {len(deleted)} blobs which no longer exist locally...")
+            storage_client = get_storage_client(bucket_credentials_file_path)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(_run_with_retries, _blob_at_url(storage_client, url).delete,
+                                    f"Deleting blob '{url}'", max_retries, backoff_seconds)
+                    for url in deleted
+                ]
+                for future in as_completed(futures):
+                    future.result()
+
+    log.info(f"Synced directory '{dir_path}' to '{target_prefix_url}': uploaded {len(target_urls)} files "
+             f"({uploaded_bytes} bytes), skipped {len(skipped)} unchanged files ({skipped_bytes} bytes), and "
+             f"deleted {len(deleted)} blobs")
+    return {
+        "uploaded": sorted(target_urls.keys()),
+        "skipped": skipped,
+        "deleted": deleted,
+        "uploaded_bytes": uploaded_bytes,
+        "skipped_bytes": skipped_bytes
+    }
+
+
+def open_blob_for_reading(bucket_credentials_file_path, blob_url, encoding=None,
+                          chunk_size=DEFAULT_STREAM_CHUNK_SIZE_BYTES):
+    """
+    Opens a Google Cloud Storage blob as a file-like object, which downloads the blob in chunks as it is read.
+
+    Only one chunk of the blob is held in memory at a time, so this can read blobs of any size. Reads are pinned to
+    the generation of the blob which existed when it was opened, so the data read can't be a mix of two versions of
+    the blob if it is overwritten while it is being read. Blobs which were uploaded with one of the `COMPRESSIONS` are
+    decompressed as they are read.
+
+    Use as a context manager, e.g.
+
+    >>> with open_blob_for_reading(credentials_file_path, blob_url, encoding="utf-8") as f:
+    >>>     for line in f:
+    >>>         ...
+
+    :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
+    :type bucket_credentials_file_path: str
+    :param blob_url: gs URL to the blob to read (i.e. of the form gs://<bucket-name>/<blob-name>).
+    :type blob_url: str
+    :param encoding: Encoding to decode the blob with, or None to read bytes.
+    :type encoding: str | None
+    :param chunk_size: Number of bytes to download at a time.
+    :type chunk_size: int
+    :return: Readable file-like object, in text mode if an `encoding` was given, otherwise in binary mode.
+    :rtype: file-like
+    """
+    storage_client = get_storage_client(bucket_credentials_file_path)
+    blob = _blob_at_url(storage_client, blob_url)
+    blob.reload()
+    content_encoding = blob.content_encoding
+    blob = blob.bucket.blob(blob.name, generation=blob.generation)
+    if content_encoding in COMPRESSIONS:
+        # Read the stored bytes as they are, because the client library can't decode a compressed blob in chunks.
+        f = _open_decompressing_reader(blob.open("rb", chunk_size=chunk_size, raw_download=True), content_encoding)
+    else:
+        f = blob.open("rb", chunk_size=chunk_size)
+    if encoding is not None:
+        f = io.TextIOWrapper(f, encoding=encoding, newline="")
+    return f
+
+
+class _AbortOnErrorWriter(object):
+    """
+    Wraps a writable file-like object which uploads to a blob, so that the upload is only finished when this is
+    closed. Leaving a `with` block because of an exception, or never closing this, so that the file is only closed
+    when it is garbage collected, aborts the upload instead of finishing it with the data written so far.
+    """
+
+    def __init__(self, f, blob_writer):
+        """
+        :param f: File-like object to write to. Closing it closes `blob_writer`.
+        :type f: file-like
+        :param blob_writer: Writer which uploads the data written to `f`.
+        :type blob_writer: _ResumableBlobWriter
+        """
+        self._f = f
+        self._blob_writer = blob_writer
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def close(self):
+        self._blob_writer.finish_on_close = True
+        try:
+            self._f.close()
+        except BaseException:
+            # A compressing writer leaves the blob writer open if it fails, so that the upload can be aborted here.
+            self._blob_writer.abort()
+            self._blob_writer.close()
+            raise
+
+    def abort(self):
+        self._blob_writer.abort()
+        self._f.close()
+
+
+def open_blob_for_writing(bucket_credentials_file_path, target_blob_url, encoding=None,
+                          content_type="application/octet-stream", chunk_size=DEFAULT_STREAM_CHUNK_SIZE_BYTES,
+                          compression=None):
+    """
+    Opens a Google Cloud Storage blob as a file-like object, which uploads the data written to it in chunks using a
+    resumable upload.
+
+    Only one chunk of data is held in memory at a time, so this can write blobs of any size. The blob is only
+    created or replaced when the file is closed. If a `with` block using the file raises an exception, the upload
+    fails, or the file is garbage collected without being closed, the upload is cancelled instead, leaving any existing
+    blob unchanged. To cancel an upload when not using a `with` block, call the file's `abort` method instead of
+    closing it.
+
+    If a `compression` is given, the data is compressed as it is written, and only compressed chunks are held in
+    memory.
+
+    Use as a context manager, e.g.
+
+    >>> with open_blob_for_writing(credentials_file_path, blob_url, encoding="utf-8") as f:
+    >>>     for line in lines:
+    >>>         f.write(line)
+
+    :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
+    :type bucket_credentials_file_path: str
+    :param target_blob_url: gs URL to the blob to write (i.e. of the form gs://<bucket-name>/<blob-name>).
+    :type target_blob_url: str
+    :param encoding: Encoding to encode text written to the blob with, or None to write bytes.
+    :type encoding: str | None
+    :param content_type: Content type to set on the uploaded blob.
+    :type content_type: str
+    :param chunk_size: Number of bytes to upload at a time. Must be a multiple of 256 KiB.
+    :type chunk_size: int
+    :param compression: One of `COMPRESSIONS` to compress the blob with, or None to upload it uncompressed.
+    :type compression: str | None
+    :return: Writable file-like object, in text mode if an `encoding` was given, otherwise in binary mode, with an
+             additional `abort` method.
+    :rtype: file-like
+    """
+    assert chunk_size % _RESUMABLE_UPLOAD_CHUNK_MULTIPLE == 0, "chunk_size must be a multiple of 256 KiB"
+    _check_compression(compression)
+
+    session = _get_authorized_session(bucket_credentials_file_path)
+    blob_writer = _ResumableBlobWriter(session, target_blob_url, content_type, compression, chunk_size)
+    f = blob_writer
+    if compression is not None:
+        f = _open_compressing_writer(f, compression)
+    if encoding is not None:
+        f = io.TextIOWrapper(f, encoding=encoding, newline="")
+    return _AbortOnErrorWriter(f, blob_writer)
+
+
+def iterate_blob_lines(bucket_credentials_file_path, blob_url, encoding="utf-8",
+                       chunk_size=DEFAULT_STREAM_CHUNK_SIZE_BYTES):
+    """
+    Iterates over the lines of a text Google Cloud Storage blob, downloading and decoding the blob incrementally.
+
+    :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
+    :type bucket_credentials_file_path: str
+    :param blob_url: gs URL to the blob to read (i.e. of the form gs://<bucket-name>/<blob-name>).
+    :type blob_url: str
+    :param encoding: Encoding of the blob.
+    :type encoding: str
+    :param chunk_size: Number of bytes to download at a time.
+    :type chunk_size: int
+    :return: Generator of the lines in the blob, without their line endings.
+    :rtype: generator of str
+    """
+    with open_blob_for_reading(bucket_credentials_file_path, blob_url, encoding, chunk_size) as f:
+        for line in f:
+            yield line.rstrip("\r\n")
+
+
+def iterate_blob_jsonl_records(bucket_credentials_file_path, blob_url, encoding="utf-8",
+                               chunk_size=DEFAULT_STREAM_CHUNK_SIZE_BYTES):
+    """
+    Iterates over the records in a JSON lines Google Cloud Storage blob, downloading and decoding the blob
+    incrementally. Blank lines are skipped.
+
+    :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
+    :type bucket_credentials_file_path: str
+    :param blob_url: gs URL to the blob to read (i.e. of the form gs://<bucket-name>/<blob-name>).
+    :type blob_url: str
+    :param encoding: Encoding of the blob.
+    :type encoding: str
+    :param chunk_size: Number of bytes to download at a time.
+    :type chunk_size: int
+    :return: Generator of the records in the blob.
+    :rtype: generator of any
+    """
+    for line in iterate_blob_lines(bucket_credentials_file_path, blob_url, encoding, chunk_size):
+        if line.strip() == "":
+            continue
+        yield json.loads(line)
+
+
+def write_blob_jsonl_records(bucket_credentials_file_path, target_blob_url, records, encoding="utf-8",
+                             chunk_size=DEFAULT_STREAM_CHUNK_SIZE_BYTES, compression=None):
+    """
+    Writes records to a Google Cloud Storage blob as JSON lines, uploading in chunks as the records are serialized.
+
+    If serializing or uploading the records fails, the upload is cancelled, leaving any existing blob unchanged.
+
+    :param bucket_credentials_file_path: Path to a credentials file for accessing the bucket.
+    :type bucket_credentials_file_path: str
+    :param target_blob_url: gs URL to the blob to write (i.e. of the form gs://<bucket-name>/<blob-name>).
+    :type target_blob_url: str
+    :param records: JSON-serializable records to write. This may be a generator, in which case only one chunk of
+                    serialized records is held in memory at a time.
+    :type records: iterable of any
+    :param encoding: Encoding to write the blob with.
+    :type encoding: str
+    :param chunk_size: Number of bytes to upload at a time. Must be a multiple of 256 KiB.
+    :type chunk_size: int
+    :param compression: One of `COMPRESSIONS` to compress the blob with, or None to upload it uncompressed.
+    :type compression: str | None
+    :return: Number of records written.
+    :rtype: int
+    """
+    log.info(f"Writing JSONL records to blob '{target_blob_url}'...")
+    record_count = 0
+    with open_blob_for_writing(bucket_credentials_file_path, target_blob_url, encoding,
+                               "application/x-ndjson", chunk_size, compression) as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+            record_count += 1
+    log.info(f"Wrote {record_count} JSONL records to blob")
 
-    return blob_names
+    return record_count
@@ -1,49 +1,131 @@
+import hashlib
+import json
 import os
+import threading
 import time
 import socket
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import google.oauth2.service_account
-import googleapiclient.discovery
 from core_data_modules.logging import Logger
-from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
+
+from storage.google_drive.folder_id_cache import FolderIdCache
+from util.lazy_imports import LazyModule
+
+service_account = LazyModule("google.oauth2.service_account")
+discovery = LazyModule("googleapiclient.discovery")
+errors = LazyModule("googleapiclient.errors")
+http = LazyModule("googleapiclient.http")
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ["https://www.googleapis.com/auth/drive"]
 DRIVE_FOLDER_TYPE = "application/vnd.google-apps.folder"
 
-_drive_service = None
+# Maximum number of calls Drive accepts in one HTTP batch request.
+_MAX_BATCH_SIZE = 100
+
+_credentials = None
+_thread_local = threading.local()
+_service_account_email = None
+_folder_id_cache = FolderIdCache()
+# Held while looking up a target folder path again after its cached id turned out to be stale, so that concurrent
+# uploads to the same path don't each create a new folder.
+_folder_lookup_lock = threading.Lock()
+
+_upload_chunk_size_bytes = 8 * 1024 * 1024
+_upload_session_dir = None
+_upload_sessions_lock = threading.Lock()
+_upload_sessions = dict()  # of upload key -> resumable session URI, for uploads which haven't finished yet
 
 log = Logger(__name__)
 
 
+def configure_folder_id_cache(ttl_seconds=600, cache_file_path=None):
+    """
+    Sets how the ids of folders on upload paths are cached. By default, they are cached in memory for 10 minutes.
+
+    :param ttl_seconds: Number of seconds to use a cached folder id for. Set to 0 to disable caching.
+    :type ttl_seconds: float
+    :param cache_file_path: Path to a JSON file to persist the cache to, so that later runs can reuse it, or None to
+                            only cache in memory.
+    :type cache_file_path: str | None
+    """
+    global _folder_id_cache
+    _folder_id_cache = FolderIdCache(ttl_seconds, cache_file_path)
+
+
+def configure_uploads(chunk_size_bytes=8 * 1024 * 1024, upload_session_dir=None):
+    """
+    Sets how files are uploaded to Drive.
+
+    Files are uploaded in chunks, using a resumable upload session. If an upload fails part way through, retrying it
+    continues from the last chunk Drive received. By default, upload sessions are only remembered by this process.
+    If an `upload_session_dir` is given, they are also saved there, so that if this process is restarted, a later
+    upload of the same, unmodified file to the same target continues where the previous upload stopped.
+
+    :param chunk_size_bytes: Number of bytes to upload per request. Must be a multiple of 256 KiB.
+    :type chunk_size_bytes: int
+    :param upload_session_dir: Directory to save upload sessions in, or None to not save them. This is created if it
+                               doesn't exist.
+    :type upload_session_dir: str | None
+    """
+    global _upload_chunk_size_bytes, _upload_session_dir
+
+    assert chunk_size_bytes % (256 * 1024) == 0, "chunk_size_bytes must be a multiple of 256 KiB"
+    if upload_session_dir is not None:
+        # Upload session URIs allow uploading to the target without credentials, so keep them private.
+        os.makedirs(upload_session_dir, mode=0o700, exist_ok=True)
+    _upload_chunk_size_bytes = chunk_size_bytes
+    _upload_session_dir = upload_session_dir
+
+
 def init_client_from_file(service_account_credentials_file):
-    global _drive_service
+    global _credentials
 
-    credentials = google.oauth2.service_account.Credentials.from_service_account_file(service_account_credentials_file,
-                                                                                      scopes=SCOPES)
+    credentials = service_account.Credentials.from_service_account_file(service_account_credentials_file,
+                                                                        scopes=SCOPES)
     if not credentials:
         log.error(f"Failed to get credentials from file '{service_account_credentials_file}'")
         exit(1)
 
-    _drive_service = googleapiclient.discovery.build('drive', 'v3', credentials=credentials)
+    _credentials = credentials
+    _set_service_account_email(credentials)
 
 
 def init_client_from_info(service_account_credentials_info):
-    global _drive_service
+    global _credentials
 
-    credentials = google.oauth2.service_account.Credentials.from_service_account_info(service_account_credentials_info,
-                                                                                      scopes=SCOPES)
+    credentials = service_account.Credentials.from_service_account_info(service_account_credentials_info,
+                                                                        scopes=SCOPES)
     if not credentials:
         log.error("Failed to get credentials from dict")
         exit(1)
 
-    _drive_service = googleapiclient.discovery.build('drive', 'v3', credentials=credentials)
+    _credentials = credentials
+    _set_service_account_email(credentials)
+
+
+def _get_drive_service():
+    """
+    Gets the Drive service for the current thread.
+
+    Each thread has its own service, because a service's httplib2 transport isn't thread-safe.
+    """
+    assert _credentials is not None, "Drive client not initialised. Call init_client_from_file or init_client_from_info"
+    if getattr(_thread_local, "credentials", None) is not _credentials:
+        _thread_local.drive_service = discovery.build('drive', 'v3', credentials=_credentials)
+        _thread_local.credentials = _credentials
+    return _thread_local.drive_service
+
+
+def _set_service_account_email(credentials):
+    # Folder ids are cached per account, because each account has its own root and shared-with-me folders.
+    global _service_account_email
+    _service_account_email = credentials.service_account_email
 
 
 def _get_root_id():
     log.info("Getting id of drive root folder...")
-    return _drive_service.files().get(fileId='root').execute().get('id')
+    return _get_drive_service().files().get(fileId='root').execute().get('id')
 
 
 def _list_folder_id(folder_id):
@@ -52,6 +134,8 @@ def _list_folder_id(folder_id):
         'name': ''
         'id': '',
         'mimeType': '',
+        'md5Checksum': '',  (only for files with binary content, not folders or Google Docs)
+        'size': '',
     }
     """
     children = []
@@ -60,10 +144,10 @@ def _list_folder_id(folder_id):
     log.info(f"Getting children of folder with id '{folder_id}'...")
     page_count = 1
     while True:
-        response = _drive_service.files().list(
-            q=f"'{folder_id}' in parents",
+        response = _get_drive_service().files().list(
+            q=f"'{folder_id}' in parents and trashed = false",
             spaces='drive',
-            fields='nextPageToken, files(id, name, mimeType)',
+            fields='nextPageToken, files(id, name, mimeType, md5Checksum, size)',
             pageToken=page_token).execute()
         log.info(f"Getting children of folder with id '{folder_id}' - got page {page_count}")
         for file in response.get("files", []):
@@ -76,10 +160,35 @@ def _list_folder_id(folder_id):
     return children
 
 
+def _is_unchanged(source_file_path, existing_file):
+    """
+    :param source_file_path: Path to a local file.
+    :type source_file_path: str
+    :param existing_file: Drive file, as returned by `_list_folder_id`.
+    :type existing_file: dict
+    :return: Whether the Drive file has the same contents as the local file.
+    :rtype: bool
+    """
+    if existing_file.get("md5Checksum") is None or existing_file.get("size") is None:
+        return False
+    # Compare sizes first, so that changed files can usually be detected without hashing them.
+    if int(existing_file["size"]) != os.path.getsize(source_file_path):
+        return False
+
+    md5 = hashlib.md5()
+    with open(source_file_path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if len(chunk) == 0:
+                break
+            md5.update(chunk)
+    return md5.hexdigest() == existing_file["md5Checksum"]
+
+
 def _get_folder_id(name, parent_id, recursive=False):
     log.info(f"Getting id of folder '{name}' under parent with id '{parent_id}'...")
-    response = _drive_service.files().list(
-        q=f"name='{name}' and '{parent_id}' in parents and mimeType='{DRIVE_FOLDER_TYPE}'",
+    response = _get_drive_service().files().list(
+        q=f"name='{name}' and '{parent_id}' in parents and mimeType='{DRIVE_FOLDER_TYPE}' and trashed = false",
         spaces='drive',
         fields='files(id)').execute()
     files = response.get('files', [])
@@ -102,8 +211,8 @@ def _get_folder_id(name, parent_id, recursive=False):
 
 def _get_shared_folder_id(name):
     log.info(f"Getting id of shared-with-me folder '{name}'...")
-    response = _drive_service.files().list(
-        q=f"name='{name}' and sharedWithMe=true and mimeType='{DRIVE_FOLDER_TYPE}'",
+    response = _get_drive_service().files().list(
+        q=f"name='{name}' and sharedWithMe=true and mimeType='{DRIVE_FOLDER_TYPE}' and trashed = false",
         spaces="drive",
         fields="files(id)").execute()
     files = response.get("files", [])
@@ -120,20 +229,85 @@ def _get_shared_folder_id(name):
     return folder_id
 
 
+def _path_cache_key(folders, target_folder_is_shared_with_me):
+    root = "shared-with-me" if target_folder_is_shared_with_me else "root"
+    return f"{_service_account_email}|{root}|" + "".join(f"/{folder}" for folder in folders)
+
+
+def _invalidate_cached_path_id(path, target_folder_is_shared_with_me=False):
+    # Invalidates every folder on the path, starting from its top folder, because the folder may have been deleted or
+    # trashed along with one of its parents.
+    _folder_id_cache.invalidate(_path_cache_key(_split_path(path)[:1], target_folder_is_shared_with_me))
+
+
+def _folder_exists(folder_id):
+    """
+    :param folder_id: Id of the folder to check.
+    :type folder_id: str
+    :return: Whether the folder exists and isn't in the trash.
+    :rtype: bool
+    """
+    try:
+        folder = _get_drive_service().files().get(fileId=folder_id, fields="id, trashed").execute()
+    except errors.HttpError as ex:
+        if ex.resp.status != 404:
+            raise ex
+        return False
+    return not folder.get("trashed", False)
+
+
+def _look_up_path_id_again(path, stale_folder_id, recursive, target_folder_is_shared_with_me):
+    """
+    Looks up the id of the folder at a path, after its cached id turned out to be for a deleted or trashed folder.
+    """
+    with _folder_lookup_lock:
+        # Another upload may already have looked the path up again.
+        folder_id = _get_path_id(path, recursive, target_folder_is_shared_with_me)
+        if folder_id == stale_folder_id:
+            log.warning(f"Folder with id '{stale_folder_id}' no longer exists, looking up the path '{path}' again...")
+            _invalidate_cached_path_id(path, target_folder_is_shared_with_me)
+            folder_id = _get_path_id(path, recursive, target_folder_is_shared_with_me)
+        return folder_id
+
+
 def _get_path_id(path, recursive=False, target_folder_is_shared_with_me=False):
     folders = _split_path(path)
 
-    if target_folder_is_shared_with_me:
-        if len(folders) == 0:
-            log.error("Missing target folder name which necessary when looking for a shared-with-me type folder")
-            exit(1)
-        folder_id = _get_shared_folder_id(folders[0])
-        folders.remove(folders[0])
-    else:
-        folder_id = _get_root_id()
+    if target_folder_is_shared_with_me and len(folders) == 0:
+        log.error("Missing target folder name which necessary when looking for a shared-with-me type folder")
+        exit(1)
+
+    # Start from the deepest folder on the path whose id is cached, and only look up the folders below it.
+    min_depth = 1 if target_folder_is_shared_with_me else 0
+    depth = len(folders)
+    folder_id = None
+    while depth >= min_depth:
+        folder_id = _folder_id_cache.get(_path_cache_key(folders[:depth], target_folder_is_shared_with_me))
+        if folder_id is not None:
+            break
+        depth -= 1
+    if folder_id is not None:
+        log.debug(f"Using cached id '{folder_id}' for Drive folder '/{'/'.join(folders[:depth])}'")
+
+    try:
+        if folder_id is None:
+            if target_folder_is_shared_with_me:
+                folder_id = _get_shared_folder_id(folders[0])
+                depth = 1
+            else:
+                folder_id = _get_root_id()
+                depth = 0
+            _folder_id_cache.set(_path_cache_key(folders[:depth], target_folder_is_shared_with_me), folder_id)
+
+        for i in range(depth, len(folders)):
+            folder_id = _get_folder_id(folders[i], folder_id, recursive)
+            _folder_id_cache.set(_path_cache_key(folders[:i + 1], target_folder_is_shared_with_me), folder_id)
+    except BaseException:
+        # The lookup may have failed because a cached folder was deleted or moved, so look the whole path up again
+        # next time. BaseException because a folder which isn't found exits.
+        _folder_id_cache.invalidate(_path_cache_key(folders[:depth], target_folder_is_shared_with_me))
+        raise
 
-    for folder in folders:
-        folder_id = _get_folder_id(folder, folder_id, recursive)
     return folder_id
 
 
@@ -154,20 +328,134 @@ def _add_folder(name, parent_id):
         "mimeType": DRIVE_FOLDER_TYPE,
         "parents": [parent_id],
     }
-    file = _drive_service.files().create(body=file_metadata,
-                                         fields="id").execute()
+    file = _get_drive_service().files().create(body=file_metadata,
+                                               fields="id").execute()
     log.info(f"Creating folder '{name}' under parent with id '{parent_id}' - done. Folder id is '{file.get('id')}'")
     return file.get('id')
 
 
-def _update_file(source_file_path, target_file_id):
-    media = MediaFileUpload(source_file_path,
-                            resumable=True)
+def _get_upload_key(source_file_path, target):
+    # Includes the file's size and modification time, so that a session is never resumed with a different file.
+    stat = os.stat(source_file_path)
+    return f"{_service_account_email}|{target}|{os.path.abspath(source_file_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+
+def _get_upload_session_file_path(upload_key):
+    return os.path.join(_upload_session_dir, hashlib.sha256(upload_key.encode("utf-8")).hexdigest() + ".json")
+
+
+def _get_upload_session(upload_key):
+    with _upload_sessions_lock:
+        if upload_key in _upload_sessions:
+            return _upload_sessions[upload_key]
+        if _upload_session_dir is None:
+            return None
+        session_file_path = _get_upload_session_file_path(upload_key)
+        if not os.path.exists(session_file_path):
+            return None
+        with open(session_file_path) as f:
+            saved_session = json.load(f)
+        return saved_session["resumable_uri"] if saved_session["upload_key"] == upload_key else None
 
+
+def _set_upload_session(upload_key, resumable_uri):
+    with _upload_sessions_lock:
+        if resumable_uri is None:
+            _upload_sessions.pop(upload_key, None)
+        else:
+            _upload_sessions[upload_key] = resumable_uri
+
+        if _upload_session_dir is None:
+            return
+        session_file_path = _get_upload_session_file_path(upload_key)
+        if resumable_uri is None:
+            if os.path.exists(session_file_path):
+                os.remove(session_file_path)
+            return
+        with open(session_file_path, "w") as f:
+            json.dump({"upload_key": upload_key, "resumable_uri": resumable_uri}, f)
+
+
+def _query_upload_progress(request, total_size):
+    """
+    Asks Drive how much of a resumable upload it has received, and sets the request to continue from there.
+
+    :param request: Upload request, with `resumable_uri` set to the session to resume.
+    :type request: googleapiclient.http.HttpRequest
+    :param total_size: Size of the file being uploaded, in bytes.
+    :type total_size: int
+    :return: Response to the completed upload if Drive has already received the whole file, otherwise None.
+    :rtype: dict | None
+    """
+    resp, content = request.http.request(request.resumable_uri, "PUT",
+                                         headers={"Content-Range": f"bytes */{total_size}"})
+    if resp.status in {200, 201}:
+        return json.loads(content)
+    if resp.status != 308:
+        raise errors.HttpError(resp, content, uri=request.resumable_uri)
+
+    # The Range header is of the form "bytes=0-<last byte received>", and is missing if nothing was received.
+    received_range = resp.get("range")
+    request.resumable_progress = 0 if received_range is None else int(received_range.split("-")[-1]) + 1
+    return None
+
+
+def _execute_chunked_upload(build_request, source_file_path, upload_key):
+    """
+    Runs a resumable upload request a chunk at a time, logging progress, and saving the upload session so that a
+    failed upload can be continued from the last chunk Drive received.
+
+    :param build_request: Function which builds the upload request from a media body.
+    :type build_request: Callable of (googleapiclient.http.MediaFileUpload) -> googleapiclient.http.HttpRequest
+    :param source_file_path: Path to the file to upload.
+    :type source_file_path: str
+    :param upload_key: Key to save the upload session under. See `_get_upload_key`.
+    :type upload_key: str
+    :return: Response to the completed upload.
+    :rtype: dict
+    """
+    while True:
+        request = build_request(http.MediaFileUpload(source_file_path, chunksize=_upload_chunk_size_bytes,
+                                                     resumable=True))
+        resumable_uri = _get_upload_session(upload_key)
+        resuming = resumable_uri is not None
+        if resuming:
+            log.info(f"Resuming the previous upload of '{source_file_path}'...")
+            request.resumable_uri = resumable_uri
+
+        response = None
+        try:
+            if resuming:
+                response = _query_upload_progress(request, os.path.getsize(source_file_path))
+            while response is None:
+                status, response = request.next_chunk()
+                if request.resumable_uri != resumable_uri:
+                    resumable_uri = request.resumable_uri
+                    _set_upload_session(upload_key, resumable_uri)
+                if status is not None:
+                    log.info(f"Uploading '{source_file_path}' - {status.progress():.0%} "
+                             f"({status.resumable_progress}/{status.total_size} bytes)")
+        except errors.HttpError as ex:
+            if ex.resp.status not in {404, 410}:
+                raise ex
+            # The upload session has expired, so it can't be continued.
+            _set_upload_session(upload_key, None)
+            if not resuming:
+                raise ex
+            log.warning(f"The previous upload session for '{source_file_path}' has expired, restarting the upload "
+                        f"from the beginning")
+            continue
+
+        _set_upload_session(upload_key, None)
+        return response
+
+
+def _update_file(source_file_path, target_file_id):
     log.info(f"Updating file with ID '{target_file_id}' with source file '{source_file_path}'...")
-    file = _drive_service.files().update(fileId=target_file_id,
-                                         media_body=media,
-                                         fields="name").execute()
+    file = _execute_chunked_upload(
+        lambda media: _get_drive_service().files().update(fileId=target_file_id, media_body=media, fields="name"),
+        source_file_path, _get_upload_key(source_file_path, f"update:{target_file_id}")
+    )
 
     log.info(
         f"Updating file with ID '{target_file_id}' with source file '{source_file_path}' - done. File name was "
@@ -183,32 +471,109 @@ def _create_file(source_file_path, target_folder_id, target_file_name=None):
         "name": target_file_name,
         "parents": [target_folder_id]
     }
-    media = MediaFileUpload(source_file_path,
-                            resumable=True)
 
     log.info(f"Creating file '{target_file_name}' in folder with ID '{target_folder_id}' "
              f"with source file '{source_file_path}'...")
-    file = _drive_service.files().create(body=file_metadata,
-                                         media_body=media,
-                                         fields="id").execute()
+    file = _execute_chunked_upload(
+        lambda media: _get_drive_service().files().create(body=file_metadata, media_body=media, fields="id"),
+        source_file_path, _get_upload_key(source_file_path, f"create:{target_folder_id}/{target_file_name}")
+    )
     log.info(f"Creating file '{target_file_name}' in folder with ID '{target_folder_id}' with source file "
              f"'{source_file_path}' - done. File id is '{file.get('id')}'")
 
 
-def _delete_file(file_id):
+def _is_retryable_error(ex):
+    if isinstance(ex, errors.HttpError):
+        return ex.resp.status in {500, 503}
+    return isinstance(ex, (socket.timeout, ConnectionError))
+
+
+def _execute_batch(build_requests, max_retries=2, backoff_seconds=1, retried_not_found_is_success=False):
     """
-    Permanently deletes a file, skipping the trash.
+    Executes Drive calls in as few HTTP batch requests as possible, retrying the calls which fail with a transient
+    error. If a whole batch request fails with a transient error, every call in it which hadn't completed is retried.
+    Calls with media bodies, i.e. uploads, can't be batched.
+
+    :param build_requests: Dict of call id -> function which builds the call's request from a Drive service.
+    :type build_requests: dict of str -> (Callable of (googleapiclient.discovery.Resource) ->
+                                          googleapiclient.http.HttpRequest)
+    :param max_retries: Maximum number of times to retry the calls which failed.
+    :type max_retries: int
+    :param backoff_seconds: Number of seconds to wait before the first retry. This doubles on each retry.
+    :type backoff_seconds: float
+    :param retried_not_found_is_success: Whether a retried call which fails with HTTP 404 succeeded, with a None
+                                         response. Set for deletes, because an attempt which seemed to fail may have
+                                         deleted the file.
+    :type retried_not_found_is_success: bool
+    :return: Dict of call id -> response.
+    :rtype: dict of str -> dict | None
     """
-    log.warning(f"Deleting file '{file_id}'...")
-    _drive_service.files().delete(fileId=file_id).execute()
-    log.info(f"Deleting file '{file_id}' - done.")
+    service = _get_drive_service()
+    responses = dict()
+    pending_ids = list(build_requests.keys())
+    retries = 0
+    while True:
+        failures = dict()  # of call id -> exception
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                responses[request_id] = response
+            elif retries > 0 and retried_not_found_is_success and isinstance(exception, errors.HttpError) and \
+                    exception.resp.status == 404:
+                responses[request_id] = None
+            else:
+                failures[request_id] = exception
+
+        for start in range(0, len(pending_ids), _MAX_BATCH_SIZE):
+            batch_ids = pending_ids[start:start + _MAX_BATCH_SIZE]
+            batch = service.new_batch_http_request(callback=callback)
+            for call_id in batch_ids:
+                batch.add(build_requests[call_id](service), request_id=call_id)
+            try:
+                batch.execute()
+            except (errors.HttpError, socket.timeout, ConnectionError) as ex:
+                if not _is_retryable_error(ex):
+                    raise ex
+                log.warning(f"Drive batch request failed with {type(ex).__name__}: {ex}")
+                for call_id in batch_ids:
+                    if call_id not in responses and call_id not in failures:
+                        failures[call_id] = ex
+
+        if len(failures) == 0:
+            return responses
+
+        non_retryable_errors = [ex for ex in failures.values() if not _is_retryable_error(ex)]
+        if len(non_retryable_errors) > 0:
+            raise non_retryable_errors[0]
+        if retries >= max_retries:
+            log.error(f"{len(failures)} batched Drive calls still failed after retrying the maximum number of times")
+            raise next(iter(failures.values()))
+
+        log.warning(f"{len(failures)} batched Drive calls failed with transient errors. Retrying them after "
+                    f"{backoff_seconds} seconds...")
+        time.sleep(backoff_seconds)
+        backoff_seconds *= 2
+        retries += 1
+        pending_ids = list(failures.keys())
+
+
+def _delete_files(file_ids, max_retries=2, backoff_seconds=1):
+    """
+    Permanently deletes files, skipping the trash, in batch requests.
+    """
+    log.warning(f"Deleting {len(file_ids)} files {file_ids}...")
+    _execute_batch(
+        {file_id: lambda service, file_id=file_id: service.files().delete(fileId=file_id) for file_id in file_ids},
+        max_retries, backoff_seconds, retried_not_found_is_success=True
+    )
+    log.info(f"Deleting {len(file_ids)} files - done.")
 
 
 def _auto_retry(f, max_retries=2, backoff_seconds=1):
     try:
         return f()
-    except (HttpError, socket.timeout) as ex:
-        if type(ex) == HttpError:
+    except (errors.HttpError, socket.timeout) as ex:
+        if type(ex) == errors.HttpError:
             if ex.resp.status not in {500, 503}:
                 raise ex
             log.warning(f"Drive call failed with HttpError {ex.resp.status}")
@@ -219,35 +584,85 @@ def _auto_retry(f, max_retries=2, backoff_seconds=1):
         if max_retries > 0:
             log.info(f"Retrying up to {max_retries} more times, after {backoff_seconds} seconds...")
             time.sleep(backoff_seconds)
-            _auto_retry(f, max_retries - 1, backoff_seconds * 2)
+            return _auto_retry(f, max_retries - 1, backoff_seconds * 2)
         else:
             log.error("Retried the maximum number of times")
             raise ex
 
 
-def update_or_create_batch(source_file_paths, target_folder_path, recursive=False,
-                           target_folder_is_shared_with_me=False, fix_duplicates=False,
-                           max_retries=2, backoff_seconds=1):
+def _get_target_folder(target_folder_path, recursive, target_folder_is_shared_with_me, max_retries, backoff_seconds):
+    """
+    Gets the id of the folder at a path, and the files in it.
+
+    If the folder's id was cached but the folder has since been deleted or trashed, its path is looked up again.
+    """
+    cached_folder_id = _folder_id_cache.get(_path_cache_key(_split_path(target_folder_path),
+                                                            target_folder_is_shared_with_me))
     target_folder_id = _auto_retry(lambda: _get_path_id(target_folder_path, recursive, target_folder_is_shared_with_me),
                                    max_retries, backoff_seconds)
+    # Listing a deleted or trashed folder succeeds with no files, so check the folder itself. This is only needed if
+    # its id came from the cache, because a folder which was just looked up exists.
+    if target_folder_id == cached_folder_id and \
+            not _auto_retry(lambda: _folder_exists(target_folder_id), max_retries, backoff_seconds):
+        stale_folder_id = target_folder_id
+        target_folder_id = _auto_retry(
+            lambda: _look_up_path_id_again(target_folder_path, stale_folder_id, recursive,
+                                           target_folder_is_shared_with_me),
+            max_retries, backoff_seconds)
     files = _auto_retry(lambda: _list_folder_id(target_folder_id), max_retries, backoff_seconds)
-    
-    for i, source_file_path in enumerate(source_file_paths):
-        log.info(f"Uploading file {i + 1}/{len(source_file_paths)}: {source_file_path}...")
-        
+    return target_folder_id, files
+
+
+def _create_file_in_target_folder(source_file_path, target_folder_id, target_file_name, target_folder_path, recursive,
+                                  target_folder_is_shared_with_me, max_retries, backoff_seconds):
+    try:
+        _auto_retry(lambda: _create_file(source_file_path, target_folder_id, target_file_name),
+                    max_retries, backoff_seconds)
+        return
+    except errors.HttpError as ex:
+        if ex.resp.status != 404:
+            raise ex
+
+    # The target folder was deleted after it was looked up, so look it up again and retry the upload once.
+    new_target_folder_id = _auto_retry(
+        lambda: _look_up_path_id_again(target_folder_path, target_folder_id, recursive,
+                                       target_folder_is_shared_with_me),
+        max_retries, backoff_seconds)
+    _auto_retry(lambda: _create_file(source_file_path, new_target_folder_id, target_file_name),
+                max_retries, backoff_seconds)
+
+
+def update_or_create_batch(source_file_paths, target_folder_path, recursive=False,
+                           target_folder_is_shared_with_me=False, fix_duplicates=False,
+                           max_retries=2, backoff_seconds=1, max_workers=4, skip_unchanged=True):
+    """
+    Uploads files to a Drive folder, replacing any existing files with the same names.
+
+    :return: Dict of the number of "uploaded_files", "uploaded_bytes", "skipped_files" and "skipped_bytes", where
+             skipped files are those which weren't uploaded because they were unchanged.
+    :rtype: dict of str -> int
+    """
+    target_folder_id, files = _get_target_folder(target_folder_path, recursive, target_folder_is_shared_with_me,
+                                                 max_retries, backoff_seconds)
+
+    # Decide what to do with every file before uploading any, so that any problems are found before making changes.
+    uploads = []  # of (source file path, id of the file to update or None to create a new file)
+    duplicate_file_ids = []
+    skipped_files = 0
+    skipped_bytes = 0
+    for source_file_path in source_file_paths:
         target_file_name = os.path.basename(source_file_path)
         files_with_upload_name = list(filter(lambda file: file.get('name') == target_file_name, files))
 
         if len(files_with_upload_name) > 1:
             log.warning(f"Multiple files with the same name '{source_file_path}' found in Drive folder.")
             if fix_duplicates:
-                log.warning("Deleting the duplicate files...")
                 for duplicate_file in files_with_upload_name:
                     # Make sure it's not a folder
                     if duplicate_file.get("mimetype") == DRIVE_FOLDER_TYPE:
                         log.error(f"Attempting to remove a folder with name '{target_file_name}'")
                         exit(1)
-                    _auto_retry(lambda: _delete_file(duplicate_file.get("id")), max_retries, backoff_seconds)
+                    duplicate_file_ids.append(duplicate_file.get("id"))
                 files_with_upload_name = []
             else:
                 log.error("I don't know which to update, aborting. To handle this automatically in future, set "
@@ -260,23 +675,62 @@ def update_or_create_batch(source_file_paths, target_folder_path, recursive=Fals
             if existing_file.get("mimetype") == DRIVE_FOLDER_TYPE:
                 log.error(f"Attempting to replace a folder with a file with name '{target_file_name}'")
                 exit(1)
-            _auto_retry(lambda: _update_file(source_file_path, existing_file.get("id")), max_retries, backoff_seconds)
+            if skip_unchanged and _is_unchanged(source_file_path, existing_file):
+                log.info(f"Skipping '{source_file_path}', because it is unchanged in Drive")
+                skipped_files += 1
+                skipped_bytes += os.path.getsize(source_file_path)
+                continue
+            uploads.append((source_file_path, existing_file.get("id")))
             continue
 
-        _auto_retry(lambda: _create_file(source_file_path, target_folder_id, target_file_name),
-                    max_retries, backoff_seconds)
+        uploads.append((source_file_path, None))
+
+    if len(duplicate_file_ids) > 0:
+        log.warning("Deleting the duplicate files...")
+        _delete_files(duplicate_file_ids, max_retries, backoff_seconds)
+
+    def upload(source_file_path, existing_file_id):
+        if existing_file_id is not None:
+            _auto_retry(lambda: _update_file(source_file_path, existing_file_id), max_retries, backoff_seconds)
+        else:
+            _create_file_in_target_folder(source_file_path, target_folder_id, os.path.basename(source_file_path),
+                                          target_folder_path, recursive, target_folder_is_shared_with_me, max_retries,
+                                          backoff_seconds)
+
+    # Each worker thread uploads with its own Drive service (see `_get_drive_service`).
+    log.info(f"Uploading {len(uploads)} files with {max_workers} workers...")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(upload, path, file_id): path for path, file_id in uploads}
+        for i, future in enumerate(as_completed(futures)):
+            future.result()
+            log.info(f"Uploaded file {i + 1}/{len(futures)}: {futures[future]}")
+
+    uploaded_bytes = sum(os.path.getsize(path) for path, _ in uploads)
+    log.info(f"Uploaded {len(uploads)} files ({uploaded_bytes} bytes), and skipped {skipped_files} unchanged files "
+             f"({skipped_bytes} bytes)")
+    return {
+        "uploaded_files": len(uploads),
+        "uploaded_bytes": uploaded_bytes,
+        "skipped_files": skipped_files,
+        "skipped_bytes": skipped_bytes
+    }
 
 
 def update_or_create(source_file_path, target_folder_path, target_file_name=None, recursive=False,
                      target_folder_is_shared_with_me=False, fix_duplicates=False,
-                     max_retries=2, backoff_seconds=1):
+                     max_retries=2, backoff_seconds=1, skip_unchanged=True):
+    """
+    Uploads a file to a Drive folder, replacing any existing file with the same name.
+
+    :return: Whether the file was uploaded. This is False if `skip_unchanged` is True and the file in Drive already
+             has the same contents.
+    :rtype: bool
+    """
     if target_file_name is None:
         target_file_name = os.path.basename(source_file_path)
 
-    target_folder_id = _auto_retry(
-        lambda: _get_path_id(target_folder_path, recursive, target_folder_is_shared_with_me),
-        max_retries, backoff_seconds)
-    files = _auto_retry(lambda: _list_folder_id(target_folder_id), max_retries, backoff_seconds)
+    target_folder_id, files = _get_target_folder(target_folder_path, recursive, target_folder_is_shared_with_me,
+                                                 max_retries, backoff_seconds)
 
     files_with_upload_name = list(filter(lambda file: file.get('name') == target_file_name, files))
 
@@ -289,7 +743,8 @@ def update_or_create(source_file_path, target_folder_path, target_file_name=None
                 if duplicate_file.get("mimetype") == DRIVE_FOLDER_TYPE:
                     log.error(f"Attempting to remove a folder with name '{target_file_name}'")
                     exit(1)
-                _auto_retry(lambda: _delete_file(duplicate_file.get("id")), max_retries, backoff_seconds)
+            _delete_files([duplicate_file.get("id") for duplicate_file in files_with_upload_name], max_retries,
+                          backoff_seconds)
             files_with_upload_name = []
         else:
             log.error("I don't know which to update, aborting. To handle this automatically in future, set "
@@ -302,8 +757,13 @@ def update_or_create(source_file_path, target_folder_path, target_file_name=None
         if existing_file.get("mimetype") == DRIVE_FOLDER_TYPE:
             log.error(f"Attempting to replace a folder with a file with name '{target_file_name}'")
             exit(1)
+        if skip_unchanged and _is_unchanged(source_file_path, existing_file):
+            log.info(f"Skipping '{source_file_path}', because it is unchanged in Drive "
+                     f"({os.path.getsize(source_file_path)} bytes)")
+            return False
         _auto_retry(lambda: _update_file(source_file_path, existing_file.get("id")), max_retries, backoff_seconds)
-        return
+        return True
 
-    _auto_retry(lambda: _create_file(source_file_path, target_folder_id, target_file_name),
-                max_retries, backoff_seconds)
+    _create_file_in_target_folder(source_file_path, target_folder_id, target_file_name, target_folder_path, recursive,
+                                  target_folder_is_shared_with_me, max_retries, backoff_seconds)
+    return True
@@ -0,0 +1,105 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+from core_data_modules.logging import Logger
+
+log = Logger(__name__)
+
+
+class FolderIdCache(object):
+    def __init__(self, ttl_seconds=600, cache_file_path=None):
+        """
+        Cache of Google Drive folder paths to folder ids, so that resolving a path doesn't need one Drive request per
+        folder on every upload.
+
+        Paths are given as keys of the form "<account>|<root>|/<folder>/<folder>...", where the root is either the
+        account's own Drive or a folder shared with it. Each entry expires `ttl_seconds` after it was cached.
+        Setting or invalidating a path also invalidates every path below it, because those folders may have been
+        under a different folder with the same path.
+
+        :param ttl_seconds: Number of seconds to use a cached folder id for.
+        :type ttl_seconds: float
+        :param cache_file_path: Path to a JSON file to persist the cache to, so that it can be reused by later runs,
+                                or None to only cache in memory. The file is created if it doesn't exist.
+        :type cache_file_path: str | None
+        """
+        self.ttl_seconds = ttl_seconds
+        self.cache_file_path = cache_file_path
+        self._lock = threading.Lock()
+        self._entries = dict()  # of path key -> {"folder_id": str, "cached_at": float}
+
+        if cache_file_path is not None and os.path.exists(cache_file_path):
+            try:
+                with open(cache_file_path) as f:
+                    self._entries = json.load(f)
+            except ValueError:
+                log.warning(f"Ignoring the Drive folder id cache in '{cache_file_path}', because it isn't valid JSON")
+
+    def _save(self):
+        if self.cache_file_path is None:
+            return
+        cache_dir = os.path.dirname(os.path.abspath(self.cache_file_path))
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self._entries, f)
+            os.replace(temp_path, self.cache_file_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def _remove_path_and_descendants(self, path_key):
+        removed = [key for key in self._entries if key == path_key or key.startswith(path_key + "/")]
+        for key in removed:
+            del self._entries[key]
+        return len(removed) > 0
+
+    def get(self, path_key):
+        """
+        :param path_key: Key of the folder path to look up.
+        :type path_key: str
+        :return: The cached id of the folder, or None if it isn't cached or has expired.
+        :rtype: str | None
+        """
+        with self._lock:
+            entry = self._entries.get(path_key)
+            if entry is None or time.time() - entry["cached_at"] > self.ttl_seconds:
+                return None
+            return entry["folder_id"]
+
+    def set(self, path_key, folder_id):
+        """
+        Caches the id of a folder, invalidating every path below it.
+
+        :param path_key: Key of the folder path.
+        :type path_key: str
+        :param folder_id: Id of the folder.
+        :type folder_id: str
+        """
+        with self._lock:
+            self._remove_path_and_descendants(path_key)
+            self._entries[path_key] = {"folder_id": folder_id, "cached_at": time.time()}
+            self._save()
+
+    def invalidate(self, path_key):
+        """
+        Removes a folder path, and every path below it, from the cache.
+
+        :param path_key: Key of the folder path to invalidate.
+        :type path_key: str
+        """
+        with self._lock:
+            if self._remove_path_and_descendants(path_key):
+                log.debug(f"Invalidated cached Drive folder ids under '{path_key}'")
+                self._save()
+
+    def clear(self):
+        """
+        Removes every folder from the cache.
+        """
+        with self._lock:
+            self._entries = dict()
+            self._save()
@@ -0,0 +1,125 @@
+import argparse
+import os
+import statistics
+import time
+
+from core_data_modules.logging import Logger
+
+from storage.google_cloud import google_cloud_utils
+
+log = Logger(__name__)
+
+
+def _available_compressions():
+    compressions = [None]
+    for compression in google_cloud_utils.COMPRESSIONS:
+        try:
+            google_cloud_utils._check_compression(compression)
+        except ImportError as ex:
+            log.warning(f"Not benchmarking {compression}: {ex}")
+            continue
+        compressions.append(compression)
+    return compressions
+
+
+def _median_seconds(f, repeats):
+    durations = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = f()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations), result
+
+
+def benchmark_file(google_cloud_credentials_file_path, target_prefix_url, file_path, compression, repeats,
+                   local_only):
+    """
+    Measures how well a file compresses, and how long it takes to upload and download with a compression.
+
+    :param google_cloud_credentials_file_path: Path to a credentials file for accessing the bucket.
+    :type google_cloud_credentials_file_path: str
+    :param target_prefix_url: gs URL of the prefix to upload benchmark blobs under. Each blob is deleted after it has
+                              been benchmarked.
+    :type target_prefix_url: str
+    :param file_path: Path of the file to benchmark.
+    :type file_path: str
+    :param compression: One of `google_cloud_utils.COMPRESSIONS`, or None to benchmark uncompressed transfers.
+    :type compression: str | None
+    :param repeats: Number of times to repeat each measurement. The median time is reported.
+    :type repeats: int
+    :param local_only: Whether to only measure compression, without uploading or downloading anything.
+    :type local_only: bool
+    :return: Dict of "stored_bytes", "compress_seconds", "upload_seconds" and "download_seconds". The transfer times
+             are None if `local_only` is True.
+    :rtype: dict
+    """
+    with open(file_path, "rb") as f:
+        data = f.read()
+
+    if compression is None:
+        compress_seconds, stored_bytes = 0, len(data)
+    else:
+        compress_seconds, compressed = _median_seconds(
+            lambda: google_cloud_utils._compress_bytes(data, compression), repeats)
+        stored_bytes = len(compressed)
+
+    if local_only:
+        return {"stored_bytes": stored_bytes, "compress_seconds": compress_seconds,
+                "upload_seconds": None, "download_seconds": None}
+
+    blob_url = f"{target_prefix_url.rstrip('/')}/{os.path.basename(file_path)}.{compression or 'uncompressed'}"
+
+    def upload():
+        with open(file_path, "rb") as f:
+            google_cloud_utils.upload_file_to_blob(google_cloud_credentials_file_path, blob_url, f,
+                                                   compression=compression)
+
+    upload_seconds, _ = _median_seconds(upload, repeats)
+    download_seconds, downloaded = _median_seconds(
+        lambda: google_cloud_utils.download_blob_to_bytes(google_cloud_credentials_file_path, blob_url), repeats)
+    assert downloaded == data, f"Downloaded blob '{blob_url}' doesn't match the uploaded file"
+
+    storage_client = google_cloud_utils.get_storage_client(google_cloud_credentials_file_path)
+    google_cloud_utils._blob_at_url(storage_client, blob_url).delete()
+
+    return {"stored_bytes": stored_bytes, "compress_seconds": compress_seconds,
+            "upload_seconds": upload_seconds, "download_seconds": download_seconds}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the stored size and transfer times of files uploaded to "
+                                                 "Google Cloud Storage with each of the supported compressions, "
+                                                 "for choosing a compression for pipeline outputs")
+
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="Number of times to repeat each measurement. The median time is reported")
+    parser.add_argument("--local-only", action="store_true",
+                        help="Only measure compression ratios and times, without uploading or downloading anything")
+
+    parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
+                        help="Path to a Google Cloud service account credentials file to use to access the "
+                             "benchmark bucket")
+    parser.add_argument("target_prefix_url", metavar="target-prefix-url",
+                        help="GS URL of a prefix to upload the benchmark blobs under, "
+                             "of the form gs://<bucket-name>/<prefix>")
+    parser.add_argument("file_paths", metavar="file-paths", nargs="+",
+                        help="Paths of representative files to benchmark e.g. exported messages, traced data, or "
+                             "analysis CSVs")
+
+    args = parser.parse_args()
+
+    compressions = _available_compressions()
+
+    print(f"{'Compression':<12} {'Bytes':>14} {'Ratio':>7} {'Compress (s)':>13} {'Upload (s)':>11} "
+          f"{'Download (s)':>13}  File")
+    for file_path in args.file_paths:
+        uncompressed_bytes = os.path.getsize(file_path)
+        for compression in compressions:
+            result = benchmark_file(args.google_cloud_credentials_file_path, args.target_prefix_url, file_path,
+                                    compression, args.repeats, args.local_only)
+            ratio = uncompressed_bytes / result["stored_bytes"] if result["stored_bytes"] > 0 else 1
+            upload = "-" if result["upload_seconds"] is None else f"{result['upload_seconds']:.2f}"
+            download = "-" if result["download_seconds"] is None else f"{result['download_seconds']:.2f}"
+            print(f"{compression or 'none':<12} {result['stored_bytes']:>14} {ratio:>7.2f} "
+                  f"{result['compress_seconds']:>13.2f} {upload:>11} {download:>13}  {file_path}")
@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from core_data_modules.logging import Logger
+
+log = Logger(__name__)
+
+# Modules of this package which short-lived tools and workers commonly import.
+DEFAULT_MODULES = [
+    "id_infrastructure.firestore_uuid_table",
+    "engagement_database",
+    "engagement_database.cold_storage",
+    "pipeline_logs",
+    "storage.google_cloud.google_cloud_utils",
+    "storage.google_drive.drive_client_wrapper",
+    "util.firestore_utils"
+]
+
+# SDKs which are slow to import, so must only be imported when a client is first constructed.
+HEAVY_MODULES = [
+    "firebase_admin",
+    "google.api_core",
+    "google.cloud.firestore",
+    "google.cloud.storage",
+    "google.oauth2",
+    "googleapiclient",
+    "grpc"
+]
+
+_MEASURE_SCRIPT = """
+import json
+import sys
+import time
+
+start = time.perf_counter()
+import {module}
+import_seconds = time.perf_counter() - start
+
+heavy_modules = {heavy_modules}
+print(json.dumps({{
+    "import_seconds": import_seconds,
+    "loaded_heavy_modules": [m for m in heavy_modules if m in sys.modules]
+}}))
+"""
+
+
+def measure_import(module, package_dir):
+    """
+    Imports a module in a fresh interpreter and measures how long the import took.
+
+    :param module: Name of the module to import.
+    :type module: str
+    :param package_dir: Directory to import this package from.
+    :type package_dir: str
+    :return: Dict of "import_seconds" and "loaded_heavy_modules", the heavy SDK modules which the import loaded.
+    :rtype: dict
+    """
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join([package_dir] + ([env["PYTHONPATH"]] if "PYTHONPATH" in env else []))
+    output = subprocess.run(
+        [sys.executable, "-c", _MEASURE_SCRIPT.format(module=module, heavy_modules=repr(HEAVY_MODULES))],
+        env=env, stdout=subprocess.PIPE, check=True
+    ).stdout
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures how long it takes to import this package's modules, and "
+                                                 "fails if any of them eagerly import the Google Cloud or Firebase "
+                                                 "SDKs, or take longer to import than a maximum time")
+
+    parser.add_argument("--modules", nargs="+", default=DEFAULT_MODULES,
+                        help="Modules to measure the import times of")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="Number of times to import each module. The median import time is reported")
+    parser.add_argument("--max-seconds", type=float, default=None,
+                        help="Maximum median import time allowed for each module. If not set, import times are "
+                             "only reported")
+
+    args = parser.parse_args()
+
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    failures = []
+    print(f"{'Median (ms)':>12} {'Max (ms)':>10}  Module")
+    for module in args.modules:
+        results = [measure_import(module, package_dir) for _ in range(args.repeats)]
+        import_seconds = [result["import_seconds"] for result in results]
+        median_seconds = statistics.median(import_seconds)
+        print(f"{median_seconds * 1000:>12.1f} {max(import_seconds) * 1000:>10.1f}  {module}")
+
+        loaded_heavy_modules = results[0]["loaded_heavy_modules"]
+        if len(loaded_heavy_modules) > 0:
+            failures.append(f"Importing '{module}' eagerly imported {', '.join(loaded_heavy_modules)}")
+        if args.max_seconds is not None and median_seconds > args.max_seconds:
+            failures.append(f"Importing '{module}' took {median_seconds:.3f}s, which is over the maximum of "
+                            f"{args.max_seconds}s")
+
+    for failure in failures:
+        log.error(failure)
+    if len(failures) > 0:
+        exit(1)
+    log.info("All import time checks passed")
@@ -6,6 +6,7 @@ from core_data_modules.cleaners import PhoneCleaner
 from core_data_modules.logging import Logger
 from id_infrastructure.firestore_uuid_table import FirestoreUuidTable
 from storage.google_cloud import google_cloud_utils
+from storage.google_cloud.blob_cache import BlobCache
 
 log = Logger(__name__)
 
@@ -14,6 +15,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="De-identifies a CSV by converting the phone numbers in "
                                                  "the specified column to avf phone ids")
 
+    parser.add_argument("--blob-cache-dir", metavar="blob-cache-dir",
+                        help="Directory to cache downloaded blobs in, so that later runs only download blobs which "
+                             "have changed")
+
     parser.add_argument("csv_input_path", metavar="recovered-csv-input-url",
                         help="Path to a CSV file to de-identify a column of")
     parser.add_argument("google_cloud_credentials_file_path", metavar="google-cloud-credentials-file-path",
@@ -37,9 +42,14 @@ if __name__ == "__main__":
     firebase_table_name = args.firebase_table_name
     column_to_de_identify = args.column_to_de_identify
     de_identified_csv_output_path = args.de_identified_csv_output_path
+    blob_cache_dir = args.blob_cache_dir
 
     log.info("Downloading Firestore UUID Table credentials...")
-    firestore_uuid_table_credentials = json.loads(google_cloud_utils.download_blob_to_string(
+    if blob_cache_dir is None:
+        download_blob_to_string = google_cloud_utils.download_blob_to_string
+    else:
+        download_blob_to_string = BlobCache(blob_cache_dir).download_blob_to_string
+    firestore_uuid_table_credentials = json.loads(download_blob_to_string(
         google_cloud_credentials_file_path,
         firebase_credentials_file_url
     ))
@@ -0,0 +1,29 @@
+import argparse
+
+from core_data_modules.logging import Logger
+
+from pipeline_logs.event_spool import EventSpool
+from pipeline_logs.firestore_pipeline_logger import replay_spool
+from util.firestore_utils import make_firestore_client
+
+log = Logger(__name__)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Uploads the pipeline log events in a local spool file to Firestore, "
+                                                 "for events that FirestorePipelineLogger couldn't write at the time")
+
+    parser.add_argument("--skip-legacy-event-logs", action="store_true",
+                        help="Only write events to the per-run pipeline log documents, not to the legacy per-event "
+                             "documents")
+    parser.add_argument("firestore_credentials_file_path", metavar="firestore-credentials-file-path",
+                        help="Path to the private credentials file for the Firebase account to write the pipeline "
+                             "logs to")
+    parser.add_argument("spool_path", metavar="spool-path",
+                        help="Path to the spool file to replay")
+
+    args = parser.parse_args()
+
+    client = make_firestore_client(args.firestore_credentials_file_path, "PipelineLogSpoolReplay")
+    replayed_count = replay_spool(client, EventSpool(args.spool_path), not args.skip_legacy_event_logs)
+    log.info(f"Replayed {replayed_count} events")
@@ -0,0 +1,289 @@
+import datetime
+import threading
+
+from core_data_modules.logging import Logger
+
+log = Logger(__name__)
+
+# Upper bounds of the latency histogram buckets, in seconds. Latencies above the last bound are only counted in the
+# implicit +Inf bucket.
+DEFAULT_LATENCY_BUCKETS_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Approximate per-value storage sizes, following Firestore's document size rules.
+_NUMBER_SIZE_BYTES = 8
+_GEO_POINT_SIZE_BYTES = 16
+_DOCUMENT_OVERHEAD_BYTES = 32
+
+
+def estimate_value_size(value):
+    """
+    Estimates the storage size of a Firestore field value, following Firestore's document size rules.
+
+    :param value: Field value, as it would be written to or read from Firestore.
+    :type value: any
+    :return: Estimated size in bytes.
+    :rtype: int
+    """
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float, datetime.datetime)):
+        return _NUMBER_SIZE_BYTES
+    if isinstance(value, str):
+        return len(value.encode("utf-8")) + 1
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(estimate_value_size(k) + estimate_value_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_value_size(v) for v in value)
+    if hasattr(value, "path"):
+        # DocumentReference
+        return len(value.path.encode("utf-8")) + 1
+    if hasattr(value, "latitude"):
+        # GeoPoint
+        return _GEO_POINT_SIZE_BYTES
+    # Sentinels such as SERVER_TIMESTAMP or ArrayUnion, whose stored size isn't known until they are applied.
+    return _NUMBER_SIZE_BYTES
+
+
+def estimate_document_size(path, data):
+    """
+    Estimates the storage size of a Firestore document, following Firestore's document size rules.
+
+    :param path: Path of the document.
+    :type path: str
+    :param data: Fields of the document.
+    :type data: dict
+    :return: Estimated size in bytes.
+    :rtype: int
+    """
+    return estimate_value_size(path) + estimate_value_size(data) + _DOCUMENT_OVERHEAD_BYTES
+
+
+def measure_read_result(result, measure_bytes=True):
+    """
+    Counts the documents returned by a Firestore read and estimates their size.
+
+    :param result: Result of a read: a document snapshot, or a list of document snapshots.
+    :type result: google.cloud.firestore.DocumentSnapshot | list of google.cloud.firestore.DocumentSnapshot
+    :param measure_bytes: Whether to estimate the size of the documents. If False, the returned size is 0.
+    :type measure_bytes: bool
+    :return: Tuple of (number of documents read, estimated total size of the documents in bytes).
+    :rtype: (int, int)
+    """
+    snapshots = [result] if hasattr(result, "exists") else result
+    if not measure_bytes:
+        return len(snapshots), 0
+
+    size_bytes = 0
+    for snapshot in snapshots:
+        # Missing documents are still charged as reads, but have no size.
+        if snapshot.exists:
+            size_bytes += estimate_document_size(snapshot.reference.path, snapshot.to_dict())
+    return len(snapshots), size_bytes
+
+
+class _OperationStats(object):
+    def __init__(self, bucket_bounds):
+        self.operations = 0
+        self.errors = 0
+        self.documents = 0
+        self.bytes = 0
+        self.latency_count = 0
+        self.latency_sum_seconds = 0
+        self.latency_bucket_counts = [0] * len(bucket_bounds)  # Non-cumulative count of latencies in each bucket
+        self.latency_overflow_count = 0
+
+
+class FirestoreMetrics(object):
+    def __init__(self, latency_buckets_seconds=DEFAULT_LATENCY_BUCKETS_SECONDS, measure_bytes=True):
+        """
+        Thread-safe counters and latency histograms of Firestore operations, grouped by method, collection, and
+        whether the operation reads or writes.
+
+        :param latency_buckets_seconds: Upper bounds of the latency histogram buckets, in ascending order.
+        :type latency_buckets_seconds: iterable of float
+        :param measure_bytes: Whether to estimate the size of the documents read and written. Estimating sizes
+                              requires walking every document, so this can be disabled to reduce CPU overhead.
+        :type measure_bytes: bool
+        """
+        self.latency_buckets_seconds = tuple(latency_buckets_seconds)
+        assert list(self.latency_buckets_seconds) == sorted(self.latency_buckets_seconds), \
+            "latency_buckets_seconds must be in ascending order"
+        self.measure_bytes = measure_bytes
+        self._stats = dict()  # of (method, collection, kind) -> _OperationStats
+        self._lock = threading.Lock()
+
+    def record(self, method, collection, kind, documents=0, size_bytes=0, latency_seconds=None, error=False):
+        """
+        Records a Firestore operation.
+
+        :param method: Name of the method which made the operation e.g. "EngagementDatabase.get_messages".
+        :type method: str
+        :param collection: Id of the collection the operation accessed e.g. "messages", or None if unknown.
+        :type collection: str | None
+        :param kind: Whether the operation read or wrote documents. One of util.firestore_operations.READ or WRITE.
+        :type kind: str
+        :param documents: Number of documents the operation read or wrote.
+        :type documents: int
+        :param size_bytes: Estimated size of the documents the operation read or wrote.
+        :type size_bytes: int
+        :param latency_seconds: How long the operation took, or None to not record a latency.
+        :type latency_seconds: float | None
+        :param error: Whether the operation failed.
+        :type error: bool
+        """
+        key = (method, collection, kind)
+        with self._lock:
+            if key not in self._stats:
+                self._stats[key] = _OperationStats(self.latency_buckets_seconds)
+            stats = self._stats[key]
+
+            stats.operations += 1
+            if error:
+                stats.errors += 1
+            stats.documents += documents
+            stats.bytes += size_bytes
+
+            if latency_seconds is not None:
+                stats.latency_count += 1
+                stats.latency_sum_seconds += latency_seconds
+                for i, bound in enumerate(self.latency_buckets_seconds):
+                    if latency_seconds <= bound:
+                        stats.latency_bucket_counts[i] += 1
+                        break
+                else:
+                    stats.latency_overflow_count += 1
+
+    def reset(self):
+        """
+        Clears all recorded operations.
+        """
+        with self._lock:
+            self._stats = dict()
+
+    def snapshot(self):
+        """
+        :return: The metrics recorded so far, as a list of dicts sorted by method, collection, and kind. Each dict
+                 contains the "method", "collection", "kind", the number of "operations", "errors", "documents" and
+                 "bytes", and "latency": a dict of the latency "count", "sum_seconds", "mean_seconds", and "buckets",
+                 a list of (upper bound seconds, cumulative count) tuples, ending with (inf, count).
+        :rtype: list of dict
+        """
+        with self._lock:
+            items = sorted(self._stats.items(), key=lambda item: tuple("" if k is None else k for k in item[0]))
+
+            snapshot = []
+            for (method, collection, kind), stats in items:
+                buckets = []
+                cumulative_count = 0
+                for bound, count in zip(self.latency_buckets_seconds, stats.latency_bucket_counts):
+                    cumulative_count += count
+                    buckets.append((bound, cumulative_count))
+                buckets.append((float("inf"), cumulative_count + stats.latency_overflow_count))
+
+                snapshot.append({
+                    "method": method,
+                    "collection": collection,
+                    "kind": kind,
+                    "operations": stats.operations,
+                    "errors": stats.errors,
+                    "documents": stats.documents,
+                    "bytes": stats.bytes,
+                    "latency": {
+                        "count": stats.latency_count,
+                        "sum_seconds": stats.latency_sum_seconds,
+                        "mean_seconds": (stats.latency_sum_seconds / stats.latency_count
+                                         if stats.latency_count > 0 else None),
+                        "buckets": buckets
+                    }
+                })
+
+        return snapshot
+
+    def to_prometheus_text(self, prefix="firestore"):
+        """
+        Formats the metrics recorded so far in the Prometheus text exposition format.
+
+        :param prefix: Prefix to give every metric name.
+        :type prefix: str
+        :return: Prometheus text exposition of the metrics.
+        :rtype: str
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def labels(entry, **extra_labels):
+            label_values = {
+                "method": entry["method"],
+                "collection": "" if entry["collection"] is None else entry["collection"],
+                "kind": entry["kind"]
+            }
+            label_values.update(extra_labels)
+            return ",".join(f'{k}="{_escape_label_value(v)}"' for k, v in label_values.items())
+
+        for name, key, help_text in [
+            ("operations_total", "operations", "Number of Firestore operations."),
+            ("errors_total", "errors", "Number of Firestore operations which failed."),
+            ("documents_total", "documents", "Number of documents read or written."),
+            ("bytes_total", "bytes", "Estimated size of the documents read or written, in bytes.")
+        ]:
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            for entry in snapshot:
+                lines.append(f"{prefix}_{name}{{{labels(entry)}}} {entry[key]}")
+
+        lines.append(f"# HELP {prefix}_latency_seconds Latency of Firestore operations, in seconds.")
+        lines.append(f"# TYPE {prefix}_latency_seconds histogram")
+        for entry in snapshot:
+            latency = entry["latency"]
+            for bound, count in latency["buckets"]:
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{prefix}_latency_seconds_bucket{{{labels(entry, le=le)}}} {count}")
+            lines.append(f"{prefix}_latency_seconds_sum{{{labels(entry)}}} {latency['sum_seconds']}")
+            lines.append(f"{prefix}_latency_seconds_count{{{labels(entry)}}} {latency['count']}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_text(self, path, prefix="firestore"):
+        """
+        Writes the metrics recorded so far to a file in the Prometheus text exposition format, e.g. for collection by
+        node_exporter's textfile collector.
+
+        :param path: Path of the file to write.
+        :type path: str
+        :param prefix: Prefix to give every metric name.
+        :type prefix: str
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus_text(prefix))
+        log.info(f"Wrote Firestore metrics to '{path}'")
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+_metrics = FirestoreMetrics()
+
+
+def configure_firestore_metrics(latency_buckets_seconds=DEFAULT_LATENCY_BUCKETS_SECONDS, measure_bytes=True):
+    """
+    Replaces the metrics which all Firestore operations made by this process are recorded to, clearing any metrics
+    recorded so far.
+
+    :param latency_buckets_seconds: See `FirestoreMetrics.__init__`.
+    :type latency_buckets_seconds: iterable of float
+    :param measure_bytes: See `FirestoreMetrics.__init__`.
+    :type measure_bytes: bool
+    """
+    global _metrics
+    _metrics = FirestoreMetrics(latency_buckets_seconds, measure_bytes)
+
+
+def get_firestore_metrics():
+    """
+    :return: The metrics which all Firestore operations made by this process are recorded to.
+    :rtype: FirestoreMetrics
+    """
+    return _metrics
@@ -0,0 +1,319 @@
+import random
+import socket
+import threading
+import time
+
+from core_data_modules.logging import Logger
+
+from util.firestore_metrics import get_firestore_metrics, measure_read_result
+from util.lazy_imports import LazyModule
+
+exceptions = LazyModule("google.api_core.exceptions")
+
+log = Logger(__name__)
+
+READ = "read"
+WRITE = "write"
+
+
+def _get_retryable_errors():
+    # Errors which indicate a transient problem, so the operation that raised them may succeed if retried.
+    # This is a function rather than a constant so that google.api_core is only imported when it is first needed.
+    return (
+        exceptions.Aborted,             # Contention with another transaction
+        exceptions.DeadlineExceeded,
+        exceptions.InternalServerError,
+        exceptions.ResourceExhausted,   # Quota or rate limit exceeded
+        exceptions.ServiceUnavailable,
+        exceptions.TooManyRequests,
+        exceptions.GatewayTimeout,
+        exceptions.Unknown,
+        ConnectionError,
+        socket.timeout
+    )
+
+
+def is_retryable_error(ex):
+    """
+    :param ex: Exception raised by a Firestore operation.
+    :type ex: Exception
+    :return: Whether the operation that raised `ex` may succeed if it is retried.
+    :rtype: bool
+    """
+    return isinstance(ex, _get_retryable_errors())
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity):
+        """
+        Thread-safe token bucket rate limiter.
+
+        :param rate: Number of tokens added to the bucket per second.
+        :type rate: float
+        :param capacity: Maximum number of tokens the bucket can hold, which is the largest burst allowed.
+        :type capacity: float
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self, tokens=1, deadline=None):
+        """
+        Blocks until the requested number of tokens are available, then takes them.
+
+        :param tokens: Number of tokens to take. Requests for more tokens than the bucket's capacity are capped at the
+                       capacity, so that they can eventually be served.
+        :type tokens: float
+        :param deadline: `time.monotonic()` time to give up waiting at, or None to wait indefinitely.
+        :type deadline: float | None
+        :raises TimeoutError: If the tokens couldn't be acquired before the deadline.
+        """
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_seconds = (tokens - self._tokens) / self.rate
+
+            if deadline is not None and time.monotonic() + wait_seconds > deadline:
+                raise TimeoutError("Deadline exceeded while waiting for rate limit tokens")
+            time.sleep(wait_seconds)
+
+    def consume(self, tokens):
+        """
+        Takes tokens from the bucket without waiting, for usage which was only known after an operation ran e.g. the
+        number of documents returned by a query. The bucket may go into debt, which delays later `acquire` calls.
+
+        :param tokens: Number of tokens to take.
+        :type tokens: float
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+
+
+class FirestoreOperationExecutor(object):
+    def __init__(self, reads_per_second=None, writes_per_second=None, burst_seconds=1, max_retries=5,
+                 initial_backoff_seconds=0.5, max_backoff_seconds=32, default_deadline_seconds=None):
+        """
+        Runs Firestore operations with rate limiting, retries of retryable errors, and deadlines, and records each
+        attempt to the process's Firestore metrics (see `util.firestore_metrics`).
+
+        One executor is shared by all the clients for a Firestore project (see `get_operation_executor`), so that the
+        rate limits apply to the project as a whole rather than per component.
+
+        :param reads_per_second: Maximum number of documents to read per second, or None for no limit.
+        :type reads_per_second: float | None
+        :param writes_per_second: Maximum number of documents to write per second, or None for no limit.
+        :type writes_per_second: float | None
+        :param burst_seconds: Number of seconds' worth of reads or writes that may be made in a single burst.
+        :type burst_seconds: float
+        :param max_retries: Default maximum number of times to retry an operation which failed with a retryable error.
+        :type max_retries: int
+        :param initial_backoff_seconds: Maximum backoff before the first retry. The maximum doubles on each retry,
+                                        and the actual backoff is chosen uniformly at random up to the maximum.
+        :type initial_backoff_seconds: float
+        :param max_backoff_seconds: Upper limit on the backoff before any retry.
+        :type max_backoff_seconds: float
+        :param default_deadline_seconds: Default maximum time an operation may take, including waiting for rate limits
+                                         and retries, or None for no deadline.
+        :type default_deadline_seconds: float | None
+        """
+        self._buckets = {
+            READ: None if reads_per_second is None else TokenBucket(reads_per_second,
+                                                                    reads_per_second * burst_seconds),
+            WRITE: None if writes_per_second is None else TokenBucket(writes_per_second,
+                                                                      writes_per_second * burst_seconds)
+        }
+        self.max_retries = max_retries
+        self.initial_backoff_seconds = initial_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.default_deadline_seconds = default_deadline_seconds
+
+    def get_backoff_seconds(self, retry):
+        """
+        :param retry: Number of retries made so far.
+        :type retry: int
+        :return: Jittered exponential backoff to wait before the next retry.
+        :rtype: float
+        """
+        return random.uniform(0, min(self.max_backoff_seconds, self.initial_backoff_seconds * 2 ** retry))
+
+    def acquire(self, kind, cost=1, deadline=None):
+        """
+        Blocks until the rate limit for `kind` allows an operation with the given cost.
+
+        :param kind: READ or WRITE.
+        :type kind: str
+        :param cost: Number of documents the operation will read or write.
+        :type cost: int
+        :param deadline: `time.monotonic()` time to give up waiting at, or None to wait indefinitely.
+        :type deadline: float | None
+        """
+        bucket = self._buckets[kind]
+        if bucket is not None:
+            bucket.acquire(cost, deadline)
+
+    def record_usage(self, kind, cost):
+        """
+        Records extra reads or writes against the rate limit, for usage which was only known after an operation ran.
+
+        :param kind: READ or WRITE.
+        :type kind: str
+        :param cost: Number of extra documents read or written.
+        :type cost: int
+        """
+        bucket = self._buckets[kind]
+        if bucket is not None and cost > 0:
+            bucket.consume(cost)
+
+    def execute(self, operation, kind, cost=1, deadline_seconds=None, max_retries=None, description="operation",
+                collection=None, size_bytes=0):
+        """
+        Runs a Firestore operation, waiting for the rate limit first, and retrying if it fails with a retryable error.
+
+        Only idempotent operations should be executed with retries, because an operation which failed with e.g.
+        DeadlineExceeded may have been applied. Operations which run inside a transaction should be executed with
+        `max_retries=0`, because transactions are retried as a whole.
+
+        The operation is given the time left before the deadline as its RPC timeout, so that a hung request can't
+        outlast the deadline.
+
+        Every attempt is recorded to the Firestore metrics. The documents read by a READ operation are counted and
+        measured from its result, which must be a document snapshot or a list of document snapshots. A WRITE
+        operation is recorded as writing `cost` documents of `size_bytes` total size.
+
+        :param operation: Function which runs the operation. This is called with a `timeout` keyword argument, which
+                          should be passed to the Firestore request as its timeout in seconds. The timeout is None if
+                          there is no deadline.
+        :type operation: Callable of (timeout: float | None) -> any
+        :param kind: Whether the operation reads or writes documents. One of READ or WRITE.
+        :type kind: str
+        :param cost: Number of documents the operation is expected to read or write.
+        :type cost: int
+        :param deadline_seconds: Maximum time this operation may take, including waiting for rate limits and retries.
+                                 If None, uses this executor's default deadline.
+        :type deadline_seconds: float | None
+        :param max_retries: Maximum number of times to retry the operation. If None, uses this executor's default.
+        :type max_retries: int | None
+        :param description: Name of the method which made the operation e.g. "EngagementDatabase.get_messages", for
+                            logging and metrics.
+        :type description: str
+        :param collection: Id of the collection the operation accesses, for metrics.
+        :type collection: str | None
+        :param size_bytes: Estimated size of the documents written by a WRITE operation, for metrics.
+        :type size_bytes: int
+        :return: The result of `operation`.
+        :rtype: any
+        :raises TimeoutError: If the deadline passed before the operation succeeded and no retryable error had been
+                              raised yet.
+        """
+        assert kind in {READ, WRITE}, kind
+        if deadline_seconds is None:
+            deadline_seconds = self.default_deadline_seconds
+        deadline = None if deadline_seconds is None else time.monotonic() + deadline_seconds
+        if max_retries is None:
+            max_retries = self.max_retries
+
+        metrics = get_firestore_metrics()
+        retry = 0
+        while True:
+            self.acquire(kind, cost, deadline)
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise TimeoutError(f"Deadline exceeded before Firestore operation {description} could be run")
+            start = time.perf_counter()
+            try:
+                result = operation(timeout=timeout)
+            except Exception as ex:
+                metrics.record(description, collection, kind, latency_seconds=time.perf_counter() - start, error=True)
+                if not is_retryable_error(ex) or retry >= max_retries:
+                    raise ex
+
+                backoff_seconds = self.get_backoff_seconds(retry)
+                if deadline is not None and time.monotonic() + backoff_seconds > deadline:
+                    log.warning(f"Firestore operation {description} failed with {type(ex).__name__} and there isn't "
+                                f"time to retry before its deadline")
+                    raise ex
+
+                retry += 1
+                log.warning(f"Firestore operation {description} failed with {type(ex).__name__}: {ex}. "
+                            f"Retrying in {backoff_seconds:.2f}s (retry {retry}/{max_retries})...")
+                time.sleep(backoff_seconds)
+                continue
+
+            latency_seconds = time.perf_counter() - start
+            if kind == READ:
+                documents, read_bytes = measure_read_result(result, metrics.measure_bytes)
+                metrics.record(description, collection, kind, documents, read_bytes, latency_seconds)
+            else:
+                metrics.record(description, collection, kind, cost, size_bytes, latency_seconds)
+            return result
+
+    def execute_query(self, run_query, deadline_seconds=None, max_retries=None, description="query",
+                      collection=None):
+        """
+        Runs a query with `execute`, as a read which is charged to the rate limit for every document it returned.
+
+        :param run_query: Function which runs the query and returns the resulting documents. This is called with a
+                          `timeout` keyword argument, as for the operation passed to `execute`.
+        :type run_query: Callable of (timeout: float | None) -> iterable of google.cloud.firestore.DocumentSnapshot
+        :param deadline_seconds: See `execute`.
+        :type deadline_seconds: float | None
+        :param max_retries: See `execute`.
+        :type max_retries: int | None
+        :param description: See `execute`.
+        :type description: str
+        :param collection: See `execute`.
+        :type collection: str | None
+        :return: Documents returned by the query.
+        :rtype: list of google.cloud.firestore.DocumentSnapshot
+        """
+        docs = self.execute(lambda timeout: list(run_query(timeout=timeout)), READ, 1, deadline_seconds, max_retries,
+                            description, collection)
+        self.record_usage(READ, len(docs) - 1)
+        return docs
+
+
+_executors_lock = threading.Lock()
+_executors = dict()  # of project id -> FirestoreOperationExecutor
+
+
+def configure_operation_executor(project, **kwargs):
+    """
+    Sets the rate limits and retry settings for all Firestore operations on a project made by this process.
+
+    :param project: Id of the Firestore project to configure.
+    :type project: str
+    :param kwargs: Arguments to construct the project's FirestoreOperationExecutor with.
+    """
+    with _executors_lock:
+        _executors[project] = FirestoreOperationExecutor(**kwargs)
+
+
+def get_operation_executor(client):
+    """
+    Gets the operation executor shared by all clients for the same Firestore project as `client`.
+    If the project hasn't been configured with `configure_operation_executor`, an executor with no rate limits and the
+    default retry settings is created.
+
+    :param client: Firestore client.
+    :type client: google.cloud.firestore.Client
+    :return: Operation executor for the client's project.
+    :rtype: FirestoreOperationExecutor
+    """
+    with _executors_lock:
+        if client.project not in _executors:
+            _executors[client.project] = FirestoreOperationExecutor()
+        return _executors[client.project]
@@ -1,34 +1,119 @@
-import firebase_admin
+import json
+import threading
+
 from core_data_modules.logging import Logger
-from firebase_admin import credentials, firestore
+
+from util.lazy_imports import LazyModule
+
+credentials = LazyModule("firebase_admin.credentials")
+firestore = LazyModule("google.cloud.firestore")
 
 log = Logger(__name__)
 
+_registry_lock = threading.Lock()
+_client_pools = dict()  # of credentials key -> _FirestoreClientPool
+_pool_size = 1
+_client_options = None
+
+
+class _FirestoreClientPool(object):
+    def __init__(self, cert, pool_size, client_options):
+        """
+        Pool of Firestore clients for one set of credentials, created lazily and handed out round-robin.
+        Each client has its own gRPC channel, so a pool size above 1 spreads requests over more connections.
+        """
+        self._cert = cert
+        self._pool_size = pool_size
+        self._client_options = client_options
+        self._clients = []
+        self._next_index = 0
+        self._lock = threading.Lock()
+
+    def get_client(self):
+        with self._lock:
+            if len(self._clients) < self._pool_size:
+                cred = credentials.Certificate(self._cert)
+                log.debug(f"Creating Firestore client {len(self._clients) + 1}/{self._pool_size} for project "
+                          f"{cred.project_id}")
+                self._clients.append(firestore.Client(
+                    project=cred.project_id, credentials=cred.get_credential(), client_options=self._client_options
+                ))
+                return self._clients[-1]
+
+            client = self._clients[self._next_index]
+            self._next_index = (self._next_index + 1) % self._pool_size
+            return client
+
+
+def _get_credentials_key(cert):
+    if isinstance(cert, str):
+        with open(cert) as f:
+            cert = json.load(f)
+    return cert["project_id"], cert["client_email"], cert.get("private_key_id")
+
+
+def configure_firestore_clients(pool_size=1, client_options=None):
+    """
+    Sets the options to use when `get_firestore_client` creates clients.
+
+    This only affects credentials that haven't had a client requested yet, so it should be called at start-up before
+    any clients are created.
+
+    gRPC channel options, such as keepalive settings or maximum message sizes, can't be configured here. Each
+    google.cloud.firestore.Client creates its own channel with the library's own keepalive settings, and has no public
+    way to pass options to that channel. The number of connections can be tuned with `pool_size`.
+
+    :param pool_size: Number of clients (and therefore gRPC channels) to create for each set of credentials.
+                      Requests for a client are spread round-robin over the pool.
+    :type pool_size: int
+    :param client_options: Client options to construct clients with e.g. {"api_endpoint": "..."}, or None.
+    :type client_options: dict | google.api_core.client_options.ClientOptions | None
+    """
+    global _pool_size, _client_options
+
+    assert pool_size >= 1, "pool_size must be at least 1"
+    with _registry_lock:
+        _pool_size = pool_size
+        _client_options = client_options
+
+
+def get_firestore_client(cert):
+    """
+    Gets a shared Firestore client for the given credentials.
+
+    Clients are created the first time they are requested for a set of credentials, then shared by every later request
+    for the same credentials, including requests from different modules and threads. This means a process that uses
+    several components (e.g. uuid tables, an engagement database, and a pipeline logger) shares connections between
+    them, rather than each component opening its own.
+
+    :param cert: Path to a firebase credentials file or a dictionary containing firebase credentials.
+    :type cert: str | dict
+    :return: Firestore client.
+    :rtype: google.cloud.firestore.Client
+    """
+    key = _get_credentials_key(cert)
+    with _registry_lock:
+        if key not in _client_pools:
+            _client_pools[key] = _FirestoreClientPool(cert, _pool_size, _client_options)
+        pool = _client_pools[key]
+
+    return pool.get_client()
+
 
 def make_firestore_client(cert, app_name):
     """
     Creates a Firestore client from the given credentials.
 
-    Connects the returned client to a a new app with the given `app_name`, so that this client doesn't interfere with
-    any other Firestore clients. Note that this will force the default app to be created if it hasn't already,
-    because the Firestore api insists on a default app existing before named apps can be created.
+    Clients are shared with every other caller that uses the same credentials, via `get_firestore_client`, so calling
+    this more than once with the same `app_name` or credentials is safe.
 
     :param cert: Path to a firebase credentials file or a dictionary containing firebase credentials.
     :type cert: str | dict
-    :param app_name: Name to give the Firestore app instance that a client will be constructed for.
+    :param app_name: Name of the component requesting the client. This is only used for logging, and is kept for
+                     backwards compatibility.
     :type app_name: str
     :return: Firestore client.
-    :rtype: google.cloud.firestore.Firestore
+    :rtype: google.cloud.firestore.Client
     """
-    # Create the default app if it doesn't already exist, because we can't create an app with a custom `app_name`
-    # without creating a default app first.
-    try:
-        firebase_admin.get_app()
-    except ValueError:
-        log.debug("Creating default Firebase app")
-        firebase_admin.initialize_app()
-
-    log.debug(f"Creating Firebase app {app_name}")
-    cred = credentials.Certificate(cert)
-    app = firebase_admin.initialize_app(cred, name=app_name)
-    return firestore.client(app)
+    log.debug(f"Getting Firestore client for {app_name}")
+    return get_firestore_client(cert)
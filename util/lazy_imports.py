@@ -0,0 +1,37 @@
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    def __init__(self, name):
+        """
+        Module which is only imported when one of its attributes is first accessed.
+
+        This is used for the Google Cloud and Firebase SDKs, which take a long time to import, so that importing this
+        package stays fast and the SDKs are only loaded by processes which actually construct a client. For example:
+
+        >>> firestore = LazyModule("google.cloud.firestore")
+        >>> firestore.Client(...)  # google.cloud.firestore is imported here
+
+        :param name: Fully qualified name of the module to import.
+        :type name: str
+        """
+        super().__init__(name)
+        self.__dict__["_lazy_module"] = None
+
+    def _load(self):
+        if self._lazy_module is None:
+            # importlib holds a per-module lock while importing, so concurrent first accesses are safe.
+            self.__dict__["_lazy_module"] = importlib.import_module(self.__name__)
+        return self._lazy_module
+
+    def __getattr__(self, attr):
+        # Only called for attributes which aren't set on this proxy, i.e. everything except __name__ etc.
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "not yet imported" if self._lazy_module is None else "imported"
+        return f"<lazy module '{self.__name__}' ({state})>"